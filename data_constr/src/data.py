@@ -7,6 +7,7 @@ import logging
 from typing import List, Optional
 from tokenizations import get_alignments, get_original_spans
 
+from src.utils.bert_emb import encoder_rows, token_budget_batches, encode_sentences
 from .constants import (
     CoNLL_SOURCE_NAMES,
     OntoNotes_INDICES,
@@ -431,34 +432,33 @@ def linking_to_tagging_annos(tagging_anno_list, linking_anno_list):
     return normalized_link_anno_list
 
 
-def build_bert_emb(sents: List[str],
+def build_bert_emb(sents: List[List[str]],
                    tokenizer,
                    model,
-                   device: str):
-    bert_embs = list()
-    for i, sent in enumerate(sents):
-
-        joint_sent = ' '.join(sent)
-        bert_tokens = tokenizer.tokenize(joint_sent)
-
-        input_ids = torch.tensor([tokenizer.encode(joint_sent, add_special_tokens=True)], device=device)
-        # calculate BERT last layer embeddings
-        with torch.no_grad():
-            last_hidden_states = model(input_ids)[0].squeeze(0).to('cpu')
-            trunc_hidden_states = last_hidden_states[1:-1, :]
-
-        ori2bert, bert2ori = get_alignments(sent, bert_tokens)
-
-        emb_list = list()
-        for idx in ori2bert:
-            emb = trunc_hidden_states[idx, :]
-            emb_list.append(emb.mean(dim=0))
-
-        # TODO: using the embedding of [CLS] may not be the best idea
-        # It does not matter since that embedding is not used in the training
-        emb_list = [last_hidden_states[0, :]] + emb_list
-        bert_emb = torch.stack(emb_list)
-        bert_embs.append(bert_emb)
+                   device: str,
+                   max_tokens_per_batch: Optional[int] = 8192):
+    """
+    Build the word-level BERT embeddings of tokenized sentences in batches of similar lengths.
+    The subwords of each word are averaged; the embedding of [CLS] is prepended to each sentence.
+
+    Parameters
+    ----------
+    sents: token sequences
+    tokenizer: a fast tokenizer, which provides the word of each subword
+    model: BERT model
+    device: device of the model
+    max_tokens_per_batch: token budget of a batch, padding included
+    """
+    max_seq_length = min(tokenizer.model_max_length, model.config.max_position_embeddings, 512)
+    n_rows, row_lengths = encoder_rows(sents, tokenizer, max_seq_length)
+
+    # TODO: using the embedding of [CLS] may not be the best idea
+    # It does not matter since that embedding is not used in the training
+    bert_embs = [None] * len(sents)
+    for batch in tqdm(token_budget_batches(n_rows, row_lengths, max_tokens_per_batch)):
+        embs = encode_sentences([sents[idx] for idx in batch], tokenizer, model, max_seq_length, device)
+        for idx, emb in zip(batch, embs):
+            bert_embs[idx] = emb
     return bert_embs
 
 
@@ -17,7 +17,8 @@ from transformers import (
 from seqlbtoolkit.io import set_logging, logging_args
 from seqlbtoolkit.data import span_to_label, label_to_span
 # in-project dependencies
-from src.chmm.dataset import CHMMBaseDataset, collate_fn
+from src.chmm.dataset import CHMMBaseDataset, BatchCollator
+from src.chmm.projection import load_emb_projection, fit_emb_projection
 from src.chmm.train import CHMMTrainer
 from src.bert.dataset import BertNERDataset
 from src.bert.train import BertTrainer
@@ -32,23 +33,30 @@ def chmm_train(args: AltArguments):
 
     # setup CHMM datasets
     chmm_training_dataset = chmm_valid_dataset = chmm_test_dataset = None
+    # the embedding projection fitted by an earlier run, if any
+    projection = load_emb_projection(config)
     if args.train_path:
         logger.info('Loading training dataset for CHMM...')
         chmm_training_dataset = CHMMBaseDataset().load_file(
             file_path=args.train_path,
-            config=config
+            config=config,
+            projection=projection
         )
+        if projection is None and config.emb_projection != 'none':
+            projection = fit_emb_projection(config, chmm_training_dataset)
     if args.valid_path:
         logger.info('Loading validation dataset for CHMM...')
         chmm_valid_dataset = CHMMBaseDataset().load_file(
             file_path=args.valid_path,
-            config=config
+            config=config,
+            projection=projection
         )
     if args.test_path:
         logger.info('Loading test dataset for CHMM...')
         chmm_test_dataset = CHMMBaseDataset().load_file(
             file_path=args.test_path,
-            config=config
+            config=config,
+            projection=projection
         )
 
     # create output dir if it does not exist
@@ -60,7 +68,7 @@ def chmm_train(args: AltArguments):
 
     chmm_trainer = CHMMTrainer(
         config=config,
-        collate_fn=collate_fn,
+        collate_fn=BatchCollator(pin_memory=config.pin_memory),
         training_dataset=chmm_training_dataset,
         valid_dataset=chmm_valid_dataset,
         test_dataset=chmm_test_dataset,
@@ -99,15 +107,16 @@ def chmm_train(args: AltArguments):
                 f.write(f"  {k}: {v:.4f}\n")
             f.write('\n')
 
-    chmm_pred_lbs_train, chmm_pred_probs_train = chmm_trainer.predict(chmm_training_dataset)
-    # make sure the predicted labels are valid spans (do not start with I-)
-    chmm_pred_lbs_train = [span_to_label(label_to_span(lbs), tks) for lbs, tks in
-                           zip(chmm_pred_lbs_train, chmm_training_dataset.text)]
-
+    # only run the inference passes the BERT training objective needs
     if config.pass_soft_labels:
-        chmm_out = chmm_pred_probs_train
+        _, chmm_out = chmm_trainer.predict(chmm_training_dataset, return_labels=False)
     else:
-        chmm_out = chmm_pred_lbs_train
+        chmm_out, _ = chmm_trainer.predict(chmm_training_dataset, return_probs=False)
+        # make sure the predicted labels are valid spans (do not start with I-).
+        # BIO-constrained Viterbi paths are valid by construction
+        if not (config.bio_constrained_trans and config.decode_mode == 'viterbi'):
+            chmm_out = [span_to_label(label_to_span(lbs), tks) for lbs, tks in
+                        zip(chmm_out, chmm_training_dataset.text)]
 
     logger.info("Collecting garbage.")
     gc.collect()
@@ -205,7 +214,7 @@ def chmm_train(args: AltArguments):
 
         chmm_trainer = CHMMTrainer(
             config=config,
-            collate_fn=collate_fn,
+            collate_fn=BatchCollator(pin_memory=config.pin_memory),
             training_dataset=chmm_training_dataset,
             valid_dataset=chmm_valid_dataset,
             test_dataset=chmm_test_dataset,
@@ -240,15 +249,16 @@ def chmm_train(args: AltArguments):
                     f.write(f"  {k}: {v:.4f}\n")
                 f.write('\n')
 
-        chmm_pred_lbs_train, chmm_pred_probs_train = chmm_trainer.predict(chmm_training_dataset)
-        # make sure the predicted labels are valid spans (do not start with I-)
-        chmm_pred_lbs_train = [span_to_label(label_to_span(lbs), tks) for lbs, tks in
-                               zip(chmm_pred_lbs_train, chmm_training_dataset.text)]
-
+        # only run the inference passes the BERT training objective needs
         if config.pass_soft_labels:
-            chmm_out = chmm_pred_probs_train
+            _, chmm_out = chmm_trainer.predict(chmm_training_dataset, return_labels=False)
         else:
-            chmm_out = chmm_pred_lbs_train
+            chmm_out, _ = chmm_trainer.predict(chmm_training_dataset, return_probs=False)
+            # make sure the predicted labels are valid spans (do not start with I-).
+            # BIO-constrained Viterbi paths are valid by construction
+            if not (config.bio_constrained_trans and config.decode_mode == 'viterbi'):
+                chmm_out = [span_to_label(label_to_span(lbs), tks) for lbs, tks in
+                            zip(chmm_out, chmm_training_dataset.text)]
 
         logger.info("Collecting garbage.")
         gc.collect()
@@ -0,0 +1,122 @@
+# coding=utf-8
+""" Benchmark the eager and TorchScript CHMM dynamic programming backends on CPU for small numbers of states """
+
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+
+import torch
+
+from seqlbtoolkit.data import entity_to_bio_labels
+
+from src.chmm.args import CHMMConfig
+from src.chmm.model import CHMM
+
+logger = logging.getLogger(__name__)
+
+
+def build_chmm(args, n_ent: int, dp_backend: str) -> CHMM:
+    config = CHMMConfig()
+    config.no_cuda = True
+    config.entity_types = [f'ENT{i}' for i in range(n_ent)]
+    config.bio_label_types = entity_to_bio_labels(config.entity_types)
+    config.sources = [f'src{i}' for i in range(args.n_src)]
+    config.d_emb = args.d_emb
+    config.dp_backend = dp_backend
+    return CHMM(config)
+
+
+def random_batch(args, n_lbs: int):
+    embs = torch.randn(args.batch_size, args.seq_len, args.d_emb)
+    obs = torch.nn.functional.one_hot(
+        torch.randint(0, n_lbs, [args.batch_size, args.seq_len, args.n_src]), n_lbs
+    ).to(torch.float)
+    # uniformly distributed lengths; the longest instance always spans the whole batch
+    seq_lens = torch.randint(2, args.seq_len + 1, [args.batch_size])
+    seq_lens[0] = args.seq_len
+    return embs, obs, seq_lens
+
+
+def median_time(fn, n_repeats: int):
+    fn()  # warm up; the TorchScript profiling executor also optimizes on the first runs
+    fn()
+    wall_times = list()
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        fn()
+        wall_times.append(time.perf_counter() - start_time)
+    return np.median(wall_times)
+
+
+def run_backend(model: CHMM, embs, obs, seq_lens, n_repeats: int):
+    """
+    Time the forward-backward pass, the Viterbi decoding and the training step (forward-backward with the
+    expected log-likelihood and its gradients), and return the outputs for the parity check.
+    """
+    with torch.no_grad():
+        model._initialize_states(embs=embs, obs=obs.clone(), normalize_observation=False)
+        fb_time = median_time(lambda: model._forward_backward(seq_lens), n_repeats)
+        log_gamma = model._log_alpha + model._log_beta
+        log_gamma = log_gamma - log_gamma.logsumexp(dim=-1, keepdim=True)
+        viterbi_time = median_time(lambda: model._viterbi_decode(seq_lens), n_repeats)
+        paths, _ = model._viterbi_decode(seq_lens)
+
+    def training_step():
+        model.zero_grad()
+        log_likelihood, _ = model(embs, obs.clone(), seq_lens, normalize_observation=False)
+        log_likelihood.sum().backward()
+    train_time = median_time(training_step, n_repeats)
+    grads = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+
+    return (fb_time, viterbi_time, train_time), (log_gamma, paths, grads)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.n_threads)
+    logger.info(f"batch size: {args.batch_size}; sequence length: {args.seq_len}; sources: {args.n_src}; "
+                f"threads: {torch.get_num_threads()}")
+    logger.info(f"{'H':>4}" + ''.join(f"{name + ' (ms)':>24}" for name in ['forward-backward', 'viterbi', 'train step'])
+                + f"{'max |diff|':>14}")
+
+    for n_ent in args.n_ents:
+        models = {backend: build_chmm(args, n_ent, backend) for backend in ['torch', 'jit']}
+        models['jit'].load_state_dict(models['torch'].state_dict())
+        embs, obs, seq_lens = random_batch(args, models['torch']._d_obs)
+
+        times, outputs = dict(), dict()
+        for backend, model in models.items():
+            times[backend], outputs[backend] = run_backend(model, embs, obs, seq_lens, args.n_repeats)
+
+        # the posteriors and gradients must agree and the paths must be identical
+        log_gamma, paths, grads = outputs['torch']
+        jit_log_gamma, jit_paths, jit_grads = outputs['jit']
+        finite = torch.isfinite(log_gamma)
+        max_diff = max((log_gamma[finite] - jit_log_gamma[finite]).abs().max().item(),
+                       (grads - jit_grads).abs().max().item())
+        assert torch.equal(paths, jit_paths), f"the Viterbi paths differ for {n_ent} entity types"
+        assert max_diff < args.tolerance, f"the backends differ for {n_ent} entity types"
+
+        row = f"{2 * n_ent + 1:>4}"
+        for eager_time, jit_time in zip(times['torch'], times['jit']):
+            row += f"{eager_time * 1000:>9.2f} ->{jit_time * 1000:>7.2f} ({eager_time / jit_time:.1f}x)"
+        logger.info(row + f"{max_diff:>14.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n_ents', nargs='+', type=int, default=[1, 2, 4],
+                        help='numbers of entity types; d_hidden = 2 * n_ent + 1')
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_src', type=int, default=5)
+    parser.add_argument('--d_emb', type=int, default=64)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    parser.add_argument('--n_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--tolerance', type=float, default=1E-4)
+    parser.add_argument('--seed', type=int, default=42)
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO, stream=sys.stdout)
+    main(parser.parse_args())
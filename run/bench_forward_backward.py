@@ -0,0 +1,103 @@
+# coding=utf-8
+""" Benchmark the wall-clock time of the CHMM forward-backward modes on CPU """
+
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+
+import torch
+
+from seqlbtoolkit.data import entity_to_bio_labels
+
+from src.chmm.args import CHMMConfig
+from src.chmm.model import CHMM
+
+logger = logging.getLogger(__name__)
+
+
+def build_chmm(args, fb_mode: str) -> CHMM:
+    config = CHMMConfig()
+    config.no_cuda = True
+    config.entity_types = [f'ENT{i}' for i in range(args.n_ent)]
+    config.bio_label_types = entity_to_bio_labels(config.entity_types)
+    config.sources = [f'src{i}' for i in range(args.n_src)]
+    config.d_emb = args.d_emb
+    config.fb_mode = fb_mode
+    return CHMM(config)
+
+
+def random_batch(args, seq_len: int, n_lbs: int):
+    embs = torch.randn(args.batch_size, seq_len, args.d_emb)
+    obs = torch.nn.functional.one_hot(
+        torch.randint(0, n_lbs, [args.batch_size, seq_len, args.n_src]), n_lbs
+    ).to(torch.float)
+    if args.ragged:
+        # uniformly distributed lengths; the longest instance always spans the whole batch
+        seq_lens = torch.randint(2, seq_len + 1, [args.batch_size])
+        seq_lens[0] = seq_len
+    else:
+        seq_lens = torch.full([args.batch_size], seq_len, dtype=torch.long)
+    return embs, obs, seq_lens
+
+
+def time_forward_backward(model: CHMM, seq_lens: torch.Tensor, n_repeats: int):
+    wall_times = list()
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        model._forward_backward(seq_lens)
+        wall_times.append(time.perf_counter() - start_time)
+    return np.median(wall_times)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.n_threads)
+
+    models = {mode: build_chmm(args, mode) for mode in args.fb_modes}
+    # share the parameters so that the outputs of different modes are comparable
+    ref_model = models[args.fb_modes[0]]
+    for model in models.values():
+        model.load_state_dict(ref_model.state_dict())
+        model.eval()
+
+    logger.info(f"batch size: {args.batch_size}; hidden states: {ref_model._n_hidden}; "
+                f"sources: {args.n_src}; threads: {torch.get_num_threads()}")
+    logger.info(f"{'T':>6}" + ''.join(f"{mode + ' (ms)':>14}" for mode in args.fb_modes) + f"{'max |diff|':>14}")
+
+    for seq_len in args.seq_lens:
+        embs, obs, seq_lens = random_batch(args, seq_len, ref_model._d_obs)
+
+        row = f"{seq_len:>6}"
+        log_posteriors = list()
+        with torch.no_grad():
+            for mode in args.fb_modes:
+                model = models[mode]
+                model._initialize_states(embs=embs, obs=obs.clone(), normalize_observation=False)
+                time_forward_backward(model, seq_lens, 1)  # warm up
+                row += f"{time_forward_backward(model, seq_lens, args.n_repeats) * 1000:>14.2f}"
+
+                log_gamma = model._log_alpha + model._log_beta
+                log_gamma = log_gamma - log_gamma.logsumexp(dim=-1, keepdim=True)
+                log_posteriors.append(torch.cat([lg[:length] for lg, length in zip(log_gamma, seq_lens)]))
+
+        max_diff = max((lp.exp() - log_posteriors[0].exp()).abs().max().item() for lp in log_posteriors)
+        logger.info(row + f"{max_diff:>14.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fb_modes', nargs='+', default=['loop', 'scan'], help='forward-backward modes to compare')
+    parser.add_argument('--seq_lens', nargs='+', type=int, default=[32, 64, 128, 256, 512])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--ragged', action='store_true', help='draw instance lengths uniformly from [2, T]')
+    parser.add_argument('--n_ent', type=int, default=2, help='number of entity types; d_hidden = 2 * n_ent + 1')
+    parser.add_argument('--n_src', type=int, default=5)
+    parser.add_argument('--d_emb', type=int, default=768)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    parser.add_argument('--n_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=42)
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO, stream=sys.stdout)
+    main(parser.parse_args())
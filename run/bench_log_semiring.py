@@ -0,0 +1,135 @@
+# coding=utf-8
+""" Check the parity of the log-semiring matrix product kernels and benchmark them on the shapes CHMM uses """
+
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+
+import torch
+
+from src.utils.math import log_matmul, log_maxmul, log_matmul_exp, log_maxmul_chunked, log_prefix_matmul
+
+logger = logging.getLogger(__name__)
+
+
+def chmm_shapes(args):
+    """
+    The operands of the log-domain products in CHMM, keyed by where they are used.
+    """
+    b, t, s, h = args.batch_size, args.seq_len, args.n_src, 2 * args.n_ent + 1
+    log_probs = lambda *shape: torch.randn(*shape).log_softmax(dim=-1)
+    log_obs = torch.nn.functional.one_hot(torch.randint(0, h, [b, t, s]), h).to(torch.float).log()
+    return {
+        'emission evidence': (log_probs(b, t, s, h, h), log_obs.unsqueeze(-1)),
+        'forward step': (log_probs(b, 1, h), log_probs(b, h, h)),
+        'backward step': (log_probs(b, h, h), torch.randn(b, h, 1) * 10),
+        'prefix scan': (log_probs(b, t - 1, h, h), log_probs(b, t - 1, h, h)),
+        'scan alpha_0': (log_probs(b, 1, 1, h), log_probs(b, t - 1, h, h)),
+    }
+
+
+def values_and_grads(fn, a, b):
+    a = a.clone().requires_grad_()
+    b = b.clone().requires_grad_()
+    out = fn(a, b)
+    out = out[0] if isinstance(out, tuple) else out
+    # a random linear functional of the finite outputs
+    weights = torch.randn_like(out)
+    torch.where(torch.isfinite(out), out * weights, torch.zeros_like(out)).sum().backward()
+    return out.detach(), a.grad, b.grad
+
+
+def max_abs_diff(x, y):
+    # -inf entries must match exactly
+    if not torch.equal(torch.isfinite(x), torch.isfinite(y)):
+        return float('inf')
+    finite = torch.isfinite(x)
+    return (x[finite] - y[finite]).abs().max().item() if finite.any() else 0.0
+
+
+def check_parity(args):
+    logger.info("parity against the broadcast kernels (max |diff| of value / grad a / grad b)")
+    for name, (a, b) in chmm_shapes(args).items():
+        for ref_fn, fn, kernel in [(log_matmul, log_matmul_exp, 'sum'), (log_maxmul, log_maxmul_chunked, 'max')]:
+            torch.manual_seed(args.seed)
+            ref = values_and_grads(ref_fn, a, b)
+            torch.manual_seed(args.seed)
+            new = values_and_grads(fn, a, b)
+            diffs = [max_abs_diff(x, y) for x, y in zip(ref, new)]
+            logger.info(f"{name:>20} {kernel:>4}: " + ' / '.join(f"{d:.2e}" for d in diffs))
+            assert max(diffs) < args.tolerance, f"{name} ({kernel}) differs from the reference kernel"
+
+    log_potentials = chmm_shapes(args)['prefix scan'][0]
+    prefix_diff = max_abs_diff(
+        log_prefix_matmul(log_potentials), log_prefix_matmul(log_potentials, matmul_fn=log_matmul_exp)
+    )
+    logger.info(f"{'prefix product':>20}  sum: {prefix_diff:.2e}")
+    assert prefix_diff < args.tolerance, "prefix product differs from the reference kernel"
+
+    # analytical against numerical gradients, in double precision
+    a = torch.randn(3, 4, 5, dtype=torch.double, requires_grad=True)
+    b = torch.randn(3, 5, 2, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(log_matmul_exp, (a, b))
+    assert torch.autograd.gradcheck(lambda x, y: log_maxmul_chunked(x, y, 2)[0], (a, b))
+    # broadcast batch dimensions
+    assert torch.autograd.gradcheck(log_matmul_exp, (a[:1], b))
+    assert torch.autograd.gradcheck(lambda x, y: log_maxmul_chunked(x, y, 2)[0], (a, b[:1]))
+    logger.info("gradcheck passed")
+
+
+def time_kernel(fn, a, b, n_repeats, backward):
+    a = a.clone().requires_grad_(backward)
+    b = b.clone().requires_grad_(backward)
+    wall_times = list()
+    for _ in range(n_repeats + 1):
+        start_time = time.perf_counter()
+        out = fn(a, b)
+        out = out[0] if isinstance(out, tuple) else out
+        if backward:
+            torch.where(torch.isfinite(out), out, torch.zeros_like(out)).sum().backward()
+        wall_times.append(time.perf_counter() - start_time)
+    # the first run is a warm-up
+    return np.median(wall_times[1:])
+
+
+def benchmark(args):
+    kernels = {
+        'sum broadcast': log_matmul,
+        'sum matmul': log_matmul_exp,
+        'max broadcast': log_maxmul,
+        'max chunked': log_maxmul_chunked,
+    }
+    for backward in (False, True):
+        logger.info(f"\nwall-clock time in ms ({'forward + backward' if backward else 'forward'})")
+        logger.info(f"{'':>20}" + ''.join(f"{name:>16}" for name in kernels))
+        for name, (a, b) in chmm_shapes(args).items():
+            row = f"{name:>20}"
+            for fn in kernels.values():
+                row += f"{time_kernel(fn, a, b, args.n_repeats, backward) * 1000:>16.3f}"
+            logger.info(row)
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.n_threads)
+    logger.info(f"batch size: {args.batch_size}; sequence length: {args.seq_len}; hidden states: {2 * args.n_ent + 1}; "
+                f"sources: {args.n_src}; threads: {torch.get_num_threads()}")
+    check_parity(args)
+    benchmark(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--n_ent', type=int, default=4, help='number of entity types; d_hidden = 2 * n_ent + 1')
+    parser.add_argument('--n_src', type=int, default=10)
+    parser.add_argument('--n_repeats', type=int, default=10)
+    parser.add_argument('--n_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--tolerance', type=float, default=1E-4)
+    parser.add_argument('--seed', type=int, default=42)
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO, stream=sys.stdout)
+    main(parser.parse_args())
@@ -16,7 +16,8 @@ from transformers import (
 from seqlbtoolkit.io import set_logging, logging_args
 
 from src.chmm.train import CHMMTrainer
-from src.chmm.dataset import CHMMBaseDataset, collate_fn
+from src.chmm.dataset import CHMMBaseDataset, BatchCollator
+from src.chmm.projection import load_emb_projection, fit_emb_projection
 from src.chmm.args import CHMMArguments, CHMMConfig
 
 logger = logging.getLogger(__name__)
@@ -56,23 +57,30 @@ def chmm_train(args: CHMMArguments):
             training_dataset = valid_dataset = test_dataset = None
 
     if training_dataset is None:
+        # the embedding projection fitted by an earlier run, if any
+        projection = load_emb_projection(config)
         if args.train_path:
             logger.info('Loading training dataset...')
             training_dataset = CHMMBaseDataset().load_file(
                 file_path=args.train_path,
-                config=config
+                config=config,
+                projection=projection
             )
+            if projection is None and config.emb_projection != 'none':
+                projection = fit_emb_projection(config, training_dataset)
         if args.valid_path:
             logger.info('Loading validation dataset...')
             valid_dataset = CHMMBaseDataset().load_file(
                 file_path=args.valid_path,
-                config=config
+                config=config,
+                projection=projection
             )
         if args.test_path:
             logger.info('Loading test dataset...')
             test_dataset = CHMMBaseDataset().load_file(
                 file_path=args.test_path,
-                config=config
+                config=config,
+                projection=projection
             )
 
         if config.save_dataset:
@@ -85,7 +93,7 @@ def chmm_train(args: CHMMArguments):
 
     chmm_trainer = CHMMTrainer(
         config=config,
-        collate_fn=collate_fn,
+        collate_fn=BatchCollator(pin_memory=config.pin_memory),
         training_dataset=training_dataset,
         valid_dataset=valid_dataset,
         test_dataset=test_dataset,
@@ -104,6 +112,9 @@ def chmm_train(args: CHMMArguments):
     else:
         test_metrics = None
 
+    if args.export_annotator:
+        chmm_trainer.export_annotator()
+
     result_file = os.path.join(args.output_dir, 'chmm-results.txt')
     logger.info(f"Writing results to {result_file}")
     with open(result_file, 'w') as f:
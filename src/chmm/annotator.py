@@ -0,0 +1,297 @@
+"""
+Frozen CHMM annotator for deployment.
+
+`export_annotator` bundles the neural heads, the normalized HMM parameters, the label types and the decoding
+of a trained CHMM into one TorchScript module. The file is loaded with `torch.jit.load` (see `load_annotator`)
+and needs neither the training stack nor this repository. This module only depends on torch,
+so importing it does not pull in transformers.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import List, Tuple
+
+from .jit_kernels import forward_recursion, backward_recursion, viterbi_recursion
+
+
+def bio_span_bounds(paths: torch.Tensor,
+                    seq_lengths: torch.Tensor,
+                    is_begin_label: torch.Tensor,
+                    is_inside_label: torch.Tensor,
+                    label_entity_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Tensor part of `extract_bio_spans`, with the label types given as per-label indicators.
+
+    Parameters
+    ----------
+    paths: label indices (batch_size X max_seq_length)
+    seq_lengths: sequence lengths
+    is_begin_label: whether each label is B-X (n_lbs, BoolTensor)
+    is_inside_label: whether each label is I-X (n_lbs, BoolTensor)
+    label_entity_ids: entity type index of each label, -1 for `O` (n_lbs, LongTensor)
+
+    Returns
+    -------
+    sentence index, start, end (exclusive) and entity type index of each span
+    """
+    batch_size, max_seq_length = paths.size()
+    device = paths.device
+    is_begin = is_begin_label[paths]
+    is_inside = is_inside_label[paths]
+    entity_ids = label_entity_ids[paths]
+
+    valid = torch.arange(max_seq_length, device=device) < seq_lengths.unsqueeze(-1)
+    in_run = (is_begin | is_inside) & valid
+    # I-X continues the run of the previous token if that token is B-X or I-X
+    continues = is_inside & valid
+    # (an explicit assignment; TorchScript does not write augmented assignments to slices back)
+    continues[:, 1:] = continues[:, 1:] & in_run[:, :-1] & (entity_ids[:, 1:] == entity_ids[:, :-1])
+    continues[:, 0] = False
+
+    span_idx = torch.nonzero(is_begin & valid)
+    sent_ids, starts = span_idx[:, 0], span_idx[:, 1]
+    # the span ends at the first following token that does not continue it.
+    # A non-continuing column is appended so that every row has one
+    breaks = torch.nonzero(~torch.cat([continues, continues.new_zeros(batch_size, 1)], dim=-1).view(-1))[:, 0]
+    flat_starts = sent_ids * (max_seq_length + 1) + starts
+    ends = breaks[torch.searchsorted(breaks, flat_starts, right=True)] - sent_ids * (max_seq_length + 1)
+    return sent_ids, starts, ends, entity_ids[sent_ids, starts]
+
+
+class FrozenCHMM(nn.Module):
+    """
+    Inference-only CHMM with fixed parameters. Same outputs as `CHMM.decode` (Viterbi) and `CHMM.scored_spans`
+    with `normalize_observation=False`, i.e., for observations prepared by `CHMMBaseDataset`.
+
+    The neural heads are stored as plain weight tensors and the HMM parameters are stored normalized,
+    so that the module is scriptable and has no dependency on the training configuration.
+    """
+    label_types: List[str]
+    entity_types: List[str]
+
+    def __init__(self,
+                 label_types: List[str],
+                 log_state_priors: torch.Tensor,
+                 trans: torch.Tensor,
+                 emiss: torch.Tensor,
+                 trans_allowed: torch.Tensor,
+                 trans_head: Tuple[torch.Tensor, torch.Tensor],
+                 emiss_head: Tuple[torch.Tensor, torch.Tensor],
+                 trans_basis: torch.Tensor,
+                 emiss_basis: torch.Tensor,
+                 trans_nn_weight: float,
+                 emiss_nn_weight: float,
+                 bio_constrained: bool,
+                 use_neural_emiss: bool,
+                 factorized: bool):
+        super(FrozenCHMM, self).__init__()
+
+        self.label_types = label_types
+        self.entity_types = [lb[2:] for lb in label_types if lb.startswith('B-')]
+        self._n_src, self._d_hidden, self._d_obs = emiss.size()
+        self._trans_nn_weight = trans_nn_weight
+        self._emiss_nn_weight = emiss_nn_weight
+        self._bio_constrained = bio_constrained
+        self._use_neural_emiss = use_neural_emiss
+        self._factorized = factorized
+
+        self.register_buffer('log_state_priors', log_state_priors)
+        self.register_buffer('trans', trans)
+        self.register_buffer('emiss', emiss)
+        self.register_buffer('trans_allowed', trans_allowed)
+        self.register_buffer('trans_head_weight', trans_head[0])
+        self.register_buffer('trans_head_bias', trans_head[1])
+        # the emission heads of all sources are concatenated into one
+        self.register_buffer('emiss_head_weight', emiss_head[0])
+        self.register_buffer('emiss_head_bias', emiss_head[1])
+        # the normalized basis matrices of the factorized heads; empty otherwise
+        self.register_buffer('trans_basis', trans_basis)
+        self.register_buffer('emiss_basis', emiss_basis)
+
+        self.register_buffer('is_begin_label', torch.tensor([lb.startswith('B-') for lb in label_types]))
+        self.register_buffer('is_inside_label', torch.tensor([lb.startswith('I-') for lb in label_types]))
+        self.register_buffer('label_entity_ids', torch.tensor(
+            [self.entity_types.index(lb[2:]) if lb != 'O' else -1 for lb in label_types], dtype=torch.long
+        ))
+
+    @classmethod
+    def from_chmm(cls, chmm: nn.Module, label_types: List[str]) -> "FrozenCHMM":
+        """
+        Freeze the current parameters of a trained `CHMM`
+        """
+        assert chmm.n_replicas == 1, ValueError("Export the selected replica of a multi-restart model")
+        nn_module = chmm.neural_module
+
+        with torch.no_grad():
+            if chmm._bio_constrained:
+                trans_allowed = chmm._trans_allowed
+                log_state_priors = torch.log_softmax(chmm.state_priors.masked_fill(~chmm._init_allowed, -float('inf')),
+                                                     dim=-1)
+                trans = torch.softmax(chmm.unnormalized_trans.masked_fill(~trans_allowed, -float('inf')), dim=-1)
+            else:
+                trans_allowed = torch.ones_like(chmm.unnormalized_trans, dtype=torch.bool)
+                log_state_priors = torch.log_softmax(chmm.state_priors, dim=-1)
+                trans = torch.softmax(chmm.unnormalized_trans, dim=-1)
+            emiss = torch.softmax(chmm.unnormalized_emiss, dim=-1)
+
+            trans_head = (nn_module._neural_transition.weight, nn_module._neural_transition.bias)
+            if chmm._use_neural_emiss:
+                emiss_head = (torch.cat([head.weight for head in nn_module._neural_emissions]),
+                              torch.cat([head.bias for head in nn_module._neural_emissions]))
+            else:
+                emiss_head = (torch.empty(0), torch.empty(0))
+
+            trans_basis = emiss_basis = torch.empty(0)
+            if nn_module.is_factorized:
+                trans_basis = torch.softmax(
+                    nn_module._transition_basis.masked_fill(~trans_allowed, -float('inf')), dim=-1
+                )
+                if chmm._use_neural_emiss:
+                    emiss_basis = torch.softmax(nn_module._emission_basis, dim=-1)
+
+        return cls(
+            label_types=list(label_types),
+            log_state_priors=log_state_priors,
+            trans=trans,
+            emiss=emiss,
+            trans_allowed=trans_allowed,
+            trans_head=tuple(x.detach().clone() for x in trans_head),
+            emiss_head=tuple(x.detach().clone() for x in emiss_head),
+            trans_basis=trans_basis.detach().clone(),
+            emiss_basis=emiss_basis.detach().clone(),
+            trans_nn_weight=float(chmm._trans_weight),
+            emiss_nn_weight=float(chmm._emiss_weight),
+            bio_constrained=bool(chmm._bio_constrained),
+            use_neural_emiss=bool(chmm._use_neural_emiss),
+            factorized=bool(nn_module.is_factorized)
+        ).to('cpu')
+
+    def _log_potentials(self, embs: torch.Tensor, obs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Log transition matrices (batch_size X max_seq_length X d_hidden X d_hidden)
+        and emission evidence (batch_size X max_seq_length X d_hidden) of a batch
+        """
+        batch_size, max_seq_length, _ = embs.size()
+
+        trans_outputs = F.linear(embs, self.trans_head_weight, self.trans_head_bias)
+        if self._factorized:
+            nn_trans = torch.einsum('btk,kij->btij', torch.softmax(trans_outputs, dim=-1), self.trans_basis)
+        elif self._bio_constrained:
+            nn_trans = torch.softmax(torch.full(
+                [batch_size, max_seq_length, self._d_hidden, self._d_hidden], -float('inf'), device=embs.device
+            ).masked_scatter(self.trans_allowed, trans_outputs), dim=-1)
+        else:
+            nn_trans = torch.softmax(trans_outputs.view(batch_size, max_seq_length, self._d_hidden, self._d_hidden),
+                                     dim=-1)
+        trans = (1 - self._trans_nn_weight) * self.trans + self._trans_nn_weight * nn_trans
+        log_trans = torch.log(torch.where(self.trans_allowed, trans, torch.ones_like(trans)))\
+            .masked_fill(~self.trans_allowed, -float('inf'))
+
+        emiss = self.emiss.expand(batch_size, max_seq_length, -1, -1, -1)
+        if self._use_neural_emiss:
+            emiss_outputs = F.linear(embs, self.emiss_head_weight, self.emiss_head_bias)
+            if self._factorized:
+                emiss_weights = torch.softmax(
+                    emiss_outputs.view(batch_size, max_seq_length, self._n_src, -1), dim=-1
+                )
+                nn_emiss = torch.einsum('btsk,skho->btsho', emiss_weights, self.emiss_basis)
+            else:
+                nn_emiss = torch.softmax(emiss_outputs.view(
+                    batch_size, max_seq_length, self._n_src, self._d_hidden, self._d_obs
+                ), dim=-1)
+            emiss = (1 - self._emiss_nn_weight) * emiss + self._emiss_nn_weight * nn_emiss
+        log_emiss = torch.log(emiss)
+
+        if obs.is_floating_point():
+            log_obs = torch.log(obs)
+        else:
+            # label indices; the index `d_obs` marks the substituted observations
+            obs = obs.long()
+            substitute_prob = torch.full([self._d_obs], 0.99 / self._d_obs, device=obs.device)
+            substitute_prob[0] = 0.01
+            log_obs = torch.where(
+                (obs == self._d_obs).unsqueeze(-1),
+                torch.log(substitute_prob),
+                torch.log(F.one_hot(obs.clamp(max=self._d_obs - 1), self._d_obs).to(log_emiss.dtype))
+            )
+        log_emiss_evidence = torch.logsumexp(log_emiss + log_obs.unsqueeze(-2), dim=-1).sum(dim=-2)
+        return log_trans, log_emiss_evidence
+
+    def forward(self,
+                embs: torch.Tensor,
+                obs: torch.Tensor,
+                seq_lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Decode a batch.
+
+        Parameters
+        ----------
+        embs: token embeddings (batch_size X max_seq_length X d_emb)
+        obs: observations, either dense (batch_size X max_seq_length X n_src X d_obs, float)
+             or label indices (batch_size X max_seq_length X n_src, integer)
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        Viterbi paths (batch_size X max_seq_length, padded with 0), log probabilities of the paths,
+        posterior marginals (batch_size X max_seq_length X d_hidden)
+        """
+        log_trans, log_emiss_evidence = self._log_potentials(embs, obs)
+        paths, log_probs = viterbi_recursion(self.log_state_priors, log_trans, log_emiss_evidence, seq_lengths)
+
+        max_seq_length = int(seq_lengths.max().item())
+        log_alpha = forward_recursion(self.log_state_priors, log_trans, log_emiss_evidence, max_seq_length)
+        log_beta = backward_recursion(log_trans, log_emiss_evidence, seq_lengths, max_seq_length)
+        marginals = torch.softmax(log_alpha + log_beta, dim=-1)
+        return paths, log_probs, marginals
+
+    @torch.jit.export
+    def scored_spans(self,
+                     embs: torch.Tensor,
+                     obs: torch.Tensor,
+                     seq_lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor,
+                                                         torch.Tensor]:
+        """
+        Same as `CHMM.scored_spans`: the sentence index, start, end (exclusive), entity type index
+        (in `entity_types`) and score of each span, with the positions shifted back by the dummy first step
+        """
+        paths, _, marginals = self.forward(embs, obs, seq_lengths)
+        sent_ids, starts, ends, entity_ids = bio_span_bounds(
+            paths, seq_lengths, self.is_begin_label, self.is_inside_label, self.label_entity_ids
+        )
+
+        # the score of a span is the mean marginal probability of its labels, without the dummy step
+        token_probs = marginals.gather(-1, paths.unsqueeze(-1)).squeeze(-1)
+        token_probs[:, 0] = 0
+        cum_probs = torch.cat([token_probs.new_zeros(paths.size(0), 1), token_probs.cumsum(dim=-1)], dim=-1)
+        score_starts = starts.clamp(min=1)
+        scores = (cum_probs[sent_ids, ends] - cum_probs[sent_ids, score_starts]) / \
+            (ends - score_starts).clamp(min=1)
+
+        keep = ends > 1
+        return sent_ids[keep], (starts[keep] - 1).clamp(min=0), ends[keep] - 1, entity_ids[keep], scores[keep]
+
+
+def export_annotator(chmm: nn.Module, label_types: List[str], file_path: str):
+    """
+    Script a trained `CHMM` as a `FrozenCHMM` and save it to `file_path`
+
+    Returns
+    -------
+    the scripted module
+    """
+    annotator = torch.jit.script(FrozenCHMM.from_chmm(chmm, label_types).eval())
+    torch.jit.save(annotator, file_path)
+    return annotator
+
+
+def load_annotator(file_path: str, map_location: str = 'cpu'):
+    """
+    Load an annotator saved by `export_annotator`. Only needs torch.
+
+    Returns
+    -------
+    the scripted `FrozenCHMM`. Its `label_types` and `entity_types` attributes give the label names
+    """
+    return torch.jit.load(file_path, map_location=map_location).eval()
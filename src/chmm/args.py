@@ -37,6 +37,10 @@ class CHMMArguments:
     load_preprocessed_dataset: Optional[bool] = field(
         default=False, metadata={"help": "Whether load the pre-processed datasets from disk"}
     )
+    export_annotator: Optional[bool] = field(
+        default=False, metadata={"help": "Whether export the trained model as a self-contained TorchScript "
+                                         "annotator (`chmm-annotator.pt`) to the output folder"}
+    )
     track_training_time: Optional[bool] = field(
         default=False, metadata={'help': "Whether track training time in log files"}
     )
@@ -67,9 +71,136 @@ class CHMMArguments:
     lm_batch_size: Optional[int] = field(
         default=128, metadata={'help': 'denoising model training batch size'}
     )
+    length_bucketing: Optional[bool] = field(
+        default=False, metadata={'help': "Batch instances of similar lengths to reduce padding: training batches are "
+                                         "drawn from shuffled length buckets, and evaluation and prediction visit "
+                                         "the instances sorted by length (the outputs keep the dataset order)."}
+    )
+    bucket_size: Optional[int] = field(
+        default=50, metadata={'help': "Number of batches per length bucket in training with `length_bucketing`"}
+    )
+    num_workers: Optional[int] = field(
+        default=0, metadata={'help': "Number of DataLoader worker processes that load and collate the batches"}
+    )
+    pin_memory: Optional[bool] = field(
+        default=False, metadata={'help': "Collate the batches into pinned memory, so that they are copied to GPU "
+                                         "asynchronously (`non_blocking`). Without DataLoader workers, the pinned "
+                                         "batch buffers are reused."}
+    )
+    bio_constrained_trans: Optional[bool] = field(
+        default=False, metadata={'help': "Restrict the transitions to those allowed by the BIO scheme (I-X can only "
+                                         "follow B-X or I-X, and is never the initial state). The neural head "
+                                         "only predicts the allowed entries and the inference only visits them."}
+    )
+    nn_n_basis: Optional[int] = field(
+        default=0, metadata={'help': "Number of shared basis matrices of the factorized neural heads. "
+                                     "If positive, the neural transition (emission) of each token (and source) "
+                                     "is a token-dependent mixture of this many basis matrices instead of "
+                                     "a full matrix predicted from the embedding. 0 uses the full heads."}
+    )
+    num_restarts: Optional[int] = field(
+        default=1, metadata={'help': "Number of CHMM replicas with different random initializations trained "
+                                     "together in one process. The replicas share the data batches and the one "
+                                     "with the best validation F1 is kept."}
+    )
     obs_normalization: Optional[bool] = field(
         default=False, metadata={'help': 'whether normalize observations'}
     )
+    obs_format: Optional[str] = field(
+        default='dense', metadata={'help': "How the observations (weak labels) are stored. "
+                                           "`dense`: (seq_len, n_src, d_obs) one-hot float tensors; "
+                                           "`index`: (seq_len, n_src) int8/int16 label indices. A source that "
+                                           "gives several labels to one token (overlapping spans) needs `dense`."}
+    )
+    fb_mode: Optional[str] = field(
+        default='loop', metadata={'help': "How CHMM computes the forward-backward recursion. "
+                                          "`loop`: step through the time steps one by one; "
+                                          "`scan`: associative log-semiring prefix scan with O(log T) depth; "
+                                          "`packed`: step through time, skipping the instances that have ended."}
+    )
+    xi_mode: Optional[str] = field(
+        default='loop', metadata={'help': "How CHMM computes the expected transition log-likelihood. "
+                                          "`loop`: fill the full (B, T, H, H) xi buffer step by step; "
+                                          "`vectorized`: compute xi for all steps in one pass; "
+                                          "`streaming`: accumulate the sum over steps without holding xi."}
+    )
+    fb_posterior_grad: Optional[bool] = field(
+        default=False, metadata={'help': "Run forward-backward outside autograd and use the posteriors (gamma/xi) "
+                                         "as the gradients of the log-likelihood. This is the gradient of log p(x) "
+                                         "and does not back-propagate through the posteriors themselves."}
+    )
+    semiring_kernel: Optional[str] = field(
+        default='broadcast', metadata={'help': "How CHMM computes the log-domain matrix products. "
+                                               "`broadcast`: add and reduce over the full (m, n, p) intermediate; "
+                                               "`matmul`: max-shifted exp -> BLAS matmul -> log for the sum, "
+                                               "and a chunked reduction for the max (Viterbi)."}
+    )
+    dp_backend: Optional[str] = field(
+        default='torch', metadata={'help': "How CHMM runs the forward, backward and Viterbi recursions. "
+                                           "`torch`: eager PyTorch operations at each time step; "
+                                           "`jit`: TorchScript kernels that loop over time inside compiled code, "
+                                           "which removes the per-step overhead on CPU. `jit` always uses the "
+                                           "broadcast semiring kernel and does not apply to beam-pruned inference."}
+    )
+    fb_beam_size: Optional[int] = field(
+        default=0, metadata={'help': "Number of hidden states kept at each step in beam-pruned inference "
+                                     "(training and decoding). 0 means exact inference."}
+    )
+    fb_beam_threshold: Optional[float] = field(
+        default=0.0, metadata={'help': "Prune the states whose filtered posterior probability is below this value "
+                                       "in beam-pruned inference. Can be combined with `fb_beam_size`; "
+                                       "0 disables the threshold."}
+    )
+    decode_mode: Optional[str] = field(
+        default='viterbi', metadata={'help': "How CHMM decodes the hard labels for evaluation and prediction. "
+                                             "`viterbi`: the most probable label sequence; "
+                                             "`mbr`: the per-token argmax of the posterior marginals."}
+    )
+    stream_chunk_size: Optional[int] = field(
+        default=512, metadata={'help': "Number of tokens CHMM processes at a time in streaming inference."}
+    )
+    stream_lag: Optional[int] = field(
+        default=32, metadata={'help': "Minimum number of lookahead tokens used to smooth the marginals "
+                                      "in streaming inference. 0 means online filtering."}
+    )
+    nn_quantization: Optional[str] = field(
+        default='none', metadata={'help': "Quantization of the neural heads in prediction and evaluation. "
+                                          "`none`: float32; `dynamic`: dynamic int8 quantization of the linear "
+                                          "layers (CPU only). Training always uses float32."}
+    )
+    emb_storage: Optional[str] = field(
+        default='pickle', metadata={'help': "How the token embeddings are held. `pickle`: load the `*-emb.pt` file "
+                                            "to memory; `memmap`: convert it once to a contiguous on-disk store "
+                                            "(`*-emb.npy` with an offsets index) that is memory-mapped and read "
+                                            "lazily, sentence by sentence."}
+    )
+    emb_store_dtype: Optional[str] = field(
+        default='float32', metadata={'help': "Precision of the `memmap` embedding store: `float32` or `float16`."}
+    )
+    emb_cache_dir: Optional[str] = field(
+        default=None, metadata={'help': "Folder of the per-sentence BERT embedding cache, keyed by the hash of the "
+                                        "model and the tokens. When set, embedding files that were not built with "
+                                        "`bert_model_name_or_path` from the current sentences are rebuilt, and only "
+                                        "the sentences missing from the cache are encoded."}
+    )
+    emb_build_workers: Optional[int] = field(
+        default=1, metadata={'help': "Number of CPU processes that build the BERT embeddings; they share the CPU "
+                                     "threads. Ignored when the embeddings are built on GPU."}
+    )
+    emb_build_max_tokens: Optional[int] = field(
+        default=8192, metadata={'help': "Token budget (padding included) of a batch when building the BERT "
+                                        "embeddings; the sentences are batched by length."}
+    )
+    emb_projection: Optional[str] = field(
+        default='none', metadata={'help': "Project the token embeddings to a lower dimension before CHMM. "
+                                          "`none`: use the raw embeddings; `pca`: principal components of the "
+                                          "training embeddings; `random`: Gaussian random projection. The projection "
+                                          "is fitted once on the training set and saved to the output folder; the "
+                                          "projected embeddings are cached next to the raw embeddings."}
+    )
+    emb_projection_dim: Optional[int] = field(
+        default=128, metadata={'help': "Dimension of the projected embeddings"}
+    )
     bert_model_name_or_path: Optional[str] = field(
         default='', metadata={"help": "Path to pretrained BERT model or model identifier from huggingface.co/models; "
                                       "Used to construct BERT embeddings if not exist"}
@@ -11,10 +11,14 @@ from seqeval.scheme import IOB2
 import torch
 from torch.utils.data import DataLoader
 from seqlbtoolkit.data import entity_to_bio_labels, one_hot, probs_to_lbs
-from seqlbtoolkit.embs import build_bert_token_embeddings
 
 from .args import CHMMConfig
 from ..utils.io import load_data_from_json, load_data_from_pt
+from ..utils.emb_store import EmbeddingStore, emb_store_stem
+from ..utils.emb_cache import EmbeddingCache
+from ..utils.bert_emb import build_token_embeddings
+from .projection import EmbeddingProjection, projected_emb_path
+from ..utils.math import substitute_obs_mask, substitute_obs_prob
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +34,15 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
                  ents: Optional[List[str]] = None):
         super().__init__()
         self._embs = embs
+        # where the raw embeddings are stored on disk, if they are
+        self._emb_path = None
+        # `pickle`: lists of tensors in RAM; `memmap`: an `EmbeddingStore`. Set by `load_file`
+        self._emb_storage = 'pickle'
+        self._emb_store_dtype = 'float32'
         self._obs = obs
+        # normalized observations, computed once by `prepare_obs` and served by `__getitem__`
+        self._prepared_obs = None
+        self._prepared_obs_normalization = None
         self._text = text
         self._lbs = lbs
         self._src = src
@@ -57,6 +69,13 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
     def obs(self):
         return self._obs if self._obs else list()
 
+    @property
+    def is_index_obs(self):
+        """
+        Whether the observations are stored as label indices (the `index` format)
+        """
+        return bool(self._obs) and not self._obs[0].is_floating_point()
+
     @property
     def src(self):
         return self._src
@@ -80,6 +99,8 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
     def obs(self, value):
         logger.warning(f'{type(self)}: observations have been changed')
         self._obs = value
+        self._prepared_obs = None
+
 
     @lbs.setter
     def lbs(self, value):
@@ -109,10 +130,11 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         return self.n_insts
 
     def __getitem__(self, idx):
+        obs = self._prepared_obs[idx] if self._prepared_obs is not None else self._obs[idx]
         if self._lbs is not None and len(self._lbs) > 0:
-            return self._text[idx], self._embs[idx], self._obs[idx], self._lbs[idx]
+            return self._text[idx], self._embs[idx], obs, self._lbs[idx]
         else:
-            return self._text[idx], self._embs[idx], self._obs[idx]
+            return self._text[idx], self._embs[idx], obs
 
     def __add__(self, other: "CHMMBaseDataset") -> "CHMMBaseDataset":
         assert self.src and other.src and self.src == other.src, ValueError("Sources not matched!")
@@ -120,7 +142,7 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
 
         return CHMMBaseDataset(
             text=copy.deepcopy(self.text + other.text),
-            embs=copy.deepcopy(self.embs + other.embs),
+            embs=copy.deepcopy(list(self.embs) + list(other.embs)),
             obs=copy.deepcopy(self.obs + other.obs),
             lbs=copy.deepcopy(self.lbs + other.lbs),
             ents=copy.deepcopy(self.ents),
@@ -139,7 +161,7 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
             assert other.ents, ValueError("Attribute `ents` not found!")
 
         self.text = copy.deepcopy(self.text + other.text)
-        self.embs = copy.deepcopy(self.embs + other.embs)
+        self.embs = copy.deepcopy(list(self.embs) + list(other.embs))
         self.obs = copy.deepcopy(self.obs + other.obs)
         self.lbs = copy.deepcopy(self.lbs + other.lbs)
         self.ents = copy.deepcopy(other.ents)
@@ -172,7 +194,7 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
             'obs': self.obs,
             'src': self.src,
             'ents': self.ents,
-            'embs': self.embs,
+            'embs': list(self.embs),
             'src_priors': config.src_priors
         }
         torch.save(chmm_data_dict, output_path)
@@ -218,7 +240,8 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
 
     def load_file(self,
                   file_path: str,
-                  config: Optional[CHMMConfig] = None) \
+                  config: Optional[CHMMConfig] = None,
+                  projection: Optional[EmbeddingProjection] = None) \
             -> Union["CHMMBaseDataset", Tuple["CHMMBaseDataset", "CHMMConfig"]]:
         """
         Load data from disk
@@ -227,6 +250,8 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         ----------
         file_path: the directory of the file. In JSON or PT
         config: chmm configuration; Optional to make function testing easier.
+        projection: embedding projection. If given, the cached projected embeddings are loaded instead of the raw
+            embeddings when they exist; otherwise the raw embeddings are projected and cached, see `project_embs`
 
         Returns
         -------
@@ -273,23 +298,52 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         logger.info(f'Data loaded from {file_path}.')
 
         logger.info(f'Searching for corresponding BERT embeddings...')
-        if os.path.isfile(emb_dir):
-            logger.info(f"Found embedding file: {emb_dir}. Loading to memory...")
-            embs = torch.load(emb_dir)
-            if isinstance(embs[0], torch.Tensor):
-                self._embs = embs
-            elif isinstance(embs[0], np.ndarray):
-                self._embs = [torch.from_numpy(emb).to(torch.float) for emb in embs]
-            else:
-                logger.error(f"Unknown embedding type: {type(embs[0])}")
-                raise RuntimeError
+        self._emb_path = emb_dir
+        self._emb_storage = getattr(config, 'emb_storage', 'pickle')
+        self._emb_store_dtype = getattr(config, 'emb_store_dtype', 'float32')
+        assert self._emb_storage in ['pickle', 'memmap'], \
+            ValueError(f"Unknown embedding storage: {self._emb_storage}")
+
+        # with the sentence cache, embedding files built from another model or other sentences are not reused
+        emb_cache = None
+        emb_is_current = True
+        if getattr(config, 'emb_cache_dir', None):
+            assert bert_model, ValueError('The embedding cache requires `bert_model_name_or_path`')
+            emb_cache = EmbeddingCache(config.emb_cache_dir, bert_model)
+            emb_is_current = emb_cache.is_up_to_date(emb_dir, self._text)
+            if not emb_is_current and (os.path.isfile(emb_dir) or self._emb_file_exists(emb_dir)):
+                logger.warning(f"{emb_dir} was not built with {bert_model} from the current sentences. "
+                               f"Rebuilding it from the embedding cache...")
+
+        projected_emb_dir = projected_emb_path(emb_dir, projection) if projection is not None else None
+        if emb_is_current and projected_emb_dir is not None and self._emb_file_exists(projected_emb_dir):
+            logger.info(f"Found projected embeddings: {projected_emb_dir}.")
+            self._embs = self._load_emb_file(projected_emb_dir)
+            projection = None
+        elif emb_is_current and self._emb_file_exists(emb_dir):
+            logger.info(f"Found embeddings: {emb_dir}.")
+            self._embs = self._load_emb_file(emb_dir)
+        elif emb_is_current and os.path.isfile(emb_dir):
+            # convert the pickled embeddings into the store once
+            logger.info(f"Found embedding file: {emb_dir}. Converting to an embedding store...")
+            self._embs = self._load_emb_file(emb_dir, storage='pickle')
+            self._save_emb_file(emb_dir)
         else:
-            logger.info(f"{emb_dir} does not exist. Building embeddings instead...")
+            if emb_is_current:
+                logger.info(f"{emb_dir} does not exist. Building embeddings instead...")
 
             if not has_config_input:
                 logger.warning(f"No configuration found. Using default bert model `bert-base_model-uncased` "
                                f"and default device `cpu`.")
-            self.build_embs(bert_model, device, emb_dir)
+            self.build_embs(
+                bert_model, device, emb_dir, emb_cache=emb_cache,
+                n_workers=getattr(config, 'emb_build_workers', 1),
+                max_tokens_per_batch=getattr(config, 'emb_build_max_tokens', 8192)
+            )
+            if self._emb_storage == 'memmap':
+                self._save_emb_file(emb_dir)
+        if projection is not None:
+            self.project_embs(projection)
 
         self._src = copy.deepcopy(config.sources)
         self._ents = config.entity_types
@@ -301,8 +355,11 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         logger.info("Appending dummy token/labels in front of the text/lbs/obs for CHMM compatibility")
         self._text = [['[CLS]'] + txt for txt in self._text]
         self._lbs = [['O'] + lb for lb in self._lbs]
-        prefix = torch.zeros([1, self._obs[0].shape[-2], self._obs[0].shape[-1]])  # shape: 1, n_src, d_obs
-        prefix[:, :, 0] = 1
+        if self.is_index_obs:
+            prefix = torch.zeros([1, self._obs[0].shape[-1]], dtype=self._obs[0].dtype)  # shape: 1, n_src
+        else:
+            prefix = torch.zeros([1, self._obs[0].shape[-2], self._obs[0].shape[-1]])  # shape: 1, n_src, d_obs
+            prefix[:, :, 0] = 1
         self._obs = [torch.cat([prefix, inst]) for inst in self._obs]
 
         if has_config_input:
@@ -313,7 +370,10 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
     def build_embs(self,
                    bert_model,
                    device: Optional[torch.device] = torch.device('cpu'),
-                   save_dir: Optional[str] = None) -> "CHMMBaseDataset":
+                   save_dir: Optional[str] = None,
+                   emb_cache: Optional[EmbeddingCache] = None,
+                   n_workers: Optional[int] = 1,
+                   max_tokens_per_batch: Optional[int] = 8192) -> "CHMMBaseDataset":
         """
         build bert embeddings
 
@@ -322,6 +382,9 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         bert_model: the location/name of the bert model to use
         device: device
         save_dir: location to update/store the BERT embeddings. Leave None if do not want to save
+        emb_cache: per-sentence embedding cache of `bert_model`; only the sentences missing from it are encoded
+        n_workers: number of CPU processes that encode the sentences
+        max_tokens_per_batch: token budget of an encoder batch
 
         Returns
         -------
@@ -329,14 +392,133 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         """
         assert bert_model is not None, AssertionError('Please specify BERT model to build embeddings')
         logger.info(f'Building BERT embeddings with {bert_model} on {device}')
-        self._embs = build_bert_token_embeddings(
-            self._text, bert_model, bert_model, device=device, prepend_cls_embs=True
+        # the finished batches are kept next to the embedding file until the build completes
+        checkpoint_dir = f'{emb_store_stem(os.path.normpath(save_dir))}-build' if save_dir else None
+        encode_fn = functools.partial(
+            build_token_embeddings, model_name_or_path=bert_model, device=device,
+            max_tokens_per_batch=max_tokens_per_batch, n_workers=n_workers, checkpoint_dir=checkpoint_dir,
+            prepend_cls_embs=True
         )
+        self._embs = emb_cache.get(self._text, encode_fn) if emb_cache is not None else encode_fn(self._text)
         if save_dir:
             save_dir = os.path.normpath(save_dir)
             logger.info(f'Saving embeddings to {save_dir}...')
             embs = [emb.numpy().astype(np.float32) for emb in self.embs]
             torch.save(embs, save_dir)
+            if emb_cache is not None:
+                emb_cache.write_manifest(save_dir, self._text)
+        return self
+
+    def project_embs(self,
+                     projection: EmbeddingProjection,
+                     config: Optional[CHMMConfig] = None) -> "CHMMBaseDataset":
+        """
+        Project the embeddings to a lower dimension. If the raw embeddings were loaded from disk, the projected
+        embeddings are cached next to them (see `projection.projected_emb_path`) for the following runs.
+
+        Parameters
+        ----------
+        projection: fitted embedding projection
+        config: configuration; if given, `d_emb` is updated to the projected dimension
+
+        Returns
+        -------
+        self (MultiSrcNERDataset)
+        """
+        logger.info(f'Projecting the embeddings to {projection.d_proj} dimensions...')
+        self._embs = [projection(emb) for emb in self._embs]
+        # a truncated set (debug mode) is not cached
+        if self._emb_path and len(self._embs) == len(self._obs):
+            self._save_emb_file(projected_emb_path(self._emb_path, projection))
+        if config is not None:
+            config.d_emb = projection.d_proj
+        return self
+
+    def _emb_file_exists(self, file_path: str):
+        if self._emb_storage == 'memmap':
+            return EmbeddingStore.exists(emb_store_stem(file_path))
+        return os.path.isfile(file_path)
+
+    def _load_emb_file(self, file_path: str, storage: Optional[str] = None):
+        """
+        Load the embeddings saved at `file_path`: a pickled list (loaded to memory)
+        or an `EmbeddingStore` next to it (memory-mapped)
+        """
+        storage = storage if storage is not None else self._emb_storage
+        if storage == 'memmap':
+            logger.info(f"Memory-mapping the embedding store {emb_store_stem(file_path)}...")
+            return EmbeddingStore(emb_store_stem(file_path))
+
+        logger.info(f"Loading {file_path} to memory...")
+        embs = torch.load(file_path)
+        if isinstance(embs[0], torch.Tensor):
+            return embs
+        elif isinstance(embs[0], np.ndarray):
+            return [torch.from_numpy(emb).to(torch.float) for emb in embs]
+        else:
+            logger.error(f"Unknown embedding type: {type(embs[0])}")
+            raise RuntimeError
+
+    def _save_emb_file(self, file_path: str):
+        """
+        Save the embeddings to `file_path` in the storage format of the dataset.
+        An `EmbeddingStore` replaces the embeddings in memory
+        """
+        if self._emb_storage == 'memmap':
+            self._embs = EmbeddingStore.write(emb_store_stem(file_path), self._embs, dtype=self._emb_store_dtype)
+        else:
+            logger.info(f'Saving embeddings to {file_path}...')
+            torch.save(self._embs, file_path)
+        return self
+
+    def prepare_obs(self, obs_normalization: Optional[bool] = False) -> "CHMMBaseDataset":
+        """
+        Normalize the observations once for the whole dataset so that neither the batch collation nor CHMM
+        needs to do it for every batch. Dense observation rows are scaled to sum to 1; with
+        `obs_normalization`, the `O` observations of the sources that miss an entity observed by other sources
+        are replaced by the substitute distribution (dense format) or marked with the index `d_obs`
+        (`index` format). The instances that are not changed share the tensors with the raw observations.
+
+        Parameters
+        ----------
+        obs_normalization: whether substitute the observations as `CHMM` does with `normalize_observation`
+
+        Returns
+        -------
+        self (MultiSrcNERDataset)
+        """
+        if self._prepared_obs is not None and self._prepared_obs_normalization == obs_normalization:
+            return self
+
+        d_obs = len(entity_to_bio_labels(self.ents)) if self.ents else None
+        prepared_obs = list()
+        for obs in self.obs:
+            if obs.is_floating_point():
+                row_sums = obs.sum(dim=-1, keepdim=True)
+                if not (row_sums == 1).all():
+                    obs = obs / row_sums
+                if obs_normalization:
+                    no_obs_src_idx = substitute_obs_mask(obs.argmax(dim=-1))
+                    if no_obs_src_idx.any():
+                        obs = torch.where(no_obs_src_idx.unsqueeze(-1), substitute_obs_prob(obs.shape[-1]), obs)
+            elif obs_normalization:
+                assert d_obs is not None, ValueError("Entity types are required to normalize index observations!")
+                no_obs_src_idx = substitute_obs_mask(obs)
+                if no_obs_src_idx.any():
+                    obs = obs.masked_fill(no_obs_src_idx, d_obs)
+            prepared_obs.append(obs)
+
+        self._prepared_obs = prepared_obs
+        self._prepared_obs_normalization = obs_normalization
+        return self
+
+    def _refresh_prepared_obs(self):
+        """
+        Recompute the normalized observations after the raw observations changed, if they were prepared
+        """
+        if self._prepared_obs is not None:
+            self._prepared_obs = None
+            self.prepare_obs(self._prepared_obs_normalization)
         return self
 
     def update_obs(self,
@@ -362,21 +544,26 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
             obs = [np_map(np.asarray(weak_lbs)).tolist() for weak_lbs in obs]
 
         if len(obs[0]) == len(self.text[0]):
-            weak_lbs_one_hot = [one_hot(np.asarray(weak_lbs), n_class=config.n_lbs) for weak_lbs in obs]
+            pass
         elif len(obs[0]) == len(self.text[0]) - 1:
-            weak_lbs_one_hot = [one_hot(np.asarray([0] + weak_lbs), n_class=config.n_lbs) for weak_lbs in obs]
+            obs = [[0] + weak_lbs for weak_lbs in obs]
         else:
             logger.error("The length of the input observation does not match the dataset sentences!")
             raise ValueError("The length of the input observation does not match the dataset sentences!")
 
+        if self.is_index_obs:
+            weak_lbs_list = [torch.tensor(weak_lbs, dtype=self._obs[0].dtype) for weak_lbs in obs]
+        else:
+            weak_lbs_list = [torch.tensor(one_hot(np.asarray(weak_lbs), n_class=config.n_lbs)) for weak_lbs in obs]
+
         if src_name in self._src:
             src_idx = self._src.index(src_name)
             for i in range(len(self._obs)):
-                self._obs[i][:, src_idx, :] = torch.tensor(weak_lbs_one_hot[i])
+                self._obs[i][:, src_idx] = weak_lbs_list[i]
         else:
             self._src.append(src_name)
             for i in range(len(self._obs)):
-                self._obs[i] = torch.cat([self._obs[i], torch.tensor(weak_lbs_one_hot[i]).unsqueeze(1)], dim=1)
+                self._obs[i] = torch.cat([self._obs[i], weak_lbs_list[i].unsqueeze(1)], dim=1)
             # add the source into config and give a heuristic source prior
             if src_name not in config.sources:
                 config.sources.append(src_name)
@@ -388,6 +575,7 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
             except Exception:
                 pass
 
+        self._refresh_prepared_obs()
         return self
 
     def remove_src(self,
@@ -423,7 +611,7 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         # remove the corresponding observation
         self._src.remove(src_name)
         for i in range(len(self._obs)):
-            self._obs[i] = self._obs[i][:, other_idx, :]
+            self._obs[i] = self._obs[i][:, other_idx]
 
         # remove the cached property
         try:
@@ -431,13 +619,18 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         except Exception:
             pass
 
+        self._refresh_prepared_obs()
         return self
 
     @functools.cache
     def _get_src_metrics(self):
         src_record_list = [list() for _ in range(len(self.src))]
+        bio_labels = entity_to_bio_labels(self.ents)
         for obs in self._obs:
-            src_lbs_list = probs_to_lbs(obs, entity_to_bio_labels(self.ents)).T.tolist()
+            if self.is_index_obs:
+                src_lbs_list = np.asarray(bio_labels)[obs.long().numpy()].T.tolist()
+            else:
+                src_lbs_list = probs_to_lbs(obs, bio_labels).T.tolist()
             for src_lbs, src_record in zip(src_lbs_list, src_record_list):
                 src_record.append(src_lbs)
         metric_dict = dict()
@@ -461,34 +654,50 @@ class CHMMBaseDataset(torch.utils.data.Dataset):
         return metric_dict
 
 
+def _batch_tensor(shape: List[int], dtype: torch.dtype, buffer: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    A contiguous (uninitialized) batch tensor: a view of the head of a flat `buffer` if given, otherwise a new tensor
+    """
+    if buffer is None:
+        return torch.empty(shape, dtype=dtype)
+    return buffer[:int(np.prod(shape))].view(shape)
+
+
 def batch_prep(emb_list: List[torch.Tensor],
                obs_list: List[torch.Tensor],
                txt_list: Optional[List[List[str]]] = None,
-               lbs_list: Optional[List[dict]] = None):
+               lbs_list: Optional[List[dict]] = None,
+               emb_buffer: Optional[torch.Tensor] = None,
+               obs_buffer: Optional[torch.Tensor] = None):
     """
     Pad the instance to the max seq max_seq_length in batch
 
-    All input should already have the dummy element appended to the beginning of the sequence
+    All input should already have the dummy element appended to the beginning of the sequence,
+    and the dense observations should already be normalized (see `CHMMBaseDataset.prepare_obs`)
+
+    The padded batches are allocated once and the instances are copied into them; with `emb_buffer` and
+    `obs_buffer` (flat tensors large enough for the batch), the batches are views of the buffers instead.
     """
-    for emb, obs, txt, lbs in zip(emb_list, obs_list, txt_list, lbs_list):
-        assert len(obs) == len(emb) == len(txt) == len(lbs)
-    d_emb = emb_list[0].shape[-1]
-    _, n_src, n_obs = obs_list[0].size()
+    for inst_lists in zip(emb_list, obs_list, *[lst for lst in (txt_list, lbs_list) if lst is not None]):
+        assert all(len(inst) == len(inst_lists[0]) for inst in inst_lists)
+    batch_size = len(obs_list)
     seq_lens = [len(obs) for obs in obs_list]
-    max_seq_len = np.max(seq_lens)
+    max_seq_len = max(seq_lens)
 
-    emb_batch = torch.stack([
-        torch.cat([inst, torch.zeros([max_seq_len-len(inst), d_emb])], dim=-2) for inst in emb_list
-    ])
-
-    prefix = torch.zeros([1, n_src, n_obs])
-    prefix[:, :, 0] = 1
-    obs_batch = torch.stack([
-        torch.cat([inst, prefix.repeat([max_seq_len-len(inst), 1, 1])]) for inst in obs_list
-    ])
-    obs_batch /= obs_batch.sum(dim=-1, keepdim=True)
+    emb_batch = _batch_tensor([batch_size, max_seq_len, emb_list[0].shape[-1]], torch.float, emb_buffer)
+    # label indices are padded with `O`, whose index is 0
+    obs_batch = _batch_tensor([batch_size, max_seq_len, *obs_list[0].shape[1:]], obs_list[0].dtype, obs_buffer)
+    for idx, (emb, obs, seq_len) in enumerate(zip(emb_list, obs_list, seq_lens)):
+        emb_batch[idx, :seq_len] = emb
+        emb_batch[idx, seq_len:] = 0
+        obs_batch[idx, :seq_len] = obs
+        obs_batch[idx, seq_len:] = 0
 
     seq_lens = torch.tensor(seq_lens, dtype=torch.long)
+    if obs_batch.is_floating_point():
+        # dense observations are padded with the one-hot `O`
+        padding_mask = torch.arange(max_seq_len) >= seq_lens.unsqueeze(-1)
+        obs_batch[..., 0].masked_fill_(padding_mask.unsqueeze(-1), 1)
 
     # we don't need to append the length of txt_list and lbs_list
     return emb_batch, obs_batch, seq_lens, txt_list, lbs_list
@@ -514,6 +723,60 @@ def collate_fn(insts):
     return batch
 
 
+class BatchCollator:
+    """
+    `collate_fn` that pads the batches into buffers reused from batch to batch, pinned for fast (asynchronous)
+    transfer to GPU, so that a batch is neither allocated nor pinned again.
+
+    The buffers take turns, so a batch is overwritten `n_buffers` batches later: keep a copy (e.g., the batch moved
+    to GPU) of whatever outlives that. Two buffers suit the `non_blocking` copies of the trainer: the next batch is
+    collated into the other buffer while the copy of the current one may still be in flight, and each training or
+    evaluation step waits for the GPU (e.g., `loss.item()`) before the buffer comes round again.
+
+    In DataLoader worker processes, whose batches are sent to the main process through shared memory, the batches
+    are allocated one by one as `collate_fn` does, and the DataLoader pins them if `pin_memory` is set.
+    """
+
+    def __init__(self, n_buffers: Optional[int] = 2, pin_memory: Optional[bool] = True):
+        self._n_buffers = n_buffers
+        # pinned memory needs CUDA
+        self._pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = [dict() for _ in range(n_buffers)]
+        self._buffer_idx = 0
+
+    def _get_buffer(self, name: str, n_elements: int, dtype: torch.dtype) -> torch.Tensor:
+        buffers = self._buffers[self._buffer_idx]
+        buffer = buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < n_elements:
+            # grow geometrically, so that a few longer batches do not reallocate every time
+            if buffer is not None and buffer.dtype == dtype:
+                n_elements = max(n_elements, 2 * buffer.numel())
+            buffer = torch.empty(n_elements, dtype=dtype, pin_memory=self._pin_memory)
+            buffers[name] = buffer
+        return buffer
+
+    def __call__(self, insts):
+        if torch.utils.data.get_worker_info() is not None:
+            return collate_fn(insts)
+
+        txt, embs, obs, *lbs = zip(*insts)
+        batch_size, max_seq_len = len(obs), max(len(inst) for inst in obs)
+        emb_buffer = self._get_buffer('emb', batch_size * max_seq_len * embs[0].shape[-1], torch.float)
+        obs_buffer = self._get_buffer('obs', batch_size * max_seq_len * int(np.prod(obs[0].shape[1:])), obs[0].dtype)
+        self._buffer_idx = (self._buffer_idx + 1) % self._n_buffers
+
+        return batch_prep(
+            emb_list=embs, obs_list=obs, txt_list=txt, lbs_list=lbs[0] if lbs else None,
+            emb_buffer=emb_buffer, obs_buffer=obs_buffer
+        )
+
+    def __getstate__(self):
+        # spawned worker processes get a collator without the buffers
+        state = self.__dict__.copy()
+        state['_buffers'] = [dict() for _ in range(self._n_buffers)]
+        return state
+
+
 def load_src_metrics(file_path: str):
     """
     Load the file that contains the performance of each source
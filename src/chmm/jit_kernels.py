@@ -0,0 +1,114 @@
+"""
+TorchScript kernels of the CHMM dynamic programming recursions.
+
+The time loops run inside the compiled graphs, so the per-step operator dispatch of the eager
+`CHMM._forward_step` / `CHMM._backward_step` / Viterbi loops is gone. With the few hidden states of most
+datasets, that overhead costs more than the arithmetic on CPU.
+
+The kernels do the same arithmetic as the eager loops with the broadcast semiring kernels
+(`log_matmul` / `log_maxmul`). They run over the full (masked) transition matrices and support autograd.
+They are compiled on first use by `scripted_kernels`, so the eager backend never pays the compilation.
+"""
+
+import torch
+from functools import lru_cache
+from typing import List, Tuple
+
+
+def _pad_steps(x: torch.Tensor, total_steps: int) -> torch.Tensor:
+    """
+    Pad dimension 1 of `x` with zeros to `total_steps`, same as the zero-initialized eager buffers
+    """
+    if x.size(1) == total_steps:
+        return x
+    padding = torch.zeros([x.size(0), total_steps - x.size(1), x.size(2)], dtype=x.dtype, device=x.device)
+    return torch.cat([x, padding], dim=1)
+
+
+def forward_recursion(log_state_priors: torch.Tensor,
+                      log_trans: torch.Tensor,
+                      log_emiss_evidence: torch.Tensor,
+                      max_seq_length: int) -> torch.Tensor:
+    """
+    Normalized log alpha (batch_size X total_steps X n_hidden).
+    `log_state_priors` is either shared (n_hidden) or per instance (batch_size X n_hidden).
+    """
+    log_alpha_t = log_state_priors + log_emiss_evidence[:, 0, :]
+    log_alpha_t = log_alpha_t - torch.logsumexp(log_alpha_t, dim=-1, keepdim=True)
+    log_alphas: List[torch.Tensor] = [log_alpha_t]
+    for t in range(1, max_seq_length):
+        log_alpha_t = log_emiss_evidence[:, t, :] + torch.logsumexp(
+            log_alpha_t.unsqueeze(-1) + log_trans[:, t, :, :], dim=-2
+        )
+        log_alpha_t = log_alpha_t - torch.logsumexp(log_alpha_t, dim=-1, keepdim=True)
+        log_alphas.append(log_alpha_t)
+    return _pad_steps(torch.stack(log_alphas, dim=1), log_emiss_evidence.size(1))
+
+
+def backward_recursion(log_trans: torch.Tensor,
+                       log_emiss_evidence: torch.Tensor,
+                       seq_lengths: torch.Tensor,
+                       max_seq_length: int) -> torch.Tensor:
+    """
+    Unnormalized log beta (batch_size X total_steps X n_hidden).
+    Beta stays log1 = 0 from the last step of each instance on.
+    """
+    log_beta_t = torch.zeros_like(log_emiss_evidence[:, 0, :])
+    log_betas: List[torch.Tensor] = [log_beta_t]
+    for t in range(max_seq_length - 2, -1, -1):
+        log_step = torch.logsumexp(
+            log_trans[:, t + 1, :, :] + (log_emiss_evidence[:, t + 1, :] + log_beta_t).unsqueeze(1), dim=-1
+        )
+        log_beta_t = torch.where((t < seq_lengths - 1).unsqueeze(-1), log_step, torch.zeros_like(log_step))
+        log_betas.append(log_beta_t)
+    log_betas.reverse()
+    return _pad_steps(torch.stack(log_betas, dim=1), log_emiss_evidence.size(1))
+
+
+def viterbi_recursion(log_state_priors: torch.Tensor,
+                      log_trans: torch.Tensor,
+                      log_emiss_evidence: torch.Tensor,
+                      seq_lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Best paths (batch_size X max_seq_length, padded with 0 after each sequence length)
+    and their log probabilities (batch_size)
+    """
+    batch_size = log_emiss_evidence.size(0)
+    max_seq_length = int(seq_lengths.max().item())
+
+    log_delta_t = log_state_priors + log_emiss_evidence[:, 0, :]
+    log_deltas: List[torch.Tensor] = [log_delta_t]
+    # the most likely previous states; those of step 0 are undefined
+    pre_states: List[torch.Tensor] = [torch.zeros_like(log_delta_t, dtype=torch.long)]
+    for t in range(1, max_seq_length):
+        log_potentials = log_trans[:, t, :, :] + log_emiss_evidence[:, t, :].unsqueeze(1)
+        log_delta_t, pre_states_t = (log_delta_t.unsqueeze(-1) + log_potentials).max(dim=-2)
+        log_deltas.append(log_delta_t)
+        pre_states.append(pre_states_t)
+
+    # the terminal state of each instance is at its own last step
+    last_steps = seq_lengths - 1
+    batch_idx = torch.arange(batch_size, device=log_emiss_evidence.device)
+    max_log_probs, z_t_star = torch.stack(log_deltas, dim=1)[batch_idx, last_steps].max(dim=-1)
+
+    paths = torch.zeros([batch_size, max_seq_length], dtype=torch.long, device=log_emiss_evidence.device)
+    z_t = z_t_star
+    for t in range(max_seq_length - 1, -1, -1):
+        z_t = torch.where(last_steps == t, z_t_star, z_t)
+        paths[:, t] = z_t
+        if t > 0:
+            z_t = pre_states[t].gather(-1, z_t.unsqueeze(-1)).squeeze(-1)
+    paths.masked_fill_(torch.arange(max_seq_length, device=paths.device) > last_steps.unsqueeze(-1), 0)
+    return paths, max_log_probs
+
+
+@lru_cache(maxsize=None)
+def scripted_kernels():
+    """
+    The TorchScript versions of `forward_recursion`, `backward_recursion` and `viterbi_recursion`
+    """
+    return (
+        torch.jit.script(forward_recursion),
+        torch.jit.script(backward_recursion),
+        torch.jit.script(viterbi_recursion)
+    )
@@ -1,18 +1,83 @@
+import copy
 import logging
 import numpy as np
-from typing import Optional
+from typing import Optional, List
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from torch.func import stack_module_state, functional_call, vmap
 
 from seqlbtoolkit.data import label_to_span
 
 from .args import CHMMConfig
-from src.utils.math import log_matmul, log_maxmul, validate_prob, logsumexp
+from .jit_kernels import scripted_kernels
+from .annotator import bio_span_bounds
+from src.utils.math import (
+    log_matmul,
+    log_maxmul,
+    log_matmul_exp,
+    log_maxmul_chunked,
+    log_prefix_matmul,
+    validate_prob,
+    logsumexp,
+    substitute_obs_mask,
+    substitute_obs_prob
+)
 
 logger = logging.getLogger(__name__)
 
 
+def bio_transition_mask(label_types: List[str]):
+    """
+    Transitions allowed by the BIO scheme: I-X can only follow B-X or I-X.
+
+    Parameters
+    ----------
+    label_types: BIO label types
+
+    Returns
+    -------
+    allowed transitions (from X to, BoolTensor); allowed initial states (BoolTensor)
+    """
+    n_lbs = len(label_types)
+    allowed = torch.ones(n_lbs, n_lbs, dtype=torch.bool)
+    for j, label in enumerate(label_types):
+        if label.startswith('I-'):
+            allowed[:, j] = torch.tensor([lb in (f'B-{label[2:]}', label) for lb in label_types])
+    allowed_init = torch.tensor([not lb.startswith('I-') for lb in label_types])
+    return allowed, allowed_init
+
+
+def extract_bio_spans(paths: torch.Tensor, seq_lengths: torch.Tensor, label_types: List[str]):
+    """
+    Vectorized `label_to_span` over a batch of padded label index sequences.
+    A span starts at B-X and extends over the I-X that follow it; I- labels that do not continue a span are dropped.
+
+    Parameters
+    ----------
+    paths: label indices (batch_size X max_seq_length)
+    seq_lengths: sequence lengths
+    label_types: BIO label types
+
+    Returns
+    -------
+    sentence index, start and end (exclusive) of each span, and the index of its entity type in the order of the
+    B- labels in `label_types`. All are 1-D LongTensors sorted by sentence and start.
+    """
+    device = paths.device
+    entity_types = [lb[2:] for lb in label_types if lb.startswith('B-')]
+    return bio_span_bounds(
+        paths,
+        seq_lengths,
+        is_begin_label=torch.tensor([lb.startswith('B-') for lb in label_types], device=device),
+        is_inside_label=torch.tensor([lb.startswith('I-') for lb in label_types], device=device),
+        label_entity_ids=torch.tensor(
+            [entity_types.index(lb[2:]) if lb != 'O' else -1 for lb in label_types], device=device
+        )
+    )
+
+
 class NeuralModule(nn.Module):
     def __init__(self,
                  config: CHMMConfig):
@@ -22,24 +87,75 @@ class NeuralModule(nn.Module):
         self._d_hidden = config.d_hidden
         self._n_src = config.n_src
         self._d_obs = config.d_obs
+        self._n_basis = config.nn_n_basis
         self._use_neural_emiss = not config.no_neural_emiss
-        self._neural_transition = nn.Linear(self._d_emb, self._d_hidden * self._d_hidden)
-        if self._use_neural_emiss:
-            self._neural_emissions = nn.ModuleList([
-                nn.Linear(self._d_emb, self._d_hidden * self._d_obs) for _ in range(self._n_src)
-            ])
+
+        # the neural transition head only predicts the entries allowed by BIO
+        self._trans_allowed = None
+        if config.bio_constrained_trans:
+            self._trans_allowed, _ = bio_transition_mask(config.bio_label_types)
+            self._n_trans_outputs = int(self._trans_allowed.sum())
+        else:
+            self._n_trans_outputs = self._d_hidden * self._d_hidden
+
+        if self._n_basis > 0:
+            # token-dependent mixture weights over a shared basis of transition/emission matrices
+            self._neural_transition = nn.Linear(self._d_emb, self._n_basis)
+            self._transition_basis = nn.Parameter(torch.empty(self._n_basis, self._d_hidden, self._d_hidden))
+            if self._use_neural_emiss:
+                self._neural_emissions = nn.ModuleList([nn.Linear(self._d_emb, self._n_src * self._n_basis)])
+                self._emission_basis = nn.Parameter(
+                    torch.empty(self._n_src, self._n_basis, self._d_hidden, self._d_obs)
+                )
+            else:
+                self._neural_emissions = nn.ModuleList([])
         else:
-            self._neural_emissions = nn.ModuleList([])
+            self._neural_transition = nn.Linear(self._d_emb, self._n_trans_outputs)
+            if self._use_neural_emiss:
+                self._neural_emissions = nn.ModuleList([
+                    nn.Linear(self._d_emb, self._d_hidden * self._d_obs) for _ in range(self._n_src)
+                ])
+            else:
+                self._neural_emissions = nn.ModuleList([])
 
         self._init_parameters()
 
+    @property
+    def is_factorized(self):
+        return self._n_basis > 0
+
     def forward(self,
                 embs: torch.Tensor,
                 temperature: Optional[int] = 1.0):
+        """
+        Predict the neural transition and emission probabilities
+
+        Parameters
+        ----------
+        embs: token embeddings
+        temperature: softmax temperature
+
+        Returns
+        -------
+        transitions (batch_size X max_seq_length X d_hidden X d_hidden);
+        emissions (batch_size X max_seq_length X n_src X d_hidden X d_obs), or None if not used.
+        With the factorized heads, the emissions are returned as a tuple of the mixture weights
+        (batch_size X max_seq_length X n_src X n_basis) and the basis (n_src X n_basis X d_hidden X d_obs),
+        see `compose_emissions`.
+        """
+        if self.is_factorized:
+            return self._factorized_forward(embs, temperature)
+
         batch_size, max_seq_length, _ = embs.size()
-        trans_temp = self._neural_transition(embs).view(
-            batch_size, max_seq_length, self._d_hidden, self._d_hidden
-        )
+        if self._trans_allowed is not None:
+            # the disallowed transitions get exactly zero probability
+            trans_temp = torch.full(
+                [batch_size, max_seq_length, self._d_hidden, self._d_hidden], -float('inf'), device=embs.device
+            ).masked_scatter(self._trans_allowed.to(embs.device), self._neural_transition(embs))
+        else:
+            trans_temp = self._neural_transition(embs).view(
+                batch_size, max_seq_length, self._d_hidden, self._d_hidden
+            )
         nn_trans = torch.softmax(trans_temp / temperature, dim=-1)
 
         if self._use_neural_emiss:
@@ -50,10 +166,173 @@ class NeuralModule(nn.Module):
             nn_emiss = None
         return nn_trans, nn_emiss
 
+    def _factorized_forward(self, embs, temperature):
+        batch_size, max_seq_length, _ = embs.size()
+        # a convex combination of row-stochastic matrices is row-stochastic
+        trans_weights = torch.softmax(self._neural_transition(embs) / temperature, dim=-1)
+        trans_basis = self._transition_basis
+        if self._trans_allowed is not None:
+            trans_basis = trans_basis.masked_fill(~self._trans_allowed.to(embs.device), -float('inf'))
+        trans_basis = torch.softmax(trans_basis / temperature, dim=-1)
+        nn_trans = torch.einsum('btk,kij->btij', trans_weights, trans_basis)
+
+        if self._use_neural_emiss:
+            emiss_weights = torch.softmax(self._neural_emissions[0](embs).view(
+                batch_size, max_seq_length, self._n_src, self._n_basis
+            ) / temperature, dim=-1)
+            emiss_basis = torch.softmax(self._emission_basis / temperature, dim=-1)
+            nn_emiss = (emiss_weights, emiss_basis)
+        else:
+            nn_emiss = None
+        return nn_trans, nn_emiss
+
+    @staticmethod
+    def compose_emissions(nn_emiss):
+        """
+        Materialize the (batch_size X max_seq_length X n_src X d_hidden X d_obs) emission probabilities
+        from the factorized emissions. Dense emissions are returned unchanged.
+        """
+        if not isinstance(nn_emiss, tuple):
+            return nn_emiss
+        emiss_weights, emiss_basis = nn_emiss
+        return torch.einsum('btsk,skho->btsho', emiss_weights, emiss_basis)
+
+    @staticmethod
+    def factorized_emissions_mse(nn_emiss, target, mask):
+        """
+        Mean squared error between the factorized emissions and a fixed emission matrix, equivalent to
+        `F.mse_loss(mask * compose_emissions(nn_emiss), mask * target)` without composing the emissions.
+
+        Parameters
+        ----------
+        nn_emiss: factorized emissions
+        target: target emission probabilities (n_src X d_hidden X d_obs)
+        mask: valid steps (batch_size X max_seq_length)
+
+        Returns
+        -------
+        the mean squared error
+        """
+        emiss_weights, emiss_basis = nn_emiss
+        batch_size, max_seq_length, n_src, n_basis = emiss_weights.size()
+        flat_basis = emiss_basis.reshape(n_src, n_basis, -1)
+        flat_target = target.reshape(n_src, -1)
+
+        # ||sum_k w_k B_k - E||^2 = w^T G w - 2 w^T c + ||E||^2
+        gram = flat_basis @ flat_basis.transpose(-1, -2)
+        cross = (flat_basis @ flat_target.unsqueeze(-1)).squeeze(-1)
+        sq_err = torch.einsum('btsk,skl,btsl->bts', emiss_weights, gram, emiss_weights) \
+            - 2 * torch.einsum('btsk,sk->bts', emiss_weights, cross) \
+            + (flat_target ** 2).sum(dim=-1)
+        return (sq_err * mask.unsqueeze(-1)).sum() / (batch_size * max_seq_length * flat_target.numel())
+
     def _init_parameters(self):
         nn.init.xavier_uniform_(self._neural_transition.weight.data, gain=nn.init.calculate_gain('relu'))
         for emiss in self._neural_emissions:
             nn.init.xavier_uniform_(emiss.weight.data, gain=nn.init.calculate_gain('relu'))
+        if self.is_factorized:
+            nn.init.xavier_uniform_(self._transition_basis.data)
+            if self._use_neural_emiss:
+                nn.init.xavier_uniform_(self._emission_basis.data)
+
+
+class NeuralModuleReplicas(nn.Module):
+    """
+    Independently initialized replicas of `NeuralModule`, with their parameters stacked along a leading
+    dimension and evaluated together with `torch.func.vmap`.
+    """
+
+    def __init__(self,
+                 config: CHMMConfig):
+        super(NeuralModuleReplicas, self).__init__()
+        assert config.nn_n_basis == 0, ValueError("The factorized neural heads do not support replicas")
+
+        replicas = [NeuralModule(config) for _ in range(config.num_restarts)]
+        stacked_params, _ = stack_module_state(replicas)
+        # `ParameterDict` keys can not contain '.'
+        self._stacked_params = nn.ParameterDict({
+            name.replace('.', '__'): nn.Parameter(param.detach()) for name, param in stacked_params.items()
+        })
+        # parameter-free structure of a replica; kept in a tuple so that it is not registered as a submodule
+        self._template = (copy.deepcopy(replicas[0]).to('meta'),)
+        self._use_neural_emiss = not config.no_neural_emiss
+
+    @property
+    def is_factorized(self):
+        return False
+
+    def forward(self,
+                embs: torch.Tensor,
+                temperature: Optional[int] = 1.0):
+        """
+        Predict the neural transition and emission probabilities of all replicas from the same embeddings
+
+        Returns
+        -------
+        the outputs of `NeuralModule` with the replicas concatenated along the batch dimension,
+        i.e., instance b of replica k is at k * batch_size + b
+        """
+        params = {name.replace('__', '.'): param for name, param in self._stacked_params.items()}
+
+        def replica_forward(replica_params, x):
+            nn_trans, nn_emiss = functional_call(self._template[0], replica_params, (x, temperature))
+            return (nn_trans, nn_emiss) if self._use_neural_emiss else nn_trans
+
+        outputs = vmap(replica_forward, in_dims=(0, None))(params, embs)
+        if self._use_neural_emiss:
+            return outputs[0].flatten(0, 1), outputs[1].flatten(0, 1)
+        return outputs.flatten(0, 1), None
+
+    def replica_state_dict(self, replica_idx: int):
+        """
+        The state dict of one replica, loadable into `NeuralModule`
+        """
+        return {name.replace('__', '.'): param.detach()[replica_idx] for name, param in self._stacked_params.items()}
+
+
+class PosteriorGradLikelihood(torch.autograd.Function):
+    """
+    The expected complete log-likelihood of CHMM, with a backward pass that uses the posteriors directly.
+
+    With the posteriors held fixed, the gradients of the expected complete log-likelihood w.r.t. the log state
+    priors, transitions and emission evidence are gamma_0, xi_t and gamma_t, which are also the gradients of the
+    log-partition log p(x). Hence the forward-backward recursion runs without autograd, and only alpha and beta
+    are kept for the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, chmm, log_state_priors, log_trans, log_emiss_evidence, seq_lengths):
+        # autograd is disabled in here; `chmm` holds the same tensors as the inputs
+        chmm._forward_backward(seq_lengths)
+        log_likelihood = chmm._expected_complete_log_likelihood(seq_lengths)
+
+        ctx.save_for_backward(log_trans, log_emiss_evidence, chmm._log_alpha, chmm._log_beta, seq_lengths)
+        ctx.per_instance_priors = log_state_priors.dim() > 1
+        return log_likelihood
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        log_trans, log_emiss_evidence, log_alpha, log_beta, seq_lengths = ctx.saved_tensors
+        batch_size, max_seq_length, n_hidden = log_alpha.size()
+        valid_mask = torch.arange(max_seq_length, device=seq_lengths.device) < seq_lengths.unsqueeze(-1)
+        # every term of the log-likelihood is averaged over the batch (of each replica)
+        replica_batch_size = batch_size // grad_output.numel()
+        scale = (grad_output.view(-1) / replica_batch_size).repeat_interleave(replica_batch_size).view(-1, 1, 1)
+
+        log_gamma = log_alpha + log_beta
+        gamma = torch.exp(log_gamma - log_gamma.logsumexp(dim=-1, keepdim=True)) * valid_mask.unsqueeze(-1)
+
+        log_xi = log_alpha[:, :-1, :].unsqueeze(-1) + log_trans[:, 1:, :, :] + \
+            (log_emiss_evidence + log_beta)[:, 1:, :].unsqueeze(-2)
+        log_xi = log_xi - logsumexp(log_xi.view(batch_size, max_seq_length - 1, -1), dim=-1)\
+            .view(batch_size, max_seq_length - 1, 1, 1)
+        grad_trans = torch.zeros_like(log_trans)
+        grad_trans[:, 1:, :, :] = torch.exp(log_xi) * valid_mask[:, 1:, None, None] * scale.unsqueeze(-1)
+
+        grad_priors = gamma[:, 0, :] * scale.squeeze(-1)
+        if not ctx.per_instance_priors:
+            grad_priors = grad_priors.sum(dim=0)
+        return None, grad_priors, grad_trans, gamma * scale, None
 
 
 class CHMM(nn.Module):
@@ -69,13 +348,44 @@ class CHMM(nn.Module):
         self._d_obs = config.d_obs  # number of possible obs_set
         self._n_hidden = config.d_hidden  # number of states
 
+        self._n_replicas = config.num_restarts
+        assert self._n_replicas >= 1, ValueError(f"Invalid number of replicas: {self._n_replicas}")
+
         self._trans_weight = config.trans_nn_weight
         self._emiss_weight = config.emiss_nn_weight
         self._use_neural_emiss = not config.no_neural_emiss
 
+        self._fb_mode = config.fb_mode
+        assert self._fb_mode in ['loop', 'scan', 'packed'], ValueError(f"Unknown forward-backward mode: {self._fb_mode}")
+        self._xi_mode = config.xi_mode
+        self._fb_posterior_grad = config.fb_posterior_grad
+        assert self._xi_mode in ['loop', 'vectorized', 'streaming'], ValueError(f"Unknown xi mode: {self._xi_mode}")
+        assert config.semiring_kernel in ['broadcast', 'matmul'], \
+            ValueError(f"Unknown semiring kernel: {config.semiring_kernel}")
+        if config.semiring_kernel == 'matmul':
+            self._log_matmul, self._log_maxmul = log_matmul_exp, log_maxmul_chunked
+        else:
+            self._log_matmul, self._log_maxmul = log_matmul, log_maxmul
+        self._dp_backend = config.dp_backend
+        assert self._dp_backend in ['torch', 'jit'], \
+            ValueError(f"Unknown dynamic programming backend: {self._dp_backend}")
+        assert not (self._dp_backend == 'jit' and self._fb_mode == 'scan'), \
+            ValueError("The `jit` backend steps through time and does not work with the `scan` forward-backward mode")
+
         self._device = config.device
+        assert config.nn_quantization in ['none', 'dynamic'], \
+            ValueError(f"Unknown quantization mode: {config.nn_quantization}")
+        assert not (config.nn_quantization == 'dynamic' and self._device.type != 'cpu'), \
+            ValueError("Dynamic int8 quantization only runs on CPU")
+
+        self._bio_constrained = config.bio_constrained_trans
+        self.set_beam(config.fb_beam_size, config.fb_beam_threshold)
+
+        self._trans_allowed = self._init_allowed = None
+        if self._bio_constrained:
+            self._init_bio_blocks(config.bio_label_types)
 
-        self._nn_module = NeuralModule(config)
+        self._nn_module = NeuralModuleReplicas(config) if self._n_replicas > 1 else NeuralModule(config)
 
         # initialize unnormalized state-prior, transition and emission matrices
         self._initialize_model(
@@ -87,6 +397,170 @@ class CHMM(nn.Module):
     def neural_module(self):
         return self._nn_module
 
+    @property
+    def n_replicas(self):
+        return self._n_replicas
+
+    def replica_state_dict(self, replica_idx: int):
+        """
+        The state dict of one replica, loadable into a CHMM without replicas (`num_restarts` = 1)
+        """
+        state_dict = {name: getattr(self, name).detach()[replica_idx]
+                      for name in ['state_priors', 'unnormalized_trans', 'unnormalized_emiss']}
+        state_dict.update({
+            f'_nn_module.{name}': param for name, param in self._nn_module.replica_state_dict(replica_idx).items()
+        })
+        return state_dict
+
+    def quantized(self):
+        """
+        A copy of the model for CPU inference whose neural heads (`nn.Linear`) are dynamically quantized to int8:
+        the weights are stored in int8 and the activations are quantized on the fly for each batch.
+        The HMM parameters and the inference stay in float32.
+        """
+        assert self._device.type == 'cpu', ValueError("Dynamic int8 quantization only runs on CPU")
+        assert self._n_replicas == 1, ValueError("The neural heads of CHMM replicas are not quantizable")
+        # the inference states of the last batch are part of an autograd graph and are not copied
+        memo = {id(v): None for v in vars(self).values() if isinstance(v, torch.Tensor) and v.grad_fn is not None}
+        return torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(self, memo), {nn.Linear}, dtype=torch.qint8
+        ).eval()
+
+    def _replicate_lengths(self, seq_lengths):
+        # the replicas are concatenated along the batch dimension, see `NeuralModuleReplicas`
+        return seq_lengths.repeat(self._n_replicas) if self._n_replicas > 1 else seq_lengths
+
+    def _mix_nn_probs(self, probs, nn_probs, nn_weight):
+        """
+        (1 - nn_weight) * probs + nn_weight * nn_probs, where the HMM probabilities `probs` of the k-th replica
+        (leading dimension) are mixed with the k-th block of the neural probabilities of the batch
+        """
+        if self._n_replicas == 1:
+            return (1 - nn_weight) * probs + nn_weight * nn_probs
+        nn_probs = nn_probs.view(self._n_replicas, -1, *nn_probs.shape[1:])
+        probs = probs.view(self._n_replicas, 1, 1, *probs.shape[1:])
+        return ((1 - nn_weight) * probs + nn_weight * nn_probs).flatten(0, 1)
+
+    def _replica_mean(self, x):
+        """
+        Average the instance values over the batch, separately for each replica
+        """
+        return x.view(self._n_replicas, -1).mean(dim=-1) if self._n_replicas > 1 else x.mean()
+
+    def set_beam(self, beam_size: Optional[int] = 0, threshold: Optional[float] = 0.0):
+        """
+        Set up beam-pruned inference. At each step, only the `beam_size` most probable states under the filtered
+        posterior p(z_t | obs_{1:t}), and among them only those with probability >= `threshold`, are kept.
+        The most probable state is always kept.
+
+        Parameters
+        ----------
+        beam_size: number of states kept at each step. 0 keeps all states (subject to `threshold`)
+        threshold: minimum filtered posterior probability of the kept states. 0 disables the threshold
+
+        Returns
+        -------
+        self
+        """
+        assert beam_size >= 0 and 0 <= threshold < 1, ValueError(f"Invalid beam: {beam_size}, {threshold}")
+        if threshold > 0 and beam_size == 0:
+            beam_size = self._n_hidden
+        self._beam_size = min(beam_size, self._n_hidden)
+        self._log_beam_threshold = np.log(threshold) if threshold > 0 else -float('inf')
+        return self
+
+    @property
+    def is_beam_pruned(self):
+        return self._beam_size > 0
+
+    def _prune_beam(self, log_scores):
+        """
+        Select the beam of each instance from the log scores (batch_size X n_hidden).
+        The threshold applies to the scores normalized over the states.
+
+        Returns
+        -------
+        beam states (batch_size X beam_size, LongTensor), beam scores with the states below the threshold set to
+        -inf (batch_size X beam_size), full-size scores with all pruned states set to -inf (batch_size X n_hidden)
+        """
+        beam_scores, beam_states = log_scores.topk(self._beam_size, dim=-1)
+        below_threshold = beam_scores - log_scores.logsumexp(dim=-1, keepdim=True) < self._log_beam_threshold
+        below_threshold[:, 0] = False
+        beam_scores = beam_scores.masked_fill(below_threshold, -float('inf'))
+        pruned_scores = torch.full_like(log_scores, -float('inf')).scatter(-1, beam_states, beam_scores)
+        return beam_states, beam_scores, pruned_scores
+
+    def _init_bio_blocks(self, label_types):
+        """
+        Index the blocks of the BIO-constrained transition matrix. `O` and `B-X` (the "open" states) can be reached
+        from any state, while `I-X` can only be reached from `B-X` and `I-X`.
+        """
+        self._trans_allowed, self._init_allowed = (m.to(self._device) for m in bio_transition_mask(label_types))
+        is_open = torch.tensor([not lb.startswith('I-') for lb in label_types])
+        self._open_states = torch.nonzero(is_open).squeeze(-1).to(self._device)
+        self._cont_states = torch.nonzero(~is_open).squeeze(-1).to(self._device)
+        # the two possible previous states of each I-X
+        self._cont_sources = torch.tensor([
+            [label_types.index(f'B-{label_types[j][2:]}'), j] for j in self._cont_states.tolist()
+        ], dtype=torch.long, device=self._device).view(-1, 2)
+        # the I-X that each state can continue into; `O` has none
+        self._cont_targets = torch.tensor([
+            label_types.index(f'I-{lb[2:]}') if lb != 'O' else 0 for lb in label_types
+        ], dtype=torch.long, device=self._device)
+        self._has_cont_target = torch.tensor([lb != 'O' for lb in label_types], device=self._device)
+        # puts the [open, cont] blocks back in the state order
+        self._block_order = torch.argsort(torch.cat([self._open_states, self._cont_states]))
+        return self
+
+    def _bio_forward_transition(self, log_alpha, log_trans):
+        """
+        logsumexp_i log_alpha_i + log_trans_{i,j} over the allowed (i, j) only.
+
+        log_alpha: batch_size X n_hidden; log_trans: batch_size X n_hidden X n_hidden
+        """
+        to_open = self._log_matmul(log_alpha.unsqueeze(1), log_trans[:, :, self._open_states]).squeeze(1)
+        to_cont = (
+            log_alpha[:, self._cont_sources] + log_trans[:, self._cont_sources, self._cont_states.unsqueeze(-1)]
+        ).logsumexp(dim=-1)
+        return torch.cat([to_open, to_cont], dim=-1)[:, self._block_order]
+
+    def _bio_backward_transition(self, log_trans, log_next):
+        """
+        logsumexp_j log_trans_{i,j} + log_next_j over the allowed (i, j) only.
+
+        log_trans: batch_size X n_hidden X n_hidden; log_next: batch_size X n_hidden
+        """
+        from_open = self._log_matmul(
+            log_trans[:, :, self._open_states], log_next[:, self._open_states].unsqueeze(-1)
+        ).squeeze(-1)
+        from_cont = log_trans.gather(-1, self._cont_targets.expand(len(log_trans), -1).unsqueeze(-1)).squeeze(-1) + \
+            log_next[:, self._cont_targets]
+        from_cont = from_cont.masked_fill(~self._has_cont_target, -float('inf'))
+        return torch.logaddexp(from_open, from_cont)
+
+    def _bio_max_transition(self, log_delta, log_potentials):
+        """
+        max_i log_delta_i + log_potentials_{i,j} and the argmax, over the allowed (i, j) only.
+
+        log_delta: batch_size X n_hidden; log_potentials: batch_size X n_hidden X n_hidden
+        """
+        open_max, open_argmax = self._log_maxmul(log_delta.unsqueeze(1), log_potentials[:, :, self._open_states])
+        cont_max, cont_argmax = (
+            log_delta[:, self._cont_sources] +
+            log_potentials[:, self._cont_sources, self._cont_states.unsqueeze(-1)]
+        ).max(dim=-1)
+        cont_argmax = self._cont_sources.expand(len(log_delta), -1, -1).gather(-1, cont_argmax.unsqueeze(-1))
+        max_val = torch.cat([open_max.squeeze(1), cont_max], dim=-1)[:, self._block_order]
+        argmax_val = torch.cat([open_argmax.squeeze(1), cont_argmax.squeeze(-1)], dim=-1)[:, self._block_order]
+        return max_val, argmax_val
+
+    def _masked_log_probs(self, log_probs, allowed):
+        """
+        Set the log probabilities of the disallowed entries to 0 so that they vanish from the
+        expected log-likelihood terms instead of producing 0 * -inf.
+        """
+        return log_probs.masked_fill(~allowed, 0) if self._bio_constrained else log_probs
+
     @property
     def log_trans(self):
         try:
@@ -123,32 +597,41 @@ class CHMM(nn.Module):
 
         logger.info('Initializing CHMM...')
 
+        # with replicas, every parameter has a leading replica dimension.
+        # A shared initial matrix is copied to all replicas, and each replica can also be given its own
+        replica_shape = [self._n_replicas] if self._n_replicas > 1 else []
+
+        def stack_replicas(x, n_dims):
+            return x.expand(*replica_shape, *x.shape[-n_dims:]).clone()
+
         if state_prior is None:
             priors = torch.zeros(self._n_hidden, device=self._device) + 1E-3
             priors[0] = 1
-            self.state_priors = nn.Parameter(torch.log(priors))
+            self.state_priors = nn.Parameter(stack_replicas(torch.log(priors), 1))
         else:
             state_prior.to(self._device)
-            priors = validate_prob(state_prior, dim=0)
-            self.state_priors = nn.Parameter(torch.log(priors))
+            priors = validate_prob(state_prior, dim=-1)
+            self.state_priors = nn.Parameter(stack_replicas(torch.log(priors), 1))
 
         if trans_matrix is None:
-            self.unnormalized_trans = nn.Parameter(torch.randn(self._n_hidden, self._n_hidden, device=self._device))
+            self.unnormalized_trans = nn.Parameter(
+                torch.randn(*replica_shape, self._n_hidden, self._n_hidden, device=self._device)
+            )
         else:
             trans_matrix.to(self._device)
             trans_matrix = validate_prob(trans_matrix)
             # We may want to use softmax later, so we put here a log to counteract the effact
-            self.unnormalized_trans = nn.Parameter(torch.log(trans_matrix))
+            self.unnormalized_trans = nn.Parameter(stack_replicas(torch.log(trans_matrix), 2))
 
         if emiss_matrix is None:
             self.unnormalized_emiss = nn.Parameter(
-                torch.zeros(self._n_src, self._n_hidden, self._d_obs, device=self._device)
+                torch.zeros(*replica_shape, self._n_src, self._n_hidden, self._d_obs, device=self._device)
             )
         else:
             emiss_matrix.to(self._device)
             emiss_matrix = validate_prob(emiss_matrix)
             # We may want to use softmax later, so we put here a log to counteract the effact
-            self.unnormalized_emiss = nn.Parameter(torch.log(emiss_matrix))
+            self.unnormalized_emiss = nn.Parameter(stack_replicas(torch.log(emiss_matrix), 3))
 
         logger.info("CHMM initialized!")
 
@@ -165,7 +648,8 @@ class CHMM(nn.Module):
         Parameters
         ----------
         embs: token embeddings
-        obs: observations
+        obs: observations, either dense (batch_size X max_seq_length X n_src X d_obs, float)
+             or label indices (batch_size X max_seq_length X n_src, integer)
         temperature: softmax temperature
         normalize_observation: whether to normalize observations
 
@@ -174,92 +658,418 @@ class CHMM(nn.Module):
         self
         """
         # normalize and put the probabilities into the log domain
-        batch_size, max_seq_length, n_src, _ = obs.size()
-        self._log_state_priors = torch.log_softmax(self.state_priors / temperature, dim=-1)
-        trans = torch.softmax(self.unnormalized_trans / temperature, dim=-1)
+        batch_size, max_seq_length, n_src = obs.shape[:3]
+        if self._bio_constrained:
+            self._log_state_priors = torch.log_softmax(
+                self.state_priors.masked_fill(~self._init_allowed, -float('inf')) / temperature, dim=-1
+            )
+            trans = torch.softmax(
+                self.unnormalized_trans.masked_fill(~self._trans_allowed, -float('inf')) / temperature, dim=-1
+            )
+        else:
+            self._log_state_priors = torch.log_softmax(self.state_priors / temperature, dim=-1)
+            trans = torch.softmax(self.unnormalized_trans / temperature, dim=-1)
         emiss = torch.softmax(self.unnormalized_emiss / temperature, dim=-1)
 
         # get neural transition and emission matrices
         nn_trans, nn_emiss = self._nn_module(embs)
 
-        self._log_trans = torch.log((1 - self._trans_weight) * trans + self._trans_weight * nn_trans)
-        if nn_emiss is not None:
-            self._log_emiss = torch.log((1 - self._emiss_weight) * emiss + self._emiss_weight * nn_emiss)
+        if self._n_replicas > 1:
+            # all replicas see the same batch; instance b of replica k is at k * batch_size + b
+            obs = obs.repeat(self._n_replicas, *[1] * (obs.dim() - 1))
+            self._log_state_priors = self._log_state_priors.repeat_interleave(batch_size, dim=0)
+            if nn_emiss is None:
+                emiss = emiss.view(self._n_replicas, 1, 1, *emiss.shape[1:])\
+                    .expand(-1, batch_size, -1, -1, -1, -1).flatten(0, 1)
+            batch_size *= self._n_replicas
+
+        trans = self._mix_nn_probs(trans, nn_trans, self._trans_weight)
+        if self._bio_constrained:
+            # keep log(0) out of the graph; its gradient would be NaN
+            self._log_trans = torch.log(torch.where(self._trans_allowed, trans, torch.ones_like(trans)))\
+                .masked_fill(~self._trans_allowed, -float('inf'))
         else:
-            self._log_emiss = torch.log(emiss)
+            self._log_trans = torch.log(trans)
+        if isinstance(nn_emiss, tuple):
+            # factorized neural emissions; the emission matrices of each token are never materialized
+            self._log_emiss = None
+            self._log_emiss_evidence = self._factorized_emiss_evidence(emiss, nn_emiss, obs, normalize_observation)
+        else:
+            if nn_emiss is not None:
+                self._log_emiss = torch.log(self._mix_nn_probs(emiss, nn_emiss, self._emiss_weight))
+            else:
+                self._log_emiss = torch.log(emiss)
+
+            if obs.is_floating_point():
+                self._log_emiss_evidence = self._dense_emiss_evidence(obs, normalize_observation)
+            else:
+                self._log_emiss_evidence = self._index_emiss_evidence(obs, normalize_observation)
 
+        self._log_alpha = torch.zeros([batch_size, max_seq_length, self._n_hidden], device=self._device)
+        self._log_beta = torch.zeros([batch_size, max_seq_length, self._n_hidden], device=self._device)
+        # Gamma can be readily computed and need no initialization
+        self._log_gamma = None
+        # only values in 1:max_seq_length are valid. The first state is a dummy.
+        # The other xi modes never hold the whole tensor
+        if self._xi_mode == 'loop':
+            self._log_xi = torch.zeros(
+                [batch_size, max_seq_length, self._n_hidden, self._n_hidden], device=self._device
+            )
+        else:
+            self._log_xi = None
+        return self
+
+    def _dense_emiss_evidence(self, obs, normalize_observation):
         if normalize_observation:
-            lbs = obs.argmax(dim=-1)
-            # at least one source observes an entity
-            entity_idx = lbs.sum(dim=-1) > 1E-6
-            # the sources that do not observe any entity
-            no_entity_idx = lbs <= 1E-6
-            no_obs_src_idx = entity_idx.unsqueeze(-1) * no_entity_idx
-            subsitute_prob = torch.zeros_like(obs[0, 0, 0])
-            subsitute_prob[0] = 0.01
-            subsitute_prob[1:] = 0.99 / self._d_obs
-            obs[no_obs_src_idx] = subsitute_prob
+            # do not modify the input batch
+            no_obs_src_idx = substitute_obs_mask(obs.argmax(dim=-1))
+            obs = torch.where(
+                no_obs_src_idx.unsqueeze(-1), substitute_obs_prob(self._d_obs, device=obs.device).to(obs.dtype), obs
+            )
 
         # Calculate the emission probabilities in one time, so that we don't have to compute this repeatedly
         # log-domain subtract is regular-domain divide
-        self._log_emiss_evidence = log_matmul(
+        return self._log_matmul(
             self._log_emiss, torch.log(obs).unsqueeze(-1)
         ).squeeze(-1).sum(dim=-2)
 
-        self._log_alpha = torch.zeros([batch_size, max_seq_length, self._n_hidden], device=self._device)
-        self._log_beta = torch.zeros([batch_size, max_seq_length, self._n_hidden], device=self._device)
-        # Gamma can be readily computed and need no initialization
-        self._log_gamma = None
-        # only values in 1:max_seq_length are valid. The first state is a dummy
-        self._log_xi = torch.zeros([batch_size, max_seq_length, self._n_hidden, self._n_hidden], device=self._device)
-        return self
+    def _index_emiss_evidence(self, obs, normalize_observation):
+        """
+        Emission evidence of the observations stored as label indices: log p(obs_s | z) is read out of the
+        emission matrices directly instead of being computed with a log-domain product over all labels.
+
+        The index `d_obs` marks the observations already substituted by `CHMMBaseDataset.prepare_obs`.
+        """
+        obs = obs.long()
+        batch_size, max_seq_length, n_src = obs.shape
+        # broadcast the HMM emission (n_src X n_hidden X d_obs) without copying
+        log_emiss = self._log_emiss.expand(batch_size, max_seq_length, n_src, self._n_hidden, self._d_obs)
+        log_emiss_evidence = log_emiss.gather(
+            -1, obs.clamp(max=self._d_obs - 1).view(batch_size, max_seq_length, n_src, 1, 1)
+            .expand(-1, -1, -1, self._n_hidden, 1)
+        ).squeeze(-1)
+
+        no_obs_src_idx = obs == self._d_obs
+        if normalize_observation:
+            no_obs_src_idx |= substitute_obs_mask(obs)
+        # the substituted observations are not one-hot and need the full product, but only at those steps
+        substitute_evidence = logsumexp(
+            log_emiss[no_obs_src_idx] + torch.log(substitute_obs_prob(self._d_obs, device=obs.device)), dim=-1
+        )
+        log_emiss_evidence = log_emiss_evidence.index_put((no_obs_src_idx,), substitute_evidence)
 
-    def _forward_step(self, t):
+        return log_emiss_evidence.sum(dim=-2)
+
+    def _factorized_emiss_evidence(self, emiss, nn_emiss, obs, normalize_observation):
+        """
+        Emission evidence with the factorized neural emissions.
+
+        The emission probabilities are linear in the mixture weights, so the observations are evaluated against
+        each basis matrix first (n_basis values per token, source and state) and then mixed, instead of composing
+        the (d_hidden X d_obs) emission matrix of every token and source.
+        """
+        emiss_weights, emiss_basis = nn_emiss
+        if obs.is_floating_point():
+            if normalize_observation:
+                no_obs_src_idx = substitute_obs_mask(obs.argmax(dim=-1))
+                obs = torch.where(
+                    no_obs_src_idx.unsqueeze(-1), substitute_obs_prob(self._d_obs, device=obs.device).to(obs.dtype),
+                    obs
+                )
+            hmm_probs = torch.einsum('sho,btso->btsh', emiss, obs)
+            basis_probs = torch.einsum('skho,btso->btskh', emiss_basis, obs)
+        else:
+            # see `_index_emiss_evidence`
+            obs = obs.long()
+            no_obs_src_idx = obs == self._d_obs
+            if normalize_observation:
+                no_obs_src_idx |= substitute_obs_mask(obs)
+            obs = obs.clamp(max=self._d_obs - 1)
+            src_idx = torch.arange(self._n_src, device=obs.device)
+            subsitute_prob = substitute_obs_prob(self._d_obs, device=obs.device)
+
+            hmm_probs = torch.where(
+                no_obs_src_idx.unsqueeze(-1), emiss @ subsitute_prob, emiss.permute(0, 2, 1)[src_idx, obs]
+            )
+            basis_probs = torch.where(
+                no_obs_src_idx.view(*no_obs_src_idx.shape, 1, 1),
+                emiss_basis @ subsitute_prob,
+                emiss_basis.permute(0, 3, 1, 2)[src_idx, obs]
+            )
+
+        nn_probs = torch.einsum('btsk,btskh->btsh', emiss_weights, basis_probs)
+        return torch.log((1 - self._emiss_weight) * hmm_probs + self._emiss_weight * nn_probs).sum(dim=-2)
+
+    def _forward_step(self, t, rows=slice(None)):
         # initial alpha state
         if t == 0:
-            log_alpha_t = self._log_state_priors + self._log_emiss_evidence[:, t, :]
+            # the priors are per instance with replicas
+            log_state_priors = self._log_state_priors if self._n_replicas == 1 else self._log_state_priors[rows]
+            log_alpha_t = log_state_priors + self._log_emiss_evidence[rows, t, :]
         # do the forward step
+        elif self._bio_constrained:
+            log_alpha_t = self._log_emiss_evidence[rows, t, :] + self._bio_forward_transition(
+                self._log_alpha[rows, t - 1, :], self._log_trans[rows, t, :, :]
+            )
         else:
-            log_alpha_t = self._log_emiss_evidence[:, t, :] + \
-                          log_matmul(self._log_alpha[:, t - 1, :].unsqueeze(1), self._log_trans[:, t, :, :]).squeeze(1)
+            log_alpha_t = self._log_emiss_evidence[rows, t, :] + self._log_matmul(
+                self._log_alpha[rows, t - 1, :].unsqueeze(1), self._log_trans[rows, t, :, :]
+            ).squeeze(1)
 
         # normalize the result
         normalized_log_alpha_t = log_alpha_t - log_alpha_t.logsumexp(dim=-1, keepdim=True)
         return normalized_log_alpha_t
 
-    def _backward_step(self, t):
+    def _backward_step(self, t, rows=slice(None)):
         # do the backward step
         # beta is not a distribution, so we do not need to normalize it
-        log_beta_t = log_matmul(
-            self._log_trans[:, t, :, :],
-            (self._log_emiss_evidence[:, t, :] + self._log_beta[:, t + 1, :]).unsqueeze(-1)
+        if self._bio_constrained:
+            return self._bio_backward_transition(
+                self._log_trans[rows, t + 1, :, :],
+                self._log_emiss_evidence[rows, t + 1, :] + self._log_beta[rows, t + 1, :]
+            )
+        log_beta_t = self._log_matmul(
+            self._log_trans[rows, t + 1, :, :],
+            (self._log_emiss_evidence[rows, t + 1, :] + self._log_beta[rows, t + 1, :]).unsqueeze(-1)
         ).squeeze(-1)
         return log_beta_t
 
+    @property
+    def _use_jit_kernels(self):
+        return self._dp_backend == 'jit' and not self.is_beam_pruned
+
     def _forward_backward(self, seq_lengths):
+        if self.is_beam_pruned:
+            return self._forward_backward_beam(seq_lengths)
+        elif self._use_jit_kernels:
+            return self._forward_backward_jit(seq_lengths)
+        elif self._fb_mode == 'scan':
+            return self._forward_backward_scan(seq_lengths)
+        elif self._fb_mode == 'packed':
+            return self._forward_backward_packed(seq_lengths)
+
         max_seq_length = seq_lengths.max().item()
         # calculate log alpha
         for t in range(0, max_seq_length):
             self._log_alpha[:, t, :] = self._forward_step(t)
 
         # calculate log beta
-        # The last beta state beta[:, -1, :] = log1 = 0, so no need to re-assign the value
+        # beta stays log1 = 0 from the last step of each instance on, so that beta is aligned with the sequence ends
+        for t in range(max_seq_length - 2, -1, -1):
+            self._log_beta[:, t, :] = torch.where(
+                (t < seq_lengths - 1).unsqueeze(-1), self._backward_step(t), 0.0
+            )
+        return None
+
+    def _forward_backward_jit(self, seq_lengths):
+        """
+        Same as the `loop` mode, with the time loops inside the TorchScript kernels of `jit_kernels`.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        None
+        """
+        forward_recursion, backward_recursion, _ = scripted_kernels()
+        max_seq_length = seq_lengths.max().item()
+        self._log_alpha = forward_recursion(
+            self._log_state_priors, self._log_trans, self._log_emiss_evidence, max_seq_length
+        )
+        self._log_beta = backward_recursion(self._log_trans, self._log_emiss_evidence, seq_lengths, max_seq_length)
+        return None
+
+    def _forward_backward_packed(self, seq_lengths):
+        """
+        Forward-backward that only updates the instances still running at each time step.
+        Similar to `PackedSequence`, the batch is sorted by length so that the active instances at step t
+        are the first `batch_sizes[t]` ones in the sorted order.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        None
+        """
+        max_seq_length = seq_lengths.max().item()
+
+        sorted_lengths, sorted_idx = seq_lengths.sort(descending=True)
+        # number of instances whose length is larger than t
+        batch_sizes = (sorted_lengths.unsqueeze(0) > torch.arange(max_seq_length, device=self._device).unsqueeze(-1))\
+            .sum(dim=-1).tolist()
+
+        # sort the inference states once so that the active instances are always a contiguous slice
+        log_trans, log_emiss_evidence = self._log_trans, self._log_emiss_evidence
+        self._log_trans, self._log_emiss_evidence = log_trans[sorted_idx], log_emiss_evidence[sorted_idx]
+        log_state_priors = self._log_state_priors
+        if self._n_replicas > 1:
+            self._log_state_priors = log_state_priors[sorted_idx]
+        self._log_alpha = torch.zeros_like(self._log_alpha)
+        self._log_beta = torch.zeros_like(self._log_beta)
+
+        # calculate log alpha; the padding steps are never visited
+        for t in range(0, max_seq_length):
+            self._log_alpha[:batch_sizes[t], t, :] = self._forward_step(t, slice(batch_sizes[t]))
+
+        # calculate log beta; beta[t] is only updated for instances that do not end at t,
+        # the others keep log1 = 0 so that no shift is needed afterwards
+        for t in range(max_seq_length - 2, -1, -1):
+            self._log_beta[:batch_sizes[t + 1], t, :] = self._backward_step(t, slice(batch_sizes[t + 1]))
+
+        # restore the original order of the instances
+        unsorted_idx = sorted_idx.argsort()
+        self._log_alpha = self._log_alpha[unsorted_idx]
+        self._log_beta = self._log_beta[unsorted_idx]
+        self._log_trans, self._log_emiss_evidence = log_trans, log_emiss_evidence
+        self._log_state_priors = log_state_priors
+        return None
+
+    def _forward_backward_beam(self, seq_lengths):
+        """
+        Forward-backward that only visits the states in the beam of each step (see `set_beam`).
+        The forward step costs O(beam_size * n_hidden) and the backward step O(beam_size^2) instead of
+        O(n_hidden^2). The pruned states get -inf in alpha and beta, hence zero posterior probability.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        None
+        """
+        batch_size, max_seq_length, _ = self._log_emiss_evidence.size()
+        batch_idx = torch.arange(batch_size, device=self._device).unsqueeze(-1)
+
+        # calculate log alpha. A finite value is used for log 0 to keep the gradients away from NaN
+        # when a state cannot be reached from any state in the previous beam
+        beam_states, beam_alphas, log_alphas = list(), list(), list()
+        for t in range(0, max_seq_length):
+            if t == 0:
+                log_alpha_t = self._log_state_priors + self._log_emiss_evidence[:, t, :]
+            else:
+                log_scores = beam_alphas[-1].unsqueeze(-1) + self._log_trans[batch_idx, t, beam_states[-1], :]
+                log_alpha_t = self._log_emiss_evidence[:, t, :] + log_scores.clamp(min=-1E4).logsumexp(dim=-2)
+            log_alpha_t = log_alpha_t - log_alpha_t.logsumexp(dim=-1, keepdim=True)
+
+            states_t, beam_alpha_t, log_alpha_t = self._prune_beam(log_alpha_t)
+            beam_states.append(states_t)
+            beam_alphas.append(beam_alpha_t)
+            log_alphas.append(log_alpha_t)
+        self._log_alpha = torch.stack(log_alphas, dim=1)
+
+        # calculate log beta over the beam of t and the beam of t + 1 only.
+        # beta stays log1 = 0 from the last step of each instance on, same as `_forward_backward`
+        log_betas = [torch.zeros([batch_size, self._n_hidden], device=self._device)]
         for t in range(max_seq_length - 2, -1, -1):
-            self._log_beta[:, t, :] = self._backward_step(t)
-        # shift the output (since beta is calculated in backward direction,
-        # we need to shift each instance in the batch according to its length)
-        shift_distances = seq_lengths - max_seq_length
-        self._log_beta = torch.stack(
-            [torch.roll(beta, s.item(), 0) for beta, s in zip(self._log_beta, shift_distances)]
+            next_states = beam_states[t + 1]
+            log_next = (self._log_emiss_evidence[:, t + 1, :] + log_betas[-1]).gather(-1, next_states)
+            log_next = log_next.masked_fill(torch.isinf(beam_alphas[t + 1]), -float('inf'))
+            log_trans_t = self._log_trans[batch_idx, t + 1, beam_states[t], :].gather(
+                -1, next_states.unsqueeze(1).expand(-1, self._beam_size, -1)
+            )
+            beam_beta_t = (log_trans_t + log_next.unsqueeze(1)).clamp(min=-1E4).logsumexp(dim=-1)
+            beam_beta_t = beam_beta_t.masked_fill(torch.isinf(beam_alphas[t]), -float('inf'))
+            log_beta_t = torch.full_like(log_betas[-1], -float('inf')).scatter(-1, beam_states[t], beam_beta_t)
+            log_betas.append(torch.where((t < seq_lengths - 1).unsqueeze(-1), log_beta_t, 0.0))
+        self._log_beta = torch.stack(log_betas[::-1], dim=1)
+        return None
+
+    def _forward_backward_scan(self, seq_lengths):
+        """
+        Compute alpha and beta with log-semiring prefix scans instead of stepping through time.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        None
+        """
+        batch_size, max_seq_length, _ = self._log_emiss_evidence.size()
+
+        # log potential of moving from z_{t-1} = i to z_t = j and emitting x_t, for t = 1, ..., T-1
+        log_potentials = self._log_trans[:, 1:, :, :] + self._log_emiss_evidence[:, 1:, :].unsqueeze(-2)
+        # replace the potentials of the padding steps with the log-domain identity matrix so that they do not
+        # change the products. A finite value is used for log 0 to keep the gradients away from NaN
+        log_eye = torch.full([self._n_hidden, self._n_hidden], -1E4, device=self._device).fill_diagonal_(0)
+        pad_mask = torch.arange(1, max_seq_length, device=self._device) >= seq_lengths.unsqueeze(-1)
+        log_potentials = torch.where(pad_mask.view(batch_size, -1, 1, 1), log_eye, log_potentials)
+
+        # alpha_t = alpha_0 (x) M_1 (x) ... (x) M_t
+        log_alpha_0 = self._log_state_priors + self._log_emiss_evidence[:, 0, :]
+        log_alpha = self._log_matmul(
+            log_alpha_0.view(batch_size, 1, 1, -1), log_prefix_matmul(log_potentials, matmul_fn=self._log_matmul)
+        ).squeeze(-2)
+        log_alpha = torch.cat([log_alpha_0.unsqueeze(1), log_alpha], dim=1)
+        self._log_alpha = log_alpha - log_alpha.logsumexp(dim=-1, keepdim=True)
+
+        # beta_t = M_{t+1} (x) ... (x) M_{T-1} (x) 1. The padding steps are identities, so beta is already
+        # aligned with the end of each sequence
+        log_beta = log_prefix_matmul(log_potentials, reverse=True, matmul_fn=self._log_matmul).logsumexp(dim=-1)
+        self._log_beta = torch.cat(
+            [log_beta, torch.zeros([batch_size, 1, self._n_hidden], device=self._device)], dim=1
         )
         return None
 
     def _compute_xi(self, t):
         temp_1 = self._log_emiss_evidence[:, t, :] + self._log_beta[:, t, :]
-        temp_2 = log_matmul(self._log_alpha[:, t - 1, :].unsqueeze(-1), temp_1.unsqueeze(1))
+        # an outer sum; `log_matmul` over the singleton dimension would give NaN gradients for -inf entries
+        temp_2 = self._log_alpha[:, t - 1, :].unsqueeze(-1) + temp_1.unsqueeze(1)
         log_xi_t = self._log_trans[:, t, :, :] + temp_2
         return log_xi_t
 
+    def _expected_log_transition_vectorized(self, max_seq_length):
+        """
+        Compute xi for all time steps in one pass, without the per-step writes into `_log_xi`.
+
+        Returns
+        -------
+        the expected transition log likelihood of each instance at each step t >= 1 (batch_size X (T-1))
+        """
+        batch_size = len(self._log_alpha)
+        log_trans = self._log_trans[:, 1:max_seq_length, :, :]
+
+        # xi_t(i, j) ~ alpha_{t-1}(i) + trans_t(i, j) + emiss_t(j) + beta_t(j)
+        log_xi = self._log_alpha[:, :max_seq_length-1, :].unsqueeze(-1) + log_trans + \
+            (self._log_emiss_evidence + self._log_beta)[:, 1:max_seq_length, :].unsqueeze(-2)
+        log_xi = log_xi - logsumexp(log_xi.view(batch_size, max_seq_length - 1, -1), dim=-1)\
+            .view(batch_size, max_seq_length - 1, 1, 1)
+        return torch.sum(torch.exp(log_xi) * self._masked_log_probs(log_trans, self._trans_allowed), dim=[-2, -1])
+
+    def _expected_log_transition_step(self, t):
+        log_xi_t = self._compute_xi(t)
+        log_xi_t = log_xi_t - logsumexp(log_xi_t.view(len(log_xi_t), -1), dim=-1).view(-1, 1, 1)
+        return torch.sum(
+            torch.exp(log_xi_t) * self._masked_log_probs(self._log_trans[:, t, :, :], self._trans_allowed), dim=[-2, -1]
+        )
+
+    def _expected_log_transition_streaming(self, seq_lengths):
+        """
+        Accumulate the expected transition log likelihood over time steps without holding xi.
+        When gradients are required, each step is checkpointed and recomputed during the backward pass,
+        so that the per-step xi is not kept by autograd either.
+
+        Returns
+        -------
+        the expected transition log likelihood of each instance summed over its valid time steps
+        """
+        max_seq_length = seq_lengths.max().item()
+
+        log_tran = torch.zeros(len(seq_lengths), device=self._device)
+        for t in range(1, max_seq_length):
+            if torch.is_grad_enabled():
+                log_tran_t = checkpoint(self._expected_log_transition_step, t, use_reentrant=False)
+            else:
+                log_tran_t = self._expected_log_transition_step(t)
+            log_tran = log_tran + torch.where(t < seq_lengths, log_tran_t, 0.0)
+        return log_tran
+
     def _expected_complete_log_likelihood(self, seq_lengths):
         batch_size = len(seq_lengths)
         max_seq_length = seq_lengths.max().item()
@@ -270,22 +1080,40 @@ class CHMM(nn.Module):
         log_gamma = self._log_gamma - self._log_gamma.logsumexp(dim=-1, keepdim=True)
 
         # calculate expected sufficient statistics: psi_t(i, j) = P(z_{t-1}=i, z_t=j|x_{1:T})
-        for t in range(1, max_seq_length):
-            self._log_xi[:, t, :, :] = self._compute_xi(t)
-        stabled_norm_term = logsumexp(self._log_xi[:, 1:, :, :].view(batch_size, max_seq_length - 1, -1), dim=-1)\
-            .view(batch_size, max_seq_length-1, 1, 1)
-        log_xi = self._log_xi[:, 1:, :, :] - stabled_norm_term
+        # and the expected transition log likelihood
+        if self._xi_mode == 'vectorized':
+            log_tran = self._expected_log_transition_vectorized(max_seq_length)
+        elif self._xi_mode == 'streaming':
+            log_tran = self._expected_log_transition_streaming(seq_lengths)
+        else:
+            for t in range(1, max_seq_length):
+                self._log_xi[:, t, :, :] = self._compute_xi(t)
+            stabled_norm_term = logsumexp(self._log_xi[:, 1:, :, :].view(batch_size, max_seq_length - 1, -1), dim=-1)\
+                .view(batch_size, max_seq_length-1, 1, 1)
+            log_xi = self._log_xi[:, 1:, :, :] - stabled_norm_term
+            # sum over j, k
+            log_tran = torch.sum(
+                torch.exp(log_xi) * self._masked_log_probs(self._log_trans[:, 1:, :, :], self._trans_allowed),
+                dim=[-2, -1]
+            )
 
         # calculate the expected complete data log likelihood
-        log_prior = torch.sum(torch.exp(log_gamma[:, 0, :]) * self._log_state_priors, dim=-1)
-        log_prior = log_prior.mean()
-        # sum over j, k
-        log_tran = torch.sum(torch.exp(log_xi) * self._log_trans[:, 1:, :, :], dim=[-2, -1])
+        log_prior = torch.sum(
+            torch.exp(log_gamma[:, 0, :]) * self._masked_log_probs(self._log_state_priors, self._init_allowed), dim=-1
+        )
+        log_prior = self._replica_mean(log_prior)
         # sum over valid time steps, and then average over batch. Note this starts from t=2
-        log_tran = torch.mean(torch.stack([inst[:length].sum() for inst, length in zip(log_tran, seq_lengths-1)]))
+        if self._xi_mode == 'streaming':
+            log_tran = self._replica_mean(log_tran)
+        else:
+            log_tran = self._replica_mean(
+                torch.stack([inst[:length].sum() for inst, length in zip(log_tran, seq_lengths-1)])
+            )
         # same as above
         log_emis = torch.sum(torch.exp(log_gamma) * self._log_emiss_evidence, dim=-1)
-        log_emis = torch.mean(torch.stack([inst[:length].sum() for inst, length in zip(log_emis, seq_lengths)]))
+        log_emis = self._replica_mean(
+            torch.stack([inst[:length].sum() for inst, length in zip(log_emis, seq_lengths)])
+        )
         log_likelihood = log_prior + log_tran + log_emis
 
         return log_likelihood
@@ -294,25 +1122,44 @@ class CHMM(nn.Module):
         # the row of obs should be one-hot or at least sum to 1
         # assert (obs.sum(dim=-1) == 1).all()
 
-        batch_size, max_seq_length, n_src, n_obs = obs.size()
-        assert n_obs == self._d_obs
-        assert n_src == self._n_src
+        if obs.is_floating_point():
+            assert obs.size(-1) == self._d_obs
+        assert obs.size(2) == self._n_src
 
         # Initialize alpha, beta and xi
         self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
-        self._forward_backward(seq_lengths=seq_lengths)
-        log_likelihood = self._expected_complete_log_likelihood(seq_lengths=seq_lengths)
+        # with replicas, the outputs are those of all replicas, concatenated along the batch dimension
+        seq_lengths = self._replicate_lengths(seq_lengths)
+        if self._fb_posterior_grad:
+            log_likelihood = PosteriorGradLikelihood.apply(
+                self, self._log_state_priors, self._log_trans, self._log_emiss_evidence, seq_lengths
+            )
+        else:
+            self._forward_backward(seq_lengths=seq_lengths)
+            log_likelihood = self._expected_complete_log_likelihood(seq_lengths=seq_lengths)
         return log_likelihood, (self.log_trans, self.log_emiss)
 
-    def viterbi(self, emb, obs, seq_lengths, normalize_observation=True):
+    def _viterbi_decode(self, seq_lengths):
         """
-        Find argmax_z log p(z|obs) for each (obs) in the batch.
+        Run the Viterbi recursion and trace back the best paths of the whole batch on device.
+        Should be called after `_initialize_states`.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+
+        Returns
+        -------
+        best paths (batch_size X max_seq_length, LongTensor padded with 0 after each sequence length),
+        log probabilities of the best paths
         """
+        if self._use_jit_kernels:
+            viterbi_recursion = scripted_kernels()[2]
+            return viterbi_recursion(self._log_state_priors, self._log_trans, self._log_emiss_evidence, seq_lengths)
+
         batch_size = len(seq_lengths)
         max_seq_length = seq_lengths.max().item()
 
-        # initialize states
-        self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
         # maximum probabilities
         log_delta = torch.zeros([batch_size, max_seq_length, self._n_hidden], device=self._device)
         # most likely previous state on the most probable path to z_t = j. a[0] is undefined.
@@ -320,66 +1167,360 @@ class CHMM(nn.Module):
 
         # the initial delta state
         log_delta[:, 0, :] = self._log_state_priors + self._log_emiss_evidence[:, 0, :]
+        if self.is_beam_pruned:
+            # prune by the max-product scores; the best path always survives the threshold
+            batch_idx = torch.arange(batch_size, device=self._device).unsqueeze(-1)
+            beam_states, beam_deltas, log_delta[:, 0, :] = self._prune_beam(log_delta[:, 0, :])
         for t in range(1, max_seq_length):
             # udpate delta and a. The location of the emission probabilities does not matter
-            max_log_prob, argmax_val = log_maxmul(
-                log_delta[:, t-1, :].unsqueeze(1),
-                self._log_trans[:, t, :, :] + self._log_emiss_evidence[:, t, :].unsqueeze(1)
-            )
-            log_delta[:, t, :] = max_log_prob.squeeze(1)
-            pre_states[:, t, :] = argmax_val.squeeze(1)
+            if self.is_beam_pruned:
+                log_potentials = self._log_trans[batch_idx, t, beam_states, :] + \
+                    self._log_emiss_evidence[:, t, :].unsqueeze(1)
+                max_log_prob, argmax_val = (beam_deltas.unsqueeze(-1) + log_potentials).max(dim=-2)
+                pre_states[:, t, :] = beam_states.gather(-1, argmax_val)
+                beam_states, beam_deltas, log_delta[:, t, :] = self._prune_beam(max_log_prob)
+            elif self._bio_constrained:
+                log_potentials = self._log_trans[:, t, :, :] + self._log_emiss_evidence[:, t, :].unsqueeze(1)
+                log_delta[:, t, :], pre_states[:, t, :] = self._bio_max_transition(log_delta[:, t-1, :], log_potentials)
+            else:
+                log_potentials = self._log_trans[:, t, :, :] + self._log_emiss_evidence[:, t, :].unsqueeze(1)
+                max_log_prob, argmax_val = self._log_maxmul(log_delta[:, t-1, :].unsqueeze(1), log_potentials)
+                log_delta[:, t, :] = max_log_prob.squeeze(1)
+                pre_states[:, t, :] = argmax_val.squeeze(1)
 
         # The terminal state
-        batch_max_log_prob = list()
-        batch_z_t_star = list()
-
-        for l_delta, length in zip(log_delta, seq_lengths):
-            max_log_prob, z_t_star = l_delta[length-1, :].max(dim=-1)
-            batch_max_log_prob.append(max_log_prob)
-            batch_z_t_star.append(z_t_star)
-
-        # Trace back
-        batch_z_star = [[z_t_star.item()] for z_t_star in batch_z_t_star]
-        for p_states, z_star, length in zip(pre_states, batch_z_star, seq_lengths):
-            for t in range(length-2, -1, -1):
-                z_t = p_states[t+1, z_star[0]].item()
-                z_star.insert(0, z_t)
-
-        # compute the smoothed marginal p(z_t = j | obs_{1:T})
+        last_steps = seq_lengths - 1
+        batch_max_log_prob, batch_z_t_star = log_delta[torch.arange(batch_size), last_steps].max(dim=-1)
+
+        # Trace back. Each instance joins the trace at its own last step
+        paths = torch.zeros([batch_size, max_seq_length], dtype=torch.long, device=self._device)
+        z_t = batch_z_t_star
+        for t in range(max_seq_length - 1, -1, -1):
+            z_t = torch.where(last_steps == t, batch_z_t_star, z_t)
+            paths[:, t] = z_t
+            if t > 0:
+                z_t = pre_states[:, t, :].gather(-1, z_t.unsqueeze(-1)).squeeze(-1)
+        paths.masked_fill_(torch.arange(max_seq_length, device=self._device) > last_steps.unsqueeze(-1), 0)
+
+        return paths, batch_max_log_prob
+
+    def _nbest_viterbi_decode(self, seq_lengths, n_best):
+        """
+        Batched list Viterbi: keep the `n_best` best partial paths into each state at each step, and trace back the
+        `n_best` best complete paths of the whole batch on device. Should be called after `_initialize_states`.
+        Always runs over all the states, regardless of the beam.
+
+        Parameters
+        ----------
+        seq_lengths: sequence lengths
+        n_best: number of paths to return
+
+        Returns
+        -------
+        best paths (batch_size X n_best X max_seq_length, LongTensor padded with 0 after each sequence length),
+        log probabilities of the best paths (batch_size X n_best, in descending order). If an instance has fewer
+        than `n_best` possible paths, the log probabilities of the surplus paths are -inf.
+        """
+        batch_size = len(seq_lengths)
+        max_seq_length = seq_lengths.max().item()
+        batch_idx = torch.arange(batch_size, device=self._device).view(-1, 1)
+
+        # log_delta[b, j, r]: the r-th best score of the partial paths that end in z_t = j
+        log_delta = torch.full([batch_size, max_seq_length, self._n_hidden, n_best], -float('inf'), device=self._device)
+        # previous state and its rank on the r-th best partial path to z_t = j. The backtraces of t = 0 are undefined
+        pre_states = torch.zeros(
+            [batch_size, max_seq_length, self._n_hidden, n_best], dtype=torch.long, device=self._device
+        )
+        pre_ranks = torch.zeros_like(pre_states)
+
+        log_delta[:, 0, :, 0] = self._log_state_priors + self._log_emiss_evidence[:, 0, :]
+        for t in range(1, max_seq_length):
+            # scores of extending every (state, rank) of step t-1 to each state of step t
+            log_potentials = self._log_trans[:, t, :, :] + self._log_emiss_evidence[:, t, :].unsqueeze(1)
+            candidates = (log_delta[:, t - 1, :, :].unsqueeze(-2) + log_potentials.unsqueeze(-1))\
+                .transpose(-2, -1).reshape(batch_size, self._n_hidden * n_best, self._n_hidden)
+            top_log_prob, top_idx = candidates.topk(n_best, dim=-2)
+            log_delta[:, t, :, :] = top_log_prob.transpose(-2, -1)
+            pre_states[:, t, :, :] = torch.div(top_idx, n_best, rounding_mode='floor').transpose(-2, -1)
+            pre_ranks[:, t, :, :] = (top_idx % n_best).transpose(-2, -1)
+
+        # the terminal states
+        last_steps = seq_lengths - 1
+        batch_max_log_prob, last_idx = log_delta[batch_idx.squeeze(-1), last_steps].view(batch_size, -1)\
+            .topk(n_best, dim=-1)
+        last_states = torch.div(last_idx, n_best, rounding_mode='floor')
+        last_ranks = last_idx % n_best
+
+        # trace back all n_best paths at once. Each instance joins the trace at its own last step
+        paths = torch.zeros([batch_size, n_best, max_seq_length], dtype=torch.long, device=self._device)
+        z_t, r_t = last_states, last_ranks
+        for t in range(max_seq_length - 1, -1, -1):
+            joins = (last_steps == t).unsqueeze(-1)
+            z_t = torch.where(joins, last_states, z_t)
+            r_t = torch.where(joins, last_ranks, r_t)
+            paths[:, :, t] = z_t
+            if t > 0:
+                z_t, r_t = pre_states[batch_idx, t, z_t, r_t], pre_ranks[batch_idx, t, z_t, r_t]
+        paths.masked_fill_(torch.arange(max_seq_length, device=self._device) > last_steps.view(-1, 1, 1), 0)
+
+        return paths, batch_max_log_prob
+
+    def nbest_viterbi(self, emb, obs, seq_lengths, n_best, normalize_observation=True, return_marginals=False):
+        """
+        Find the `n_best` most probable label sequences of each instance in the batch.
+
+        Parameters
+        ----------
+        emb: embeddings
+        obs: observations
+        seq_lengths: sequence lengths
+        n_best: number of label sequences per instance
+        normalize_observation: whether normalize the observations
+        return_marginals: also return the marginals, computed from the same inference states
+
+        Returns
+        -------
+        the label indices of the n-best paths of each instance (a list of `n_best` lists per instance),
+        log probabilities log p(z, obs) of the paths of each instance as numpy arrays (n_best), in descending order,
+        and, if `return_marginals`, the marginals of each instance as numpy arrays
+        """
+        self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
+        seq_lengths = self._replicate_lengths(seq_lengths)
+        batch_marginals = None
+        if return_marginals:
+            marginals = self._posterior_marginals(seq_lengths).detach().cpu().numpy()
+            batch_marginals = [marginal[:length] for marginal, length in zip(marginals, seq_lengths.tolist())]
+        paths, log_probs = self._nbest_viterbi_decode(seq_lengths, n_best)
+        batch_paths = [[path[:length] for path in inst_paths]
+                       for inst_paths, length in zip(paths.tolist(), seq_lengths.tolist())]
+        if return_marginals:
+            return batch_paths, list(log_probs.detach().cpu().numpy()), batch_marginals
+        return batch_paths, list(log_probs.detach().cpu().numpy())
+
+    def _posterior_marginals(self, seq_lengths):
+        """
+        Compute the smoothed marginals p(z_t = j | obs_{1:T}) from the current states.
+
+        Returns
+        -------
+        marginals (batch_size X max_seq_length X n_hidden)
+        """
         self._forward_backward(seq_lengths)
         log_marginals = self._log_alpha + self._log_beta
-        norm_marginals = torch.exp(log_marginals - logsumexp(log_marginals, dim=-1, keepdim=True))
-        batch_marginals = list()
-        for marginal, length in zip(norm_marginals, seq_lengths):
-            mgn_list = marginal[:length].detach().cpu().numpy()
-            batch_marginals.append(mgn_list)
+        return torch.exp(log_marginals - logsumexp(log_marginals, dim=-1, keepdim=True))
+
+    def decode(self, emb, obs, seq_lengths, mode='both', normalize_observation=True):
+        """
+        Decode the latent labels, running only the inference passes the requested outputs need.
+
+        Parameters
+        ----------
+        emb: embeddings
+        obs: observations
+        seq_lengths: sequence lengths
+        mode: `viterbi`: the most probable label sequence only;
+              `posterior`: the marginals only;
+              `mbr`: the per-token argmax of the marginals, together with the marginals;
+              `both`: the most probable label sequence and the marginals.
+        normalize_observation: whether normalize the observations
+
+        Returns
+        -------
+        label indices of each instance (None in `posterior` mode),
+        marginals of each instance as numpy arrays (None in `viterbi` mode)
+        """
+        assert mode in ['viterbi', 'posterior', 'mbr', 'both'], ValueError(f"Unknown decode mode: {mode}")
+
+        # initialize states
+        self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
+        seq_lengths = self._replicate_lengths(seq_lengths)
+        seq_length_list = seq_lengths.tolist()
+
+        batch_z_star = None
+        if mode in ['viterbi', 'both']:
+            paths, _ = self._viterbi_decode(seq_lengths)
+            # convert the padded paths to lists in one go
+            batch_z_star = [path[:length] for path, length in zip(paths.tolist(), seq_length_list)]
+
+        batch_marginals = None
+        if mode != 'viterbi':
+            norm_marginals = self._posterior_marginals(seq_lengths)
+            if mode == 'mbr':
+                batch_z_star = [path[:length] for path, length in
+                                zip(norm_marginals.argmax(dim=-1).tolist(), seq_length_list)]
+            norm_marginals = norm_marginals.detach().cpu().numpy()
+            batch_marginals = [marginal[:length] for marginal, length in zip(norm_marginals, seq_length_list)]
 
         return batch_z_star, batch_marginals
 
-    def annotate(self, emb, obs, seq_lengths, label_types, normalize_observation=True):
-        batch_label_indices, batch_probs = self.viterbi(
-            emb, obs, seq_lengths, normalize_observation=normalize_observation
+    def viterbi(self, emb, obs, seq_lengths, normalize_observation=True):
+        """
+        Find argmax_z log p(z|obs) for each (obs) in the batch, together with the marginals.
+        """
+        return self.decode(emb, obs, seq_lengths, mode='both', normalize_observation=normalize_observation)
+
+    def stream_posteriors(self, emb, obs, chunk_size, lag=0, normalize_observation=True):
+        """
+        Streaming inference over a single (arbitrarily long) sequence.
+
+        The sequence is processed in chunks of `chunk_size` tokens; the forward state is carried across the
+        chunk boundaries. The marginal of step t is finalized by the chunk that brings in step t + `lag`, and is
+        smoothed with all observations up to the end of that chunk, i.e., p(z_t | obs_{1:t'}) with
+        t' >= t + `lag`. With `chunk_size=1` the lag is exact, and `lag=0` is online filtering.
+        Only `chunk_size + lag` steps are held in memory at once, independent of the sequence length.
+
+        Parameters
+        ----------
+        emb: embeddings of one sequence (seq_length X d_emb); may stay on the CPU
+        obs: observations of one sequence (seq_length X n_src X d_obs); may stay on the CPU
+        chunk_size: number of new steps processed in each chunk
+        lag: smoothing lag
+        normalize_observation: whether normalize the observations
+
+        Yields
+        -------
+        index of the first step and the marginals (n_steps X n_hidden numpy array) of the steps finalized by
+        each chunk. The yielded steps are consecutive and cover the whole sequence.
+        """
+        assert chunk_size > 0 and lag >= 0, ValueError("`chunk_size` must be positive and `lag` non-negative!")
+        assert self._n_replicas == 1, ValueError("Streaming inference does not support replicas!")
+        seq_length = len(emb)
+
+        # states of the steps carried over from the previous chunk: the ones that are not yet finalized,
+        # plus (at least) the last step whose alpha the next forward step depends on
+        carried_trans = carried_emiss_evidence = carried_alpha = None
+        n_pending = 0
+        for chunk_start in range(0, seq_length, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, seq_length)
+            is_last_chunk = chunk_end == seq_length
+
+            self._initialize_states(
+                embs=emb[chunk_start:chunk_end].unsqueeze(0).to(self._device),
+                obs=obs[chunk_start:chunk_end].unsqueeze(0).to(self._device),
+                normalize_observation=normalize_observation
+            )
+            n_carried = 0
+            if carried_alpha is not None:
+                n_carried = carried_alpha.size(1)
+                self._log_trans = torch.cat([carried_trans, self._log_trans], dim=1)
+                self._log_emiss_evidence = torch.cat([carried_emiss_evidence, self._log_emiss_evidence], dim=1)
+                self._log_alpha = torch.cat([carried_alpha, self._log_alpha], dim=1)
+                self._log_beta = torch.zeros_like(self._log_alpha)
+            window_length = self._log_alpha.size(1)
+
+            # the forward pass only visits the new steps
+            for t in range(n_carried, window_length):
+                self._log_alpha[:, t, :] = self._forward_step(t)
+
+            # smooth the pending and new steps up to the end of the window. Beta at the last step is log 1
+            window_start = n_carried - n_pending
+            for t in range(window_length - 2, window_start - 1, -1):
+                self._log_beta[:, t, :] = self._backward_step(t)
+
+            # steps whose lookahead is complete
+            n_final = window_length if is_last_chunk else max(window_length - lag, window_start)
+            if n_final > window_start:
+                log_marginals = self._log_alpha[0, window_start:n_final] + self._log_beta[0, window_start:n_final]
+                marginals = torch.exp(log_marginals - logsumexp(log_marginals, dim=-1, keepdim=True))
+                yield chunk_start - n_carried + window_start, marginals.detach().cpu().numpy()
+
+            # keep the unfinished steps and the last finalized one
+            n_pending = window_length - n_final
+            keep_from = max(n_final - 1, 0)
+            carried_trans = self._log_trans[:, keep_from:]
+            carried_emiss_evidence = self._log_emiss_evidence[:, keep_from:]
+            carried_alpha = self._log_alpha[:, keep_from:]
+
+    def _score_spans(self, paths, marginals, seq_lengths, label_types):
+        """
+        Extract the spans of the padded paths and score each span by the mean marginal probability of its labels.
+        The dummy first step ([CLS]) does not count in the scores.
+
+        Returns
+        -------
+        sentence index, start, end, entity type index (see `extract_bio_spans`) and score of each span
+        """
+        sent_ids, starts, ends, entity_ids = extract_bio_spans(paths, seq_lengths, label_types)
+
+        token_probs = marginals.gather(-1, paths.unsqueeze(-1)).squeeze(-1)
+        token_probs[:, 0] = 0
+        cum_probs = torch.cat([token_probs.new_zeros(len(paths), 1), token_probs.cumsum(dim=-1)], dim=-1)
+        score_starts = starts.clamp(min=1)
+        scores = (cum_probs[sent_ids, ends] - cum_probs[sent_ids, score_starts]) / \
+            (ends - score_starts).clamp(min=1)
+        return sent_ids, starts, ends, entity_ids, scores
+
+    def scored_spans(self, emb, obs, seq_lengths, label_types, normalize_observation=True):
+        """
+        Annotate the scored entity spans of a batch as flat arrays, without per-sentence python objects.
+        The spans are those of the Viterbi paths, with the positions shifted back by the dummy first step;
+        the score of a span is the mean marginal probability of its labels.
+
+        Parameters
+        ----------
+        emb: embeddings
+        obs: observations
+        seq_lengths: sequence lengths
+        label_types: BIO label types
+        normalize_observation: whether normalize the observations
+
+        Returns
+        -------
+        numpy arrays of the sentence index (within the batch), start, end (exclusive), entity type index
+        (in the order of the B- labels in `label_types`) and score of each span
+        """
+        self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
+        seq_lengths = self._replicate_lengths(seq_lengths)
+        paths, _ = self._viterbi_decode(seq_lengths)
+        marginals = self._posterior_marginals(seq_lengths)
+        sent_ids, starts, ends, entity_ids, scores = self._score_spans(paths, marginals, seq_lengths, label_types)
+
+        # a span that only covers the dummy step is not an entity
+        keep = ends > 1
+        return tuple(x[keep].detach().cpu().numpy() for x in (
+            sent_ids, (starts - 1).clamp(min=0), ends - 1, entity_ids, scores
+        ))
+
+    def annotate(self, emb, obs, seq_lengths, label_types, normalize_observation=True, n_best=1):
+        """
+        Annotate the entity spans of a batch.
+
+        If `n_best` > 1, the spans of the `n_best` most probable label sequences of each instance are returned
+        as well, as the third element of the second output: a list of (spans, log p(z, obs)) per instance.
+        """
+        self._initialize_states(embs=emb, obs=obs, normalize_observation=normalize_observation)
+        seq_lengths = self._replicate_lengths(seq_lengths)
+        paths, _ = self._viterbi_decode(seq_lengths)
+        marginals = self._posterior_marginals(seq_lengths)
+        sent_ids, starts, ends, entity_ids, scores = map(
+            lambda x: x.tolist(), self._score_spans(paths, marginals, seq_lengths, label_types)
         )
-        batch_labels = [[label_types[lb_index] for lb_index in label_indices]
-                        for label_indices in batch_label_indices]
+        entity_types = [lb[2:] for lb in label_types if lb.startswith('B-')]
 
         # For batch_spans, we are going to compare them with the true spans,
         # and the true spans is already shifted, so we do not need to shift predicted spans back
-        batch_spans = list()
-        batch_scored_spans = list()
-        for labels, probs, indices in zip(batch_labels, batch_probs, batch_label_indices):
-            spans = label_to_span(labels)
-            batch_spans.append(spans)
-
-            ps = [p[s] for p, s in zip(probs, indices[1:])]
-            scored_spans = dict()
-            for k, v in spans.items():
-                if k == (0, 1):
-                    continue
-                start = k[0] - 1 if k[0] > 0 else 0
-                end = k[1] - 1
-                score = np.mean(ps[start:end])
-                scored_spans[(start, end)] = [(v, score)]
-            batch_scored_spans.append(scored_spans)
+        batch_spans = [dict() for _ in range(len(seq_lengths))]
+        batch_scored_spans = [dict() for _ in range(len(seq_lengths))]
+        for sent_id, start, end, entity_id, score in zip(sent_ids, starts, ends, entity_ids, scores):
+            batch_spans[sent_id][(start, end)] = entity_types[entity_id]
+            if (start, end) == (0, 1):
+                continue
+            batch_scored_spans[sent_id][(max(start - 1, 0), end - 1)] = [(entity_types[entity_id], score)]
+
+        marginals = marginals.detach().cpu().numpy()
+        batch_probs = [marginal[:length] for marginal, length in zip(marginals, seq_lengths.tolist())]
+
+        if n_best > 1:
+            # the inference states are still those of the decoding above
+            batch_nbest_paths, batch_nbest_log_probs = self._nbest_viterbi_decode(seq_lengths, n_best)
+            batch_nbest_spans = list()
+            for paths, log_probs, length in zip(
+                    batch_nbest_paths.tolist(), batch_nbest_log_probs.tolist(), seq_lengths.tolist()
+            ):
+                batch_nbest_spans.append([
+                    (label_to_span([label_types[lb_index] for lb_index in path[:length]]), log_prob)
+                    for path, log_prob in zip(paths, log_probs)
+                ])
+            return batch_spans, (batch_scored_spans, batch_probs, batch_nbest_spans)
 
         return batch_spans, (batch_scored_spans, batch_probs)
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import logging
+from typing import List, Optional
+
+import torch
+
+from .args import CHMMConfig
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingProjection:
+    """
+    Linear projection of the token embeddings to a lower dimension: x -> (x - mean) @ components.
+    CHMM only reads the embeddings through linear heads, so a few principal components keep most of
+    what the heads can use while the datasets and the heads shrink several-fold.
+    """
+
+    def __init__(self, method: str, mean: torch.Tensor, components: torch.Tensor):
+        self.method = method
+        self.mean = mean.to(torch.float)
+        self.components = components.to(torch.float)
+
+    @property
+    def d_emb(self):
+        return self.components.shape[0]
+
+    @property
+    def d_proj(self):
+        return self.components.shape[1]
+
+    @property
+    def fingerprint(self):
+        """
+        A short hash of the projection, so that the cached projected embeddings of a different fit are not reused
+        """
+        digest = hashlib.sha1(self.mean.numpy().tobytes())
+        digest.update(self.components.numpy().tobytes())
+        return digest.hexdigest()[:8]
+
+    @property
+    def name(self):
+        return f'{self.method}{self.d_proj}-{self.fingerprint}'
+
+    @classmethod
+    def fit(cls, embs: List[torch.Tensor], method: str, d_proj: int, seed: Optional[int] = 42):
+        """
+        Fit the projection on a list of (seq_len X d_emb) embeddings
+
+        Parameters
+        ----------
+        embs: token embeddings of each instance, usually the training set
+        method: `pca`: the top principal components of the token embeddings;
+                `random`: a Gaussian random projection (the embeddings are only used for the dimension)
+        d_proj: projected dimension
+        seed: random seed of the random projection
+
+        Returns
+        -------
+        the fitted projection
+        """
+        assert method in ['pca', 'random'], ValueError(f"Unknown projection method: {method}")
+        d_emb = embs[0].shape[-1]
+        assert 0 < d_proj < d_emb, ValueError(f"The projected dimension {d_proj} should be in (0, {d_emb})")
+
+        if method == 'random':
+            generator = torch.Generator().manual_seed(seed)
+            components = torch.randn(d_emb, d_proj, generator=generator) / d_proj ** 0.5
+            return cls(method, torch.zeros(d_emb), components)
+
+        # accumulate the first and second moments instance by instance instead of stacking all tokens
+        n_tokens = 0
+        emb_sum = torch.zeros(d_emb, dtype=torch.double)
+        gram = torch.zeros(d_emb, d_emb, dtype=torch.double)
+        for emb in embs:
+            emb = torch.as_tensor(emb).to(torch.double)
+            n_tokens += len(emb)
+            emb_sum += emb.sum(dim=0)
+            gram += emb.T @ emb
+        mean = emb_sum / n_tokens
+        covariance = gram / n_tokens - torch.outer(mean, mean)
+
+        eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+        order = eigenvalues.argsort(descending=True)[:d_proj]
+        components = eigenvectors[:, order]
+        # fix the signs so that the fit is reproducible
+        signs = torch.sign(components.gather(0, components.abs().argmax(dim=0, keepdim=True)))
+        components = components * signs
+
+        explained = eigenvalues[order].sum() / eigenvalues.sum()
+        logger.info(f"PCA projection {d_emb} -> {d_proj} keeps {explained:.2%} of the embedding variance")
+        return cls(method, mean, components)
+
+    def __call__(self, emb: torch.Tensor) -> torch.Tensor:
+        return (torch.as_tensor(emb).to(torch.float) - self.mean) @ self.components
+
+    def save(self, file_path: str):
+        torch.save({'method': self.method, 'mean': self.mean, 'components': self.components}, file_path)
+        return self
+
+    @classmethod
+    def load(cls, file_path: str):
+        projection_dict = torch.load(file_path)
+        return cls(projection_dict['method'], projection_dict['mean'], projection_dict['components'])
+
+
+def projected_emb_path(emb_path: str, projection: EmbeddingProjection):
+    """
+    Where the projected embeddings are cached: next to the raw embeddings, e.g., `train-emb.pt` ->
+    `train-emb-pca128-<fingerprint>.pt`
+    """
+    stem = emb_path[:-len('.pt')] if emb_path.endswith('.pt') else emb_path
+    return f'{stem}-{projection.name}.pt'
+
+
+def load_emb_projection(config: CHMMConfig) -> Optional[EmbeddingProjection]:
+    """
+    Load the projection fitted by an earlier run from the output folder
+
+    Returns
+    -------
+    the projection; None if the projection is disabled or has not been fitted with the current settings
+    """
+    if config.emb_projection == 'none':
+        return None
+    assert config.emb_projection in ['pca', 'random'], ValueError(f"Unknown projection: {config.emb_projection}")
+
+    file_path = os.path.join(config.output_dir, 'emb-projection.pt')
+    if not os.path.isfile(file_path):
+        return None
+    projection = EmbeddingProjection.load(file_path)
+    if projection.method != config.emb_projection or projection.d_proj != config.emb_projection_dim:
+        logger.warning(f"The embedding projection in {file_path} does not match the configuration and is refitted.")
+        return None
+    logger.info(f"Loaded the embedding projection from {file_path}")
+    return projection
+
+
+def fit_emb_projection(config: CHMMConfig, training_dataset) -> EmbeddingProjection:
+    """
+    Fit the projection on the (raw) embeddings of the training set, save it to the output folder
+    and project the training set
+
+    Parameters
+    ----------
+    config: configuration; `d_emb` is updated to the projected dimension
+    training_dataset: training dataset (`CHMMBaseDataset`)
+
+    Returns
+    -------
+    the fitted projection
+    """
+    logger.info(f"Fitting the {config.emb_projection} embedding projection on the training set...")
+    projection = EmbeddingProjection.fit(
+        training_dataset.embs, config.emb_projection, config.emb_projection_dim, seed=config.seed
+    )
+    if not os.path.isdir(config.output_dir):
+        os.makedirs(os.path.abspath(config.output_dir))
+    projection.save(os.path.join(config.output_dir, 'emb-projection.pt'))
+    training_dataset.project_embs(projection, config)
+    return projection
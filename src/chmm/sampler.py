@@ -0,0 +1,98 @@
+import logging
+from typing import Iterator, List, Optional
+
+import torch
+import numpy as np
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+def padding_ratio(seq_lengths: List[int], batches: List[List[int]]) -> float:
+    """
+    The fraction of the padded batch tensors that is padding, i.e., the time steps the dynamic programming
+    runs on without any token
+    """
+    n_tokens = sum(seq_lengths)
+    n_padded = sum(len(batch) * max(seq_lengths[idx] for idx in batch) for batch in batches)
+    return 1 - n_tokens / n_padded if n_padded else 0.0
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Training batch sampler that groups instances of similar lengths. Each epoch, the instances are shuffled
+    and split into buckets of `bucket_size` batches; each bucket is sorted by length and cut into batches,
+    and the order of all batches is shuffled. The batches change from epoch to epoch as with uniform shuffling,
+    but a batch is padded only to the longest of similar lengths.
+    """
+
+    def __init__(self,
+                 seq_lengths: List[int],
+                 batch_size: int,
+                 bucket_size: Optional[int] = 50,
+                 seed: Optional[int] = 42):
+        self._seq_lengths = np.asarray(seq_lengths)
+        self._batch_size = batch_size
+        self._bucket_size = bucket_size
+        self._generator = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        return -(-len(self._seq_lengths) // self._batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self._epoch_batches(self._generator)
+
+    def peek(self) -> List[List[int]]:
+        """
+        The batches of the next epoch, in order, without advancing the sampler
+        """
+        generator = torch.Generator()
+        generator.set_state(self._generator.get_state())
+        return list(self._epoch_batches(generator))
+
+    def _epoch_batches(self, generator: torch.Generator) -> Iterator[List[int]]:
+        indices = torch.randperm(len(self._seq_lengths), generator=generator).numpy()
+        batches = list()
+        bucket_len = self._batch_size * self._bucket_size
+        for bucket_start in range(0, len(indices), bucket_len):
+            bucket = indices[bucket_start: bucket_start + bucket_len]
+            # stable sort, so that instances of the same length stay shuffled
+            bucket = bucket[np.argsort(-self._seq_lengths[bucket], kind='stable')]
+            batches += [bucket[i: i + self._batch_size].tolist() for i in range(0, len(bucket), self._batch_size)]
+        for batch_idx in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[batch_idx]
+
+
+class SortedBatchSampler(Sampler):
+    """
+    Evaluation batch sampler that visits the instances from the longest to the shortest.
+    `restore_order` maps the per-instance outputs back to the order of the dataset.
+    """
+
+    def __init__(self, seq_lengths: List[int], batch_size: int):
+        self._order = np.argsort(-np.asarray(seq_lengths), kind='stable')
+        self._batch_size = batch_size
+
+    @property
+    def order(self):
+        """
+        The dataset index of each instance in the visiting order
+        """
+        return self._order
+
+    def __len__(self):
+        return -(-len(self._order) // self._batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for i in range(0, len(self._order), self._batch_size):
+            yield self._order[i: i + self._batch_size].tolist()
+
+    def restore_order(self, outputs: list) -> list:
+        """
+        Reorder a list of per-instance outputs from the visiting order to the dataset order
+        """
+        assert len(outputs) == len(self._order), ValueError("The outputs do not cover the dataset")
+        restored = [None] * len(outputs)
+        for output, idx in zip(outputs, self._order):
+            restored[idx] = output
+        return restored
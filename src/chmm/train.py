@@ -1,4 +1,5 @@
 import os
+import copy
 import time
 import torch
 import logging
@@ -7,12 +8,15 @@ import numpy as np
 from tqdm.auto import tqdm
 from typing import Optional
 from torch.nn import functional as F
+from torch.utils.data import DataLoader
 
 from seqlbtoolkit.training.eval import Metric, get_ner_metrics
 from seqlbtoolkit.training.train import BaseTrainer
 
 from .model import CHMM
+from .annotator import export_annotator
 from .dataset import CHMMBaseDataset
+from .sampler import BucketBatchSampler, SortedBatchSampler, padding_ratio
 
 
 OUT_RECALL = 0.9
@@ -29,23 +33,20 @@ def initialise_transmat(observations,
     :param src_idx: the index of the source of which the transition statistics is computed.
                     If None, use all sources
     :param label_set: a set of all possible label_set
-    :param observations: n_instances X seq_len X n_src X d_obs
+    :param observations: n_instances X seq_len X n_src X d_obs, or n_instances X seq_len X n_src label indices
     :return: initial transition matrix and transition counts
     """
 
     logger.info("Constructing transition matrix prior...")
-    n_src = observations[0].shape[1]
     trans_counts = np.zeros((len(label_set), len(label_set)))
 
-    if src_idx is not None:
-        for obs in observations:
-            for k in range(0, len(obs) - 1):
-                trans_counts[obs[k, src_idx].argmax(), obs[k + 1, src_idx].argmax()] += 1
-    else:
-        for obs in observations:
-            for k in range(0, len(obs) - 1):
-                for z in range(n_src):
-                    trans_counts[obs[k, z].argmax(), obs[k + 1, z].argmax()] += 1
+    for obs in observations:
+        obs_ids = obs if obs.ndim == 2 else obs.argmax(axis=-1)
+        if src_idx is not None:
+            obs_ids = obs_ids[:, [src_idx]]
+        for k in range(0, len(obs) - 1):
+            for z in range(obs_ids.shape[1]):
+                trans_counts[obs_ids[k, z], obs_ids[k + 1, z]] += 1
 
     # update transition matrix with prior knowledge
     for i, label in enumerate(label_set):
@@ -73,7 +74,7 @@ def initialise_emissions(observations,
     :param sources: source names
     :param src_priors: source priors
     :param label_set: a set of all possible label_set
-    :param observations: n_instances X seq_len X n_src X d_obs
+    :param observations: n_instances X seq_len X n_src X d_obs, or n_instances X seq_len X n_src label indices
     :param strength: Don't know what this is for
     :return: initial emission matrices and emission counts?
     """
@@ -83,7 +84,10 @@ def initialise_emissions(observations,
     obs_counts = np.zeros((len(sources), len(label_set)), dtype=np.float64)
     # extract the total number of observations for each prior
     for obs in observations:
-        obs_counts += obs.sum(axis=0)
+        if obs.ndim == 2:
+            np.add.at(obs_counts, (np.arange(len(sources)), obs.astype(np.int64)), 1)
+        else:
+            obs_counts += obs.sum(axis=0)
     for source_index, source in enumerate(sources):
         # increase p(O)
         obs_counts[source_index, 0] += 1
@@ -152,6 +156,8 @@ class CHMMTrainer(BaseTrainer):
 
         super().__init__(config, training_dataset, valid_dataset, test_dataset, collate_fn)
         self._model = None
+        self._quantized_model = None
+        self._logged_padding = set()
         self._pretrain_optimizer = pretrain_optimizer
         self._init_state_prior = None
         self._init_trans_mat = None
@@ -161,6 +167,51 @@ class CHMMTrainer(BaseTrainer):
     def neural_module(self):
         return self._model.neural_module
 
+    def get_dataloader(self,
+                       dataset: CHMMBaseDataset,
+                       shuffle: Optional[bool] = False,
+                       batch_size: Optional[int] = 0):
+        # the observations are normalized once per dataset rather than for every batch
+        dataset.prepare_obs(self._config.obs_normalization)
+        batch_size = batch_size if batch_size else self._config.lm_batch_size
+        if not getattr(self._config, 'length_bucketing', False):
+            return super().get_dataloader(dataset, shuffle=shuffle, batch_size=batch_size)
+
+        seq_lengths = [len(obs) for obs in dataset.obs]
+        if shuffle:
+            batch_sampler = BucketBatchSampler(seq_lengths, batch_size, self._config.bucket_size, self._config.seed)
+            default_order = np.random.default_rng(self._config.seed).permutation(len(seq_lengths))
+        else:
+            batch_sampler = SortedBatchSampler(seq_lengths, batch_size)
+            default_order = np.arange(len(seq_lengths))
+        # evaluation data loaders are built for every evaluation; their padding is logged once per dataset
+        log_key = (id(dataset), batch_size, shuffle)
+        if log_key not in self._logged_padding:
+            self._logged_padding.add(log_key)
+            default_batches = [default_order[i: i + batch_size] for i in range(0, len(default_order), batch_size)]
+            # `peek` leaves the generator of the sampler at the first epoch, whose batches are the logged ones
+            batches = batch_sampler.peek() if shuffle else list(batch_sampler)
+            logger.info(f"Padding ratio: {padding_ratio(seq_lengths, default_batches):.2%} -> "
+                        f"{padding_ratio(seq_lengths, batches):.2%} with length "
+                        f"{'bucketing' if shuffle else 'sorting'}")
+
+        return DataLoader(
+            dataset=dataset,
+            collate_fn=self._collate_fn,
+            batch_sampler=batch_sampler,
+            num_workers=getattr(self._config, "num_workers", 0),
+            pin_memory=getattr(self._config, "pin_memory", False)
+        )
+
+    @staticmethod
+    def _restore_order(data_loader: DataLoader, outputs: Optional[list]) -> Optional[list]:
+        """
+        Map the per-instance outputs of an evaluation data loader back to the dataset order
+        """
+        if outputs is None or not isinstance(data_loader.batch_sampler, SortedBatchSampler):
+            return outputs
+        return data_loader.batch_sampler.restore_order(outputs)
+
     def initialize_trainer(self):
         """
         Initialize necessary components for training
@@ -176,6 +227,7 @@ class CHMMTrainer(BaseTrainer):
         return self
 
     def initialize_model(self):
+        self._quantized_model = None
         self._model = CHMM(
             config=self._config,
             state_prior=self._init_state_prior,
@@ -202,7 +254,13 @@ class CHMMTrainer(BaseTrainer):
         # construct/load initial transition matrix
         dataset_dir = os.path.split(self._config.train_path)[0]
         transmat_path = os.path.join(dataset_dir, "init_transmat.pt")
-        if getattr(self._config, "load_init_mat", False):
+        if self._config.num_restarts > 1:
+            # every replica starts from its own random transition matrix
+            logger.info(f"Constructing {self._config.num_restarts} initial transition matrices for the replicas")
+            self._init_trans_mat = torch.tensor(np.stack([initialise_transmat(
+                observations=intg_obs, label_set=self._config.bio_label_types
+            )[0] for _ in range(self._config.num_restarts)]), dtype=torch.float)
+        elif getattr(self._config, "load_init_mat", False):
             if os.path.isfile(transmat_path):
                 logger.info("Loading initial transition matrix from disk")
                 self._init_trans_mat = torch.load(transmat_path)
@@ -260,12 +318,15 @@ class CHMMTrainer(BaseTrainer):
             emiss_ = emiss_.to(self._config.device)
 
         for i, batch in enumerate(tqdm(data_loader)):
-            emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device), batch[:3])
+            emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
             batch_size = len(obs_batch)
             num_samples += batch_size
 
             optimizer.zero_grad()
             nn_trans, nn_emiss = self.neural_module(embs=emb_batch)
+            # with replicas, the outputs of all replicas are concatenated along the batch dimension
+            n_replicas = len(nn_trans) // len(seq_lens)
+            seq_lens = seq_lens.repeat(n_replicas)
             batch_size, max_seq_len, n_hidden, _ = nn_trans.size()
 
             loss_mask = torch.zeros([batch_size, max_seq_len], device=self._config.device)
@@ -273,10 +334,16 @@ class CHMMTrainer(BaseTrainer):
                 loss_mask[n, :seq_lens[n]] = 1
             trans_mask = loss_mask.view(batch_size, max_seq_len, 1, 1)
             trans_pred = trans_mask * nn_trans
-            trans_true = trans_mask * trans_.view(1, 1, n_hidden, n_hidden).repeat(batch_size, max_seq_len, 1, 1)
+            # each replica is pre-trained towards its own initial transition matrix
+            trans_true = trans_mask * trans_.view(-1, 1, 1, 1, n_hidden, n_hidden)\
+                .expand(n_replicas, len(seq_lens) // n_replicas, max_seq_len, -1, -1, -1)\
+                .reshape(batch_size, max_seq_len, n_hidden, n_hidden)
 
             emiss_pred = emiss_true = 0
-            if nn_emiss is not None:
+            if isinstance(nn_emiss, tuple):
+                # factorized emissions; compared with the target without composing them
+                pass
+            elif nn_emiss is not None:
                 n_obs = nn_emiss.size(-1)
                 emiss_mask = loss_mask.view(batch_size, max_seq_len, 1, 1, 1)
                 emiss_pred = emiss_mask * nn_emiss
@@ -288,13 +355,16 @@ class CHMMTrainer(BaseTrainer):
                 l1 = F.mse_loss(trans_pred, trans_true)
             else:
                 l1 = 0
-            if emiss_ is not None and nn_emiss is not None:
+            if emiss_ is not None and isinstance(nn_emiss, tuple):
+                l2 = self.neural_module.factorized_emissions_mse(nn_emiss, emiss_, loss_mask)
+            elif emiss_ is not None and nn_emiss is not None:
                 l2 = F.mse_loss(emiss_pred, emiss_true)
             else:
                 l2 = 0
             loss = l1 + l2
             loss.backward()
             optimizer.step()
+            self._quantized_model = None
 
             train_loss += loss.item() * batch_size
         train_loss /= num_samples
@@ -312,23 +382,25 @@ class CHMMTrainer(BaseTrainer):
 
         for i, batch in enumerate(tqdm(data_loader)):
             # get data
-            emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device), batch[:3])
+            emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
             batch_size = len(obs_batch)
             num_samples += batch_size
 
-            # training step
+            # training step. The observations are already normalized by `CHMMBaseDataset.prepare_obs`
             self._optimizer.zero_grad()
             log_probs, _ = self._model(
                 emb=emb_batch, obs=obs_batch, seq_lengths=seq_lens,
-                normalize_observation=self._config.obs_normalization
+                normalize_observation=False
             )
 
-            loss = -log_probs.mean()
+            # with replicas, the log-likelihoods of the replicas are summed so that each one gets its own gradient
+            loss = -log_probs.sum()
             loss.backward()
             self._optimizer.step()
+            self._quantized_model = None
 
-            # track loss
-            train_loss += loss.item() * batch_size
+            # track loss, averaged over the replicas
+            train_loss += loss.item() / log_probs.numel() * batch_size
 
         if start_time is not None:
             logger.info(f"Training time for current epoch: {time.time() - start_time} s.")
@@ -355,6 +427,12 @@ class CHMMTrainer(BaseTrainer):
                 logger.info(f"Epoch: {epoch_i}, Loss: {train_loss}")
             logger.info("Neural module pretrained!")
 
+        if self._model.n_replicas > 1:
+            valid_results = self._train_replicas(training_dataloader)
+            self.load()
+            self._log_quantization_error()
+            return valid_results
+
         valid_results = Metric()
         best_f1 = 0
         tolerance_epoch = 0
@@ -373,6 +451,10 @@ class CHMMTrainer(BaseTrainer):
             logger.info("Validation results:")
             for k, v in valid_metrics.items():
                 logger.info(f"  {k}: {v:.4f}")
+            if self._model.is_beam_pruned:
+                logger.info("Beam-pruned inference against exact inference on a validation batch:")
+                for k, v in self.beam_approximation_error(self._valid_dataset).items():
+                    logger.info(f"  {k}: {v:.4g}")
 
             # ----- save model -----
             if valid_metrics['f1'] >= best_f1:
@@ -391,60 +473,397 @@ class CHMMTrainer(BaseTrainer):
 
         # retrieve the best state dict
         self.load()
+        self._log_quantization_error()
 
         return valid_results
 
+    def _log_quantization_error(self):
+        if self._config.nn_quantization == 'none':
+            return None
+        logger.info("Quantized model against the float32 model on the validation set:")
+        for k, v in self.quantization_error(self._valid_dataset).items():
+            logger.info(f"  {k}: {v:.4g}")
+        return None
+
+    def _train_replicas(self, training_dataloader) -> Metric:
+        """
+        Train all CHMM replicas together and keep the replica with the best validation F1.
+        Afterwards, the trainer holds (and has saved) a single CHMM with the best parameters of that replica.
+
+        Returns
+        -------
+        validation results of the kept replica
+        """
+        n_replicas = self._model.n_replicas
+        valid_results = [Metric() for _ in range(n_replicas)]
+        best_f1 = np.zeros(n_replicas)
+        best_state_dicts = [None] * n_replicas
+        tolerance_epoch = 0
+
+        logger.info(" ----- ")
+        logger.info(f"Training {n_replicas} CHMM replicas...")
+        for epoch_i in range(self._config.num_lm_train_epochs):
+            logger.info("------")
+            logger.info(f"Epoch {epoch_i + 1} of {self._config.num_lm_train_epochs}")
+
+            train_loss = self.training_step(training_dataloader)
+            replica_metrics = self.evaluate_replicas(self._valid_dataset)
+
+            logger.info("Training loss: %.4f" % train_loss)
+            logger.info("Validation results:")
+            improved = False
+            for replica_idx, valid_metrics in enumerate(replica_metrics):
+                logger.info(f"  replica {replica_idx}: " + ", ".join(f"{k}: {v:.4f}" for k, v in valid_metrics.items()))
+                valid_results[replica_idx].append(valid_metrics)
+
+                # ----- keep the best parameters of each replica -----
+                if valid_metrics['f1'] >= best_f1[replica_idx]:
+                    best_f1[replica_idx] = valid_metrics['f1']
+                    best_state_dicts[replica_idx] = {
+                        k: v.detach().cpu().clone() for k, v in self._model.replica_state_dict(replica_idx).items()
+                    }
+                    improved = True
+
+            tolerance_epoch = 0 if improved else tolerance_epoch + 1
+            if tolerance_epoch > self._config.num_lm_valid_tolerance:
+                logger.info("Training stopped because of exceeding tolerance")
+                break
+
+        best_replica = int(np.argmax(best_f1))
+        logger.info(f"Keeping replica {best_replica} with validation f1 {best_f1[best_replica]:.4f}")
+
+        # continue with a single CHMM. The config is copied so that the caller's config still asks for replicas
+        self._config = copy.copy(self._config)
+        self._config.num_restarts = 1
+        self._init_trans_mat = self._init_trans_mat[best_replica]
+        self.initialize_model()
+        self._model.load_state_dict(best_state_dicts[best_replica])
+        self._model.to(self._config.device)
+        self.initialize_optimizers()
+        self.save()
+        logger.info("Checkpoint Saved!\n")
+
+        return valid_results[best_replica]
+
     def evaluate(self, dataset: CHMMBaseDataset) -> Metric:
+        """
+        Evaluate the model on a dataset. With replicas, the metrics of the first replica are returned;
+        see `evaluate_replicas`.
+        """
+        return self.evaluate_replicas(dataset)[0]
+
+    def evaluate_replicas(self, dataset: CHMMBaseDataset) -> list[Metric]:
+        """
+        Evaluate every replica of the model on a dataset, decoding all replicas on the same batches.
 
+        Returns
+        -------
+        metrics of each replica
+        """
         data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
-        self._model.eval()
+        model = self._inference_model()
 
-        pred_lbs = list()
+        pred_lbs = [list() for _ in range(model.n_replicas)]
         with torch.no_grad():
             for i, batch in enumerate(tqdm(data_loader)):
                 # get data
-                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device), batch[:3])
+                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
 
-                # get prediction
-                pred_lb_indices, _ = self._model.viterbi(
+                # get prediction; the marginals are not needed for the metrics
+                pred_lb_indices, _ = model.decode(
                     emb=emb_batch,
                     obs=obs_batch,
                     seq_lengths=seq_lens,
-                    normalize_observation=self._config.obs_normalization
+                    mode=self._config.decode_mode,
+                    normalize_observation=False
                 )
                 pred_lb_batch = [[self._config.bio_label_types[lb_index] for lb_index in label_indices]
                                  for label_indices in pred_lb_indices]
-                pred_lbs += pred_lb_batch
+                # the replicas are concatenated along the batch dimension
+                for replica_idx, replica_pred_lbs in enumerate(pred_lbs):
+                    replica_pred_lbs += pred_lb_batch[replica_idx * len(seq_lens): (replica_idx + 1) * len(seq_lens)]
 
         true_lbs = dataset.lbs
-        metric_values = get_ner_metrics(true_lbs, pred_lbs)
+        return [get_ner_metrics(true_lbs, self._restore_order(data_loader, replica_pred_lbs))
+                for replica_pred_lbs in pred_lbs]
+
+    def _inference_model(self) -> CHMM:
+        """
+        The model used for prediction and evaluation, quantized according to `config.nn_quantization`.
+        CHMM replicas are always evaluated in float32.
+        """
+        self._model.eval()
+        if self._config.nn_quantization == 'dynamic' and self._model.n_replicas == 1:
+            return self._quantized()
+        return self._model
 
-        return metric_values
+    def _quantized(self) -> CHMM:
+        """
+        The int8-quantized copy of the model (see `CHMM.quantized`), kept until the parameters change
+        """
+        if self._quantized_model is None:
+            self._quantized_model = self._model.quantized()
+        return self._quantized_model
 
-    def predict(self, dataset: CHMMBaseDataset):
+    def quantization_error(self, dataset: CHMMBaseDataset) -> dict:
+        """
+        Compare the int8-quantized model (see `CHMM.quantized`) with the float32 model on a dataset.
 
+        Parameters
+        ----------
+        dataset: dataset to compare on, usually the validation set
+
+        Returns
+        -------
+        the f1 scores of both models; the mean KL divergence of the quantized marginals from the float32 marginals;
+        the fraction of tokens whose labels differ; and the throughput (tokens per second) of both models
+        """
         data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
         self._model.eval()
+        decode_mode = 'both' if self._config.decode_mode == 'viterbi' else self._config.decode_mode
 
-        pred_lbs = list()
-        pred_probs = list()
+        outputs = dict()
+        with torch.no_grad():
+            for name, model in [('float32', self._model), ('int8', self._quantized())]:
+                pred_lb_indices, pred_probs = list(), list()
+                start_time = time.time()
+                for batch in data_loader:
+                    emb_batch, obs_batch, seq_lens = map(
+                        lambda x: x.to(self._config.device, non_blocking=True), batch[:3]
+                    )
+                    lb_indices, probs = model.decode(
+                        emb=emb_batch, obs=obs_batch, seq_lengths=seq_lens, mode=decode_mode,
+                        normalize_observation=False
+                    )
+                    pred_lb_indices += lb_indices
+                    pred_probs += probs
+                outputs[name] = (pred_lb_indices, np.concatenate(pred_probs), time.time() - start_time)
+
+        results = dict()
+        for name, (pred_lb_indices, _, _) in outputs.items():
+            pred_lbs = [[self._config.bio_label_types[lb_index] for lb_index in label_indices]
+                        for label_indices in pred_lb_indices]
+            results[f'{name} f1'] = get_ner_metrics(dataset.lbs, self._restore_order(data_loader, pred_lbs))['f1']
+
+        fp_lb_indices, fp_probs, fp_time = outputs['float32']
+        q_lb_indices, q_probs, q_time = outputs['int8']
+        fp_probs, q_probs = np.clip(fp_probs, 1E-12, None), np.clip(q_probs, 1E-12, None)
+        fp_paths, q_paths = np.concatenate(fp_lb_indices), np.concatenate(q_lb_indices)
+        results.update({
+            'marginal mean kl divergence': (fp_probs * (np.log(fp_probs) - np.log(q_probs))).sum(axis=-1).mean(),
+            'label mismatch': (fp_paths != q_paths).mean(),
+            'float32 tokens/s': len(fp_paths) / fp_time,
+            'int8 tokens/s': len(q_paths) / q_time,
+        })
+        return results
+
+    def beam_approximation_error(self, dataset: CHMMBaseDataset) -> dict:
+        """
+        Compare beam-pruned inference with exact inference on the first batch of a dataset.
+
+        Parameters
+        ----------
+        dataset: dataset to compare on, usually the validation set
+
+        Returns
+        -------
+        error metrics: the absolute difference of the (expected complete) log-likelihood; the mean total variation
+        distance and the max absolute difference between the marginals; the exact posterior mass on the pruned
+        states; the fraction of tokens whose Viterbi labels differ; and the wall-clock time of both
+        """
+        data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
+        emb_batch, obs_batch, seq_lens = map(
+            lambda x: x.to(self._config.device, non_blocking=True), next(iter(data_loader))[:3]
+        )
+        self._model.eval()
+
+        outputs = dict()
+        with torch.no_grad():
+            for name, (beam_size, threshold) in [('beam', (self._config.fb_beam_size, self._config.fb_beam_threshold)),
+                                                 ('exact', (0, 0.0))]:
+                self._model.set_beam(beam_size, threshold)
+                start_time = time.time()
+                log_probs, _ = self._model(
+                    emb=emb_batch, obs=obs_batch, seq_lengths=seq_lens, normalize_observation=False
+                )
+                paths, marginals = self._model.decode(
+                    emb=emb_batch, obs=obs_batch, seq_lengths=seq_lens, mode='both', normalize_observation=False
+                )
+                outputs[name] = (log_probs.item(), paths, marginals, time.time() - start_time)
+        self._model.set_beam(self._config.fb_beam_size, self._config.fb_beam_threshold)
+
+        beam_log_prob, beam_paths, beam_marginals, beam_time = outputs['beam']
+        exact_log_prob, exact_paths, exact_marginals, exact_time = outputs['exact']
+        beam_marginals, exact_marginals = np.concatenate(beam_marginals), np.concatenate(exact_marginals)
+        beam_paths, exact_paths = np.concatenate(beam_paths), np.concatenate(exact_paths)
+        return {
+            'log-likelihood abs diff': abs(beam_log_prob - exact_log_prob),
+            'marginal mean tv distance': 0.5 * np.abs(beam_marginals - exact_marginals).sum(axis=-1).mean(),
+            'marginal max abs diff': np.abs(beam_marginals - exact_marginals).max(),
+            'pruned posterior mass': (exact_marginals * (beam_marginals == 0)).sum(axis=-1).mean(),
+            'viterbi label mismatch': (beam_paths != exact_paths).mean(),
+            'beam time (s)': beam_time,
+            'exact time (s)': exact_time,
+        }
+
+    def predict(self,
+                dataset: CHMMBaseDataset,
+                return_labels: Optional[bool] = True,
+                return_probs: Optional[bool] = True,
+                n_best: Optional[int] = 1):
+        """
+        Predict the labels and/or the label marginals of a dataset.
+        Only the inference passes needed by the requested outputs are run.
+
+        Parameters
+        ----------
+        dataset: dataset to predict
+        return_labels: whether return the hard labels, decoded according to `config.decode_mode`
+        return_probs: whether return the posterior marginals
+        n_best: if larger than 1, return the `n_best` most probable label sequences of each instance instead
+            of the decoded labels, together with their log probabilities
+
+        Returns
+        -------
+        predicted labels (None if not requested), predicted marginals (None if not requested);
+        with `n_best` > 1, the labels are a list of `n_best` label sequences per instance,
+        and the log probabilities of the sequences are returned as the third output
+        """
+        if n_best > 1:
+            return self._predict_nbest(dataset, return_probs, n_best)
+
+        assert return_labels or return_probs, ValueError("Nothing to predict!")
+        assert self._config.decode_mode in ['viterbi', 'mbr'], \
+            ValueError(f"Unknown label decode mode: {self._config.decode_mode}")
+        if not return_labels:
+            decode_mode = 'posterior'
+        elif return_probs and self._config.decode_mode == 'viterbi':
+            decode_mode = 'both'
+        else:
+            decode_mode = self._config.decode_mode
+
+        data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
+        model = self._inference_model()
+
+        pred_lbs = list() if return_labels else None
+        pred_probs = list() if return_probs else None
         with torch.no_grad():
             for i, batch in enumerate(tqdm(data_loader)):
                 # get data
-                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device), batch[:3])
+                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
 
                 # get prediction
-                pred_lb_indices, pred_prob_batch = self._model.viterbi(
+                pred_lb_indices, pred_prob_batch = model.decode(
                     emb=emb_batch,
                     obs=obs_batch,
                     seq_lengths=seq_lens,
-                    normalize_observation=self._config.obs_normalization
+                    mode=decode_mode,
+                    normalize_observation=False
                 )
-                pred_lb_batch = [[self._config.bio_label_types[lb_index] for lb_index in label_indices]
+
+                if return_probs:
+                    pred_probs += pred_prob_batch
+                if return_labels:
+                    pred_lbs += [[self._config.bio_label_types[lb_index] for lb_index in label_indices]
                                  for label_indices in pred_lb_indices]
 
-                pred_probs += pred_prob_batch
-                pred_lbs += pred_lb_batch
+        return self._restore_order(data_loader, pred_lbs), self._restore_order(data_loader, pred_probs)
+
+    def _predict_nbest(self, dataset: CHMMBaseDataset, return_probs: bool, n_best: int):
+        data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
+        model = self._inference_model()
+
+        pred_lbs = list()
+        pred_probs = list() if return_probs else None
+        pred_scores = list()
+        with torch.no_grad():
+            for i, batch in enumerate(tqdm(data_loader)):
+                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
+
+                # the marginals come from the inference states of the n-best decoding
+                outputs = model.nbest_viterbi(
+                    emb=emb_batch, obs=obs_batch, seq_lengths=seq_lens, n_best=n_best, normalize_observation=False,
+                    return_marginals=return_probs
+                )
+                nbest_lb_indices, nbest_scores = outputs[:2]
+                if return_probs:
+                    pred_probs += outputs[2]
+                pred_lbs += [[[self._config.bio_label_types[lb_index] for lb_index in label_indices]
+                              for label_indices in inst_lb_indices] for inst_lb_indices in nbest_lb_indices]
+                pred_scores += nbest_scores
+
+        return tuple(self._restore_order(data_loader, outputs) for outputs in (pred_lbs, pred_probs, pred_scores))
+
+    def predict_scored_spans(self, dataset: CHMMBaseDataset):
+        """
+        Predict the scored entity spans of a dataset as flat arrays, see `CHMM.scored_spans`.
+
+        Parameters
+        ----------
+        dataset: dataset to predict
+
+        Returns
+        -------
+        numpy arrays of the instance index, start, end (exclusive), entity type index and score of each span
+        """
+        data_loader = self.get_dataloader(dataset, batch_size=self.config.lm_batch_size)
+        model = self._inference_model()
+
+        span_arrays = list()
+        n_instances = 0
+        with torch.no_grad():
+            for i, batch in enumerate(tqdm(data_loader)):
+                emb_batch, obs_batch, seq_lens = map(lambda x: x.to(self._config.device, non_blocking=True), batch[:3])
+
+                sent_ids, *span_batch = model.scored_spans(
+                    emb=emb_batch,
+                    obs=obs_batch,
+                    seq_lengths=seq_lens,
+                    label_types=self._config.bio_label_types,
+                    normalize_observation=False
+                )
+                span_arrays.append((sent_ids + n_instances, *span_batch))
+                n_instances += len(seq_lens)
+
+        sent_ids, *span_arrays = (np.concatenate(arrays) for arrays in zip(*span_arrays))
+        if isinstance(data_loader.batch_sampler, SortedBatchSampler):
+            # from the positions in the visiting order to the dataset indices, with the spans ordered as without sorting
+            sent_ids = data_loader.batch_sampler.order[sent_ids]
+            span_order = np.argsort(sent_ids, kind='stable')
+            sent_ids, span_arrays = sent_ids[span_order], [array[span_order] for array in span_arrays]
+        return (sent_ids, *span_arrays)
+
+    def stream_predict(self, dataset: CHMMBaseDataset):
+        """
+        Predict the labels and label marginals of a dataset instance by instance with streaming inference,
+        so that the memory does not grow with the lengths of the instances (e.g., whole documents).
+        The labels are the per-token argmax of the (fixed-lag smoothed) marginals.
+
+        Parameters
+        ----------
+        dataset: dataset to predict
+
+        Returns
+        -------
+        predicted labels, predicted marginals
+        """
+        model = self._inference_model()
+
+        pred_lbs = list()
+        pred_probs = list()
+        with torch.no_grad():
+            dataset.prepare_obs(self._config.obs_normalization)
+            for i in tqdm(range(len(dataset))):
+                _, emb, obs = dataset[i][:3]
+                probs = np.concatenate([chunk_probs for _, chunk_probs in model.stream_posteriors(
+                    emb=emb,
+                    obs=obs,
+                    chunk_size=self._config.stream_chunk_size,
+                    lag=self._config.stream_lag,
+                    normalize_observation=False
+                )])
+                pred_probs.append(probs)
+                pred_lbs.append([self._config.bio_label_types[lb_index] for lb_index in probs.argmax(axis=-1)])
 
         return pred_lbs, pred_probs
 
@@ -474,11 +893,12 @@ class CHMMTrainer(BaseTrainer):
         emissions = None
         with torch.no_grad():
             for i, batch in enumerate(tqdm(data_loader)):
-                emb_batch = batch[0].to(self.config.device)
-                seq_lens = batch[2].to(self.config.device)
+                emb_batch = batch[0].to(self.config.device, non_blocking=True)
+                seq_lens = batch[2].to(self.config.device, non_blocking=True)
 
                 # predict reliability scores
                 trans_probs, emiss_probs = self.neural_module(embs=emb_batch)
+                emiss_probs = self.neural_module.compose_emissions(emiss_probs)
 
                 if transitions is None:
                     transitions = [trans[:seq_len] for trans, seq_len in zip(trans_probs.detach().cpu(), seq_lens)]
@@ -486,7 +906,7 @@ class CHMMTrainer(BaseTrainer):
                 else:
                     transitions += [trans[:seq_len] for trans, seq_len in zip(trans_probs.detach().cpu(), seq_lens)]
                     emissions += [emiss[:seq_len] for emiss, seq_len in zip(emiss_probs.detach().cpu(), seq_lens)]
-        return transitions, emissions
+        return self._restore_order(data_loader, transitions), self._restore_order(data_loader, emissions)
 
     def get_pretrain_optimizer(self):
         pretrain_optimizer = torch.optim.Adam(
@@ -594,6 +1014,28 @@ class CHMMTrainer(BaseTrainer):
                 logger.warning("Pretrain optimizer file does not exist!")
         return self
 
+    def export_annotator(self,
+                         output_dir: Optional[str] = None,
+                         file_name: Optional[str] = 'chmm-annotator'):
+        """
+        Export the trained model as a self-contained TorchScript annotator, see `annotator.FrozenCHMM`.
+        Load it with `annotator.load_annotator`, which does not need the training stack.
+
+        Parameters
+        ----------
+        output_dir: output directory
+        file_name: file name (suffix free)
+
+        Returns
+        -------
+        the path of the exported file
+        """
+        output_dir = output_dir if output_dir is not None else self._config.output_dir
+        file_path = os.path.join(output_dir, f'{file_name}.pt')
+        logger.info(f"Exporting the annotator to {file_path}")
+        export_annotator(self._model, self._config.bio_label_types, file_path)
+        return file_path
+
     def save_results(self,
                      output_dir: str,
                      valid_results: Optional[Metric] = None,
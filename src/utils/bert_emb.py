@@ -0,0 +1,289 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+from tqdm.auto import tqdm
+
+from .emb_cache import model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# the tokenizer and model of a worker process, loaded once by `_init_worker`
+_worker_state = dict()
+
+
+def token_budget_batches(n_rows: List[int], row_lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """
+    Group the instances into batches of similar lengths whose padded size (number of rows X longest row)
+    stays within the token budget. The longest instances come first, so a budget that does not fit in
+    memory fails at once.
+
+    Parameters
+    ----------
+    n_rows: number of encoder rows (windows) of each instance
+    row_lengths: length of the longest row of each instance
+    max_tokens: token budget of a batch; an instance over the budget forms a batch by itself
+
+    Returns
+    -------
+    instance indices of each batch
+    """
+    order = sorted(range(len(row_lengths)), key=lambda idx: (-row_lengths[idx], idx))
+    batches = list()
+    batch = list()
+    batch_rows = 0
+    for idx in order:
+        # the first instance of a batch is the longest one
+        if batch and (batch_rows + n_rows[idx]) * row_lengths[batch[0]] > max_tokens:
+            batches.append(batch)
+            batch = list()
+            batch_rows = 0
+        batch.append(idx)
+        batch_rows += n_rows[idx]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encoder_rows(sentences: List[List[str]], tokenizer, max_seq_length: int) -> Tuple[List[int], List[int]]:
+    """
+    The number of encoder rows each sentence takes and the length of its longest row,
+    from the subword counts of the (batched) fast tokenizer
+    """
+    n_specials = tokenizer.num_special_tokens_to_add()
+    subword_ids = tokenizer(sentences, is_split_into_words=True, add_special_tokens=False)['input_ids']
+    n_subwords = [len(ids) for ids in subword_ids]
+    n_rows = [max(1, -(-n // (max_seq_length - n_specials))) for n in n_subwords]
+    row_lengths = [min(n + n_specials, max_seq_length) for n in n_subwords]
+    return n_rows, row_lengths
+
+
+def pool_subword_embs(hidden_states: torch.Tensor,
+                      word_ids: torch.Tensor,
+                      sample_ids: torch.Tensor,
+                      n_insts: int,
+                      n_words: int) -> torch.Tensor:
+    """
+    Average the subword embeddings of each word with one scatter over the whole batch
+
+    Parameters
+    ----------
+    hidden_states: encoder outputs (n_rows X row_length X d_emb)
+    word_ids: the word of each subword (n_rows X row_length); -1 for special and padding tokens
+    sample_ids: the instance of each row (n_rows); a long instance spans several rows
+    n_insts: number of instances
+    n_words: maximum number of words of an instance
+
+    Returns
+    -------
+    word embeddings (n_insts X n_words X d_emb); words without any subword are zeros
+    """
+    d_emb = hidden_states.shape[-1]
+    valid = word_ids >= 0
+    flat_word_ids = (sample_ids.unsqueeze(-1) * n_words + word_ids)[valid]
+
+    emb_sums = hidden_states.new_zeros([n_insts * n_words, d_emb]).index_add_(0, flat_word_ids, hidden_states[valid])
+    counts = hidden_states.new_zeros(n_insts * n_words).index_add_(
+        0, flat_word_ids, hidden_states.new_ones(len(flat_word_ids))
+    )
+    return (emb_sums / counts.clamp(min=1).unsqueeze(-1)).view(n_insts, n_words, d_emb)
+
+
+def encode_sentences(sentences: List[List[str]],
+                     tokenizer,
+                     model,
+                     max_seq_length: Optional[int] = 512,
+                     device: Optional[str] = 'cpu',
+                     prepend_cls_embs: Optional[bool] = True) -> List[torch.Tensor]:
+    """
+    Word-level embeddings of a batch of tokenized sentences from the last encoder layer
+
+    Sentences longer than `max_seq_length` subwords are split into several rows, whose subwords are pooled
+    back into the words of the sentence.
+
+    Parameters
+    ----------
+    sentences: token sequences
+    tokenizer: a fast (Rust) tokenizer, which provides the word of each subword
+    model: encoder
+    max_seq_length: maximum length of an encoder row, including the special tokens
+    device: device of the model
+    prepend_cls_embs: prepend the [CLS] embedding of the (first row of the) sentence to the word embeddings
+
+    Returns
+    -------
+    (n_words (+1) X d_emb) embeddings of each sentence
+    """
+    encodings = tokenizer(
+        sentences, is_split_into_words=True, truncation=True, max_length=max_seq_length,
+        return_overflowing_tokens=True, padding=True, return_tensors='pt'
+    )
+    sample_ids = encodings.pop('overflow_to_sample_mapping')
+    word_ids = torch.tensor([[-1 if word_id is None else word_id for word_id in encodings.word_ids(row)]
+                             for row in range(len(sample_ids))])
+
+    with torch.inference_mode():
+        hidden_states = model(**{k: v.to(device) for k, v in encodings.items()})[0].to(device='cpu', dtype=torch.float)
+
+    n_words = max(len(sent) for sent in sentences)
+    word_embs = pool_subword_embs(hidden_states, word_ids, sample_ids, len(sentences), n_words)
+
+    embs = list()
+    for idx, sent in enumerate(sentences):
+        emb = word_embs[idx, :len(sent)]
+        if prepend_cls_embs:
+            first_row = (sample_ids == idx).nonzero()[0, 0]
+            emb = torch.cat([hidden_states[first_row, :1], emb])
+        # copy, so that a sentence does not hold on to the whole batch
+        embs.append(emb.clone())
+    return embs
+
+
+def _init_worker(model_name_or_path: str, max_seq_length: int, n_threads: int):
+    from transformers import AutoTokenizer, AutoModel
+
+    torch.set_num_threads(n_threads)
+    _worker_state['tokenizer'] = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+    _worker_state['model'] = AutoModel.from_pretrained(model_name_or_path).eval()
+    _worker_state['max_seq_length'] = max_seq_length
+
+
+def _encode_in_worker(batch):
+    batch_idx, sentences, prepend_cls_embs = batch
+    embs = encode_sentences(
+        sentences, _worker_state['tokenizer'], _worker_state['model'],
+        max_seq_length=_worker_state['max_seq_length'], prepend_cls_embs=prepend_cls_embs
+    )
+    # numpy arrays are pickled by value, which does not use up the file descriptors of shared tensors
+    return batch_idx, [emb.numpy() for emb in embs]
+
+
+class _BatchCheckpoint:
+    """
+    The finished batches of an embedding build, one file per batch, so that an interrupted build resumes.
+    The files are discarded when the build inputs (model, sentences or batching) change.
+    """
+
+    def __init__(self, checkpoint_dir: Optional[str], fingerprint: str):
+        self._checkpoint_dir = checkpoint_dir
+        if checkpoint_dir is None:
+            return
+
+        manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                if json.load(f).get('fingerprint') != fingerprint:
+                    logger.warning(f"The checkpoint in {checkpoint_dir} belongs to another build and is discarded.")
+                    shutil.rmtree(checkpoint_dir)
+        if not os.path.isfile(manifest_path):
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': fingerprint}, f)
+
+    def _batch_path(self, batch_idx: int):
+        return os.path.join(self._checkpoint_dir, f'batch-{batch_idx:06d}.pt')
+
+    def load(self, n_batches: int):
+        if self._checkpoint_dir is None:
+            return dict()
+        finished = {batch_idx: torch.load(self._batch_path(batch_idx))
+                    for batch_idx in range(n_batches) if os.path.isfile(self._batch_path(batch_idx))}
+        if finished:
+            logger.info(f"Resuming from {self._checkpoint_dir}: {len(finished)} of {n_batches} batches are done.")
+        return finished
+
+    def save(self, batch_idx: int, embs: List[torch.Tensor]):
+        if self._checkpoint_dir is None:
+            return
+        batch_path = self._batch_path(batch_idx)
+        torch.save(embs, f'{batch_path}.tmp')
+        os.replace(f'{batch_path}.tmp', batch_path)
+
+    def remove(self):
+        if self._checkpoint_dir is not None and os.path.isdir(self._checkpoint_dir):
+            shutil.rmtree(self._checkpoint_dir)
+
+
+def build_token_embeddings(sentences: List[List[str]],
+                           model_name_or_path: str,
+                           device: Optional[torch.device] = torch.device('cpu'),
+                           max_seq_length: Optional[int] = 512,
+                           max_tokens_per_batch: Optional[int] = 8192,
+                           n_workers: Optional[int] = 1,
+                           checkpoint_dir: Optional[str] = None,
+                           prepend_cls_embs: Optional[bool] = True) -> List[torch.Tensor]:
+    """
+    Build the word-level embeddings of a corpus in batches of similar lengths
+
+    Parameters
+    ----------
+    sentences: token sequences
+    model_name_or_path: encoder (and fast tokenizer) name or path
+    device: device of the encoder; the worker processes always run on CPU
+    max_seq_length: maximum length of an encoder row; longer sentences are split into several rows
+    max_tokens_per_batch: token budget of a batch, padding included
+    n_workers: number of CPU worker processes, which share the CPU threads; 1 encodes in this process
+    checkpoint_dir: where the finished batches are kept until the build completes; None disables resuming
+    prepend_cls_embs: prepend the [CLS] embedding to the word embeddings of each sentence
+
+    Returns
+    -------
+    (n_words (+1) X d_emb) embeddings of each sentence
+    """
+    from transformers import AutoConfig, AutoTokenizer, AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+    assert tokenizer.is_fast, ValueError(f"The tokenizer of {model_name_or_path} does not support word alignment")
+    model_config = AutoConfig.from_pretrained(model_name_or_path)
+    max_seq_length = min(
+        max_seq_length, tokenizer.model_max_length, getattr(model_config, 'max_position_embeddings', max_seq_length)
+    )
+
+    batches = token_budget_batches(*encoder_rows(sentences, tokenizer, max_seq_length), max_tokens_per_batch)
+
+    fingerprint = hashlib.sha1(
+        json.dumps([model_fingerprint(model_name_or_path), max_seq_length, max_tokens_per_batch, prepend_cls_embs,
+                    sentences]).encode('utf-8')
+    ).hexdigest()
+    checkpoint = _BatchCheckpoint(checkpoint_dir, fingerprint)
+    finished = checkpoint.load(len(batches))
+    pending = [(batch_idx, [sentences[idx] for idx in batch], prepend_cls_embs)
+               for batch_idx, batch in enumerate(batches) if batch_idx not in finished]
+
+    device = torch.device(device)
+    n_workers = n_workers if device.type == 'cpu' else 1
+    logger.info(f"Encoding {len(sentences)} sentences in {len(batches)} batches with {model_name_or_path} "
+                f"({n_workers} worker(s) on {device})...")
+
+    progress = tqdm(total=len(batches), initial=len(finished))
+    if n_workers > 1:
+        n_threads = max(1, torch.get_num_threads() // n_workers)
+        # spawn: forked workers may deadlock on the thread pools of the parent process
+        with mp.get_context('spawn').Pool(
+                n_workers, initializer=_init_worker, initargs=(model_name_or_path, max_seq_length, n_threads)
+        ) as pool:
+            for batch_idx, embs in pool.imap_unordered(_encode_in_worker, pending):
+                finished[batch_idx] = [torch.from_numpy(emb) for emb in embs]
+                checkpoint.save(batch_idx, finished[batch_idx])
+                progress.update()
+    elif pending:
+        model = AutoModel.from_pretrained(model_name_or_path).to(device).eval()
+        for batch_idx, batch_sentences, _ in pending:
+            finished[batch_idx] = encode_sentences(
+                batch_sentences, tokenizer, model, max_seq_length, device, prepend_cls_embs
+            )
+            checkpoint.save(batch_idx, finished[batch_idx])
+            progress.update()
+    progress.close()
+
+    embs: List[Optional[torch.Tensor]] = [None] * len(sentences)
+    for batch_idx, batch in enumerate(batches):
+        for idx, emb in zip(batch, finished[batch_idx]):
+            embs[idx] = emb
+    checkpoint.remove()
+    return embs
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def model_fingerprint(model_name_or_path: str):
+    """
+    Identify the model that builds the embeddings. A hub identifier is used as it is; a local checkpoint is
+    identified by its absolute path and the sizes and modification times of its files, so a checkpoint
+    re-trained in place counts as a different model.
+    """
+    if not os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    model_dir = os.path.abspath(model_name_or_path)
+    digest = hashlib.sha1(model_dir.encode('utf-8'))
+    for file_name in sorted(os.listdir(model_dir)):
+        stat = os.stat(os.path.join(model_dir, file_name))
+        digest.update(f'{file_name}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+    return f'{model_dir}@{digest.hexdigest()[:8]}'
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of per-sentence token embeddings, addressed by the hash of the model and the token sequence.
+
+    The entries are spread over up to 256 shard files (`<cache_dir>/<model>/<first two hex digits>.pt`), so adding
+    sentences only rewrites the shards they fall into. Since a key changes with either the model or any token,
+    an entry can never be returned for a different input: appended or edited sentences are simply cache misses,
+    and only they are encoded.
+    """
+
+    def __init__(self, cache_dir: str, model_name_or_path: str):
+        self._model_id = model_fingerprint(model_name_or_path)
+        model_dir_name = f"{os.path.basename(os.path.normpath(model_name_or_path))}-" \
+                         f"{hashlib.sha1(self._model_id.encode('utf-8')).hexdigest()[:8]}"
+        self._cache_dir = os.path.join(cache_dir, model_dir_name)
+        self._shards: Dict[str, Dict[str, torch.Tensor]] = dict()
+
+    @property
+    def model_id(self):
+        return self._model_id
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def sentence_key(self, tokens: List[str]):
+        digest = hashlib.sha1(self._model_id.encode('utf-8'))
+        # the separators cannot appear in the (printable) tokens
+        digest.update(b'\x00')
+        digest.update('\x1f'.join(tokens).encode('utf-8'))
+        return digest.hexdigest()
+
+    def corpus_digest(self, sentences: List[List[str]]):
+        """
+        One hash of the model and all sentences in order, to tell whether an embedding file is up to date
+        """
+        digest = hashlib.sha1()
+        for tokens in sentences:
+            digest.update(self.sentence_key(tokens).encode('ascii'))
+        return digest.hexdigest()
+
+    def _shard_path(self, shard_id: str):
+        return os.path.join(self._cache_dir, f'{shard_id}.pt')
+
+    def _load_shard(self, shard_id: str) -> Dict[str, torch.Tensor]:
+        if shard_id not in self._shards:
+            shard_path = self._shard_path(shard_id)
+            self._shards[shard_id] = torch.load(shard_path) if os.path.isfile(shard_path) else dict()
+        return self._shards[shard_id]
+
+    def _save_shard(self, shard_id: str):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        shard_path = self._shard_path(shard_id)
+        torch.save(self._shards[shard_id], f'{shard_path}.tmp')
+        os.replace(f'{shard_path}.tmp', shard_path)
+
+    def get(self,
+            sentences: List[List[str]],
+            encode_fn: Callable[[List[List[str]]], List[torch.Tensor]]) -> List[torch.Tensor]:
+        """
+        Look up the embeddings of the sentences; encode the missing ones and add them to the cache
+
+        Parameters
+        ----------
+        sentences: token sequences
+        encode_fn: builds the embeddings of a list of token sequences with the cached model
+
+        Returns
+        -------
+        the embeddings of each sentence
+        """
+        keys = [self.sentence_key(tokens) for tokens in sentences]
+        embs: List[Optional[torch.Tensor]] = [self._load_shard(key[:2]).get(key) for key in keys]
+
+        # repeated sentences are encoded only once
+        missing = dict()
+        for idx, (key, emb) in enumerate(zip(keys, embs)):
+            if emb is None and key not in missing:
+                missing[key] = idx
+        logger.info(f"Embedding cache {self._cache_dir}: {len(sentences) - sum(emb is None for emb in embs)} of "
+                    f"{len(sentences)} sentences found; encoding {len(missing)} sentences.")
+        if not missing:
+            return embs
+
+        new_embs = encode_fn([sentences[idx] for idx in missing.values()])
+        updated_shards = set()
+        for key, emb in zip(missing, new_embs):
+            self._load_shard(key[:2])[key] = emb.detach().to(device='cpu', dtype=torch.float).clone()
+            updated_shards.add(key[:2])
+        for shard_id in sorted(updated_shards):
+            self._save_shard(shard_id)
+        logger.info(f"Updated {len(updated_shards)} cache shards.")
+
+        return [self._shards[key[:2]][key] if emb is None else emb for key, emb in zip(keys, embs)]
+
+    @staticmethod
+    def manifest_path(emb_path: str):
+        stem = emb_path[:-len('.pt')] if emb_path.endswith('.pt') else emb_path
+        return f'{stem}-manifest.json'
+
+    def write_manifest(self, emb_path: str, sentences: List[List[str]]):
+        """
+        Record which model and sentences an embedding file was built from
+        """
+        with open(self.manifest_path(emb_path), 'w', encoding='utf-8') as f:
+            json.dump({'model': self._model_id, 'n_sentences': len(sentences),
+                       'digest': self.corpus_digest(sentences)}, f, indent=2)
+        return self
+
+    def is_up_to_date(self, emb_path: str, sentences: List[List[str]]):
+        """
+        Whether the embedding file was built with this model from exactly these sentences.
+        A file without a manifest cannot be verified and is not up to date.
+        """
+        manifest_path = self.manifest_path(emb_path)
+        if not os.path.isfile(manifest_path):
+            return False
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest.get('model') == self._model_id and manifest.get('digest') == self.corpus_digest(sentences)
@@ -0,0 +1,121 @@
+import os
+import logging
+import numpy as np
+from typing import List, Optional, Union
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    Read-only per-sentence token embeddings kept in one contiguous on-disk array.
+
+    The tokens of all sentences are stored back to back in `<stem>.npy` (n_tokens X d_emb, float16 or float32),
+    and `<stem>-offsets.npy` holds the start of each sentence (n_sentences + 1). Both are memory-mapped, so
+    opening the store reads nothing, a sentence is only read when it is indexed, and the processes that open the
+    same store share the pages of the OS cache instead of holding their own copies.
+
+    Indexing returns float32 tensors. With a float32 store, they are views of the memory map without copying.
+    """
+
+    def __init__(self, stem: str):
+        self._stem = stem
+        # copy-on-write mapping: the views are writable for torch, but nothing is ever written back
+        self._data = np.load(self.data_path(stem), mmap_mode='c')
+        self._offsets = np.load(self.offsets_path(stem))
+
+    @staticmethod
+    def data_path(stem: str):
+        return f'{stem}.npy'
+
+    @staticmethod
+    def offsets_path(stem: str):
+        return f'{stem}-offsets.npy'
+
+    @classmethod
+    def exists(cls, stem: str):
+        return os.path.isfile(cls.data_path(stem)) and os.path.isfile(cls.offsets_path(stem))
+
+    @classmethod
+    def write(cls,
+              stem: str,
+              embs: List[Union[torch.Tensor, np.ndarray]],
+              dtype: Optional[str] = 'float32') -> "EmbeddingStore":
+        """
+        Write a list of (seq_len X d_emb) embeddings into a store, sentence by sentence
+
+        Parameters
+        ----------
+        stem: file path without the suffix
+        embs: embeddings of each sentence
+        dtype: storage precision, `float32` or `float16`
+
+        Returns
+        -------
+        the opened store
+        """
+        assert dtype in ['float32', 'float16'], ValueError(f"Unsupported embedding storage type: {dtype}")
+        lengths = np.array([len(emb) for emb in embs], dtype=np.int64)
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+        d_emb = embs[0].shape[-1]
+
+        logger.info(f"Writing {len(embs)} embeddings ({offsets[-1]} tokens, {dtype}) to {cls.data_path(stem)}")
+        # write to temporary files first so that an interrupted write never leaves a store that looks complete
+        tmp_stem = f'{stem}.tmp'
+        data = np.lib.format.open_memmap(
+            cls.data_path(tmp_stem), mode='w+', dtype=np.dtype(dtype), shape=(int(offsets[-1]), d_emb)
+        )
+        for emb, start, end in zip(embs, offsets[:-1], offsets[1:]):
+            data[start:end] = emb.numpy() if isinstance(emb, torch.Tensor) else emb
+        data.flush()
+        del data
+        np.save(cls.offsets_path(tmp_stem), offsets)
+
+        os.replace(cls.data_path(tmp_stem), cls.data_path(stem))
+        os.replace(cls.offsets_path(tmp_stem), cls.offsets_path(stem))
+        return cls(stem)
+
+    @property
+    def d_emb(self):
+        return self._data.shape[-1]
+
+    @property
+    def n_tokens(self):
+        return self._data.shape[0]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Sentence index {idx} out of range")
+        emb = torch.from_numpy(self._data[self._offsets[idx]:self._offsets[idx + 1]])
+        return emb if emb.dtype == torch.float else emb.to(torch.float)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getstate__(self):
+        # re-open the memory map in the receiving process (e.g., a spawned data loader worker) instead of
+        # pickling the whole array
+        return {'stem': self._stem}
+
+    def __setstate__(self, state):
+        self.__init__(state['stem'])
+
+
+def emb_store_stem(emb_path: str):
+    """
+    The store of an embedding file keeps its name without the `.pt` suffix, e.g., `train-emb.pt` -> `train-emb`
+    """
+    return emb_path[:-len('.pt')] if emb_path.endswith('.pt') else emb_path
@@ -45,6 +45,8 @@ def load_data_from_json(file_dir: str, config: Optional = None):
     bio_labels = entity_to_bio_labels(meta_dict['entity_types'])
     label_to_id = {lb: i for i, lb in enumerate(bio_labels)}
     np_map = np.vectorize(lambda lb: label_to_id[lb])
+    obs_format = getattr(config, 'obs_format', 'dense')
+    obs_index_dtype = get_obs_index_dtype(len(bio_labels))
 
     load_all_sources = config is not None and getattr(config, "load_all_sources", False)
     if 'lf_rec' in meta_dict.keys() and not load_all_sources:
@@ -65,11 +67,14 @@ def load_data_from_json(file_dir: str, config: Optional = None):
         # get true labels
         lbs = span_to_label(span_list_to_dict(data['label']), sent_tks)
         lbs_list.append(lbs)
-        # get lf annotations (weak labels) in one-hot format tensor
+        # get lf annotations (weak labels) in one-hot format tensor, or as label indices
         w_lbs = [span_to_label(span_list_to_dict(data['weak_labels'][lf_idx]), sent_tks) for lf_idx in lf_rec_ids]
         w_lbs = np_map(np.asarray(w_lbs).T)
-        w_lbs_one_hot = one_hot(w_lbs, n_class=len(bio_labels))
-        w_lbs_list.append(torch.from_numpy(w_lbs_one_hot).to(dtype=torch.float))
+        if obs_format == 'index':
+            w_lbs_list.append(torch.from_numpy(w_lbs).to(dtype=obs_index_dtype))
+        else:
+            w_lbs_one_hot = one_hot(w_lbs, n_class=len(bio_labels))
+            w_lbs_list.append(torch.from_numpy(w_lbs_one_hot).to(dtype=torch.float))
 
     # update config
     if config:
@@ -124,7 +129,8 @@ def load_data_from_pt(file_dir: str, config: Optional = None):
 
     load_all_sources = config is not None and getattr(config, "load_all_sources", False)
     sources = list(annotation_list[0].keys()) if load_all_sources else meta_dict['sources']
-    weak_label_list = [extract_sequence(
+    extract_fn = extract_sequence_indices if getattr(config, 'obs_format', 'dense') == 'index' else extract_sequence
+    weak_label_list = [extract_fn(
         s, a, sources=sources, label_indices=label_to_id
     ) for s, a in zip(sentence_list, annotation_list)]
 
@@ -204,3 +210,48 @@ def extract_sequence(sent,
                     sequence[start + 1: end, i, label_indices["I-%s" % label]] = conf
 
     return sequence
+
+
+def get_obs_index_dtype(n_lbs: int):
+    """
+    The smallest integer type that holds the label indices of the `index` observation format,
+    including the index `n_lbs` that marks the substituted observations in observation normalization
+    """
+    return torch.int8 if n_lbs <= torch.iinfo(torch.int8).max else torch.int16
+
+
+def extract_sequence_indices(sent,
+                             annotations,
+                             sources,
+                             label_indices):
+    """
+    Same as `extract_sequence`, but keep the observations as label indices of shape (nb_sources,).
+
+    The confidences are not kept: `CHMMBaseDataset.prepare_obs` scales the dense observations of a token to sum
+    to 1, so a single label is one-hot whatever its confidence. Only a token that gets several labels from one
+    source (overlapping spans or several labels of a span) has a soft dense observation, which label indices cannot
+    hold; such annotations raise a ValueError and need the dense format.
+    """
+    sequence = torch.zeros([len(sent), len(sources)], dtype=get_obs_index_dtype(len(label_indices)))
+    for i, source in enumerate(sources):
+        assert source in annotations, logger.error(f"source name {source} is not included in the data")
+        for (start, end), vals in annotations[source].items():
+            for label, conf in vals:
+                if start >= len(sent):
+                    logger.warning("Encountered incorrect annotation boundary")
+                    continue
+                elif end > len(sent):
+                    logger.warning("Encountered incorrect annotation boundary")
+                    end = len(sent)
+
+                span_lbs = torch.full([max(end - start, 1)], label_indices["I-%s" % label], dtype=sequence.dtype)
+                span_lbs[0] = label_indices["B-%s" % label]
+                current_lbs = sequence[start: start + len(span_lbs), i]
+                if ((current_lbs != 0) & (current_lbs != span_lbs)).any():
+                    logger.error(f"Source {source} gives several labels to a token, which the `index` "
+                                 f"observation format cannot hold. Use `obs_format='dense'` instead.")
+                    raise ValueError(f"Source {source} gives several labels to a token, which the `index` "
+                                     f"observation format cannot hold. Use `obs_format='dense'` instead.")
+                sequence[start: start + len(span_lbs), i] = span_lbs
+
+    return sequence
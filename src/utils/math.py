@@ -29,6 +29,124 @@ def log_maxmul(a, b):
     return (a1 + b1).max(-2)
 
 
+class LogMatmulExp(torch.autograd.Function):
+    """
+    `log_matmul` computed as max-shifted exp -> BLAS matmul -> log.
+
+    out_{i,j} = log( sum_k exp(a_{i,k} - ma_i) exp(b_{k,j} - mb_j) ) + ma_i + mb_j,
+    where ma_i = max_k a_{i,k} and mb_j = max_k b_{k,j}.
+
+    No m \times n \times p intermediate is created. The result is exact unless all shifted terms of an entry
+    underflow (below roughly -87 in float32), which does not happen for the probability matrices of CHMM.
+    """
+
+    @staticmethod
+    def forward(ctx, a, b):
+        a_max = a.max(dim=-1, keepdim=True)[0]
+        b_max = b.max(dim=-2, keepdim=True)[0]
+        # rows/columns that are entirely -inf contribute 0 in the linear domain; do not shift by them
+        a_max = torch.where(torch.isfinite(a_max), a_max, torch.zeros_like(a_max))
+        b_max = torch.where(torch.isfinite(b_max), b_max, torch.zeros_like(b_max))
+
+        exp_a = torch.exp(a - a_max)
+        exp_b = torch.exp(b - b_max)
+        out_shifted = torch.matmul(exp_a, exp_b)
+
+        ctx.save_for_backward(exp_a, exp_b, out_shifted)
+        ctx.shapes = (a.shape, b.shape)
+        return torch.log(out_shifted) + a_max + b_max
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        exp_a, exp_b, out_shifted = ctx.saved_tensors
+        a_shape, b_shape = ctx.shapes
+
+        # d out_{i,j} / d a_{i,k} = d out_{i,j} / d b_{k,j} = exp(a_{i,k} + b_{k,j} - out_{i,j})
+        weights = torch.where(out_shifted > 0, grad_output / out_shifted, torch.zeros_like(out_shifted))
+        grad_a = exp_a * torch.matmul(weights, exp_b.transpose(-1, -2))
+        grad_b = exp_b * torch.matmul(exp_a.transpose(-1, -2), weights)
+        # undo broadcasting
+        return grad_a.sum_to_size(a_shape), grad_b.sum_to_size(b_shape)
+
+
+class LogMaxmulChunked(torch.autograd.Function):
+    """
+    `log_maxmul` that reduces over the inner dimension chunk by chunk,
+    so that at most an m \times chunk_size \times p intermediate is created.
+    """
+
+    @staticmethod
+    def forward(ctx, a, b, chunk_size):
+        max_val = argmax_val = None
+        for start in range(0, a.size(-1), chunk_size):
+            end = start + chunk_size
+            chunk_max, chunk_argmax = (a[..., start:end].unsqueeze(-1) + b[..., start:end, :].unsqueeze(-3)).max(-2)
+            chunk_argmax += start
+            if max_val is None:
+                max_val, argmax_val = chunk_max, chunk_argmax
+            else:
+                # strict comparison keeps the first maximum, same as `torch.max`
+                update = chunk_max > max_val
+                max_val = torch.where(update, chunk_max, max_val)
+                argmax_val = torch.where(update, chunk_argmax, argmax_val)
+
+        ctx.save_for_backward(argmax_val)
+        ctx.shapes = (a.shape, b.shape)
+        ctx.mark_non_differentiable(argmax_val)
+        return max_val, argmax_val
+
+    @staticmethod
+    def backward(ctx, grad_max, grad_argmax):
+        argmax_val, = ctx.saved_tensors
+        a_shape, b_shape = ctx.shapes
+        *batch_shape, m, p = argmax_val.shape
+        n = a_shape[-1]
+
+        # the gradient only flows to the maximizing a_{i,k} and b_{k,j}
+        grad_a = grad_max.new_zeros([*batch_shape, m, n]).scatter_add_(-1, argmax_val, grad_max)
+        grad_b = grad_max.new_zeros([*batch_shape, n, p]).scatter_add_(-2, argmax_val, grad_max)
+        return grad_a.sum_to_size(a_shape), grad_b.sum_to_size(b_shape), None
+
+
+def log_matmul_exp(a: torch.Tensor, b: torch.Tensor):
+    """
+    Same as `log_matmul`, computed with a max-shifted BLAS matrix multiplication. See `LogMatmulExp`.
+    """
+    return LogMatmulExp.apply(a, b)
+
+
+def log_maxmul_chunked(a: torch.Tensor, b: torch.Tensor, chunk_size: Optional[int] = 8):
+    """
+    Same as `log_maxmul`, reduced over chunks of the inner dimension. See `LogMaxmulChunked`.
+    """
+    return LogMaxmulChunked.apply(a, b, chunk_size)
+
+
+def log_prefix_matmul(x: torch.Tensor, reverse: Optional[bool] = False, matmul_fn=log_matmul):
+    """
+    Inclusive prefix product of a sequence of log-domain matrices along dimension 1.
+
+    x : batch \times T \times n \times n
+
+    output_{:, t} = x_{:, 0} (x) x_{:, 1} (x) ... (x) x_{:, t}, where (x) is `matmul_fn` (`log_matmul` by default).
+    If `reverse` is True, the suffix product output_{:, t} = x_{:, t} (x) ... (x) x_{:, T-1} is computed instead.
+
+    The log-domain matrix product is associative, so the scan is done in the Hillis-Steele fashion:
+    ceil(log2(T)) sequential steps, each of which is one batched `log_matmul` over all time steps.
+    """
+    seq_len = x.size(1)
+    offset = 1
+    while offset < seq_len:
+        if reverse:
+            head = matmul_fn(x[:, :-offset], x[:, offset:])
+            x = torch.cat([head, x[:, seq_len - offset:]], dim=1)
+        else:
+            tail = matmul_fn(x[:, :-offset], x[:, offset:])
+            x = torch.cat([x[:, :offset], tail], dim=1)
+        offset *= 2
+    return x
+
+
 # noinspection PyTypeChecker
 def logsumexp(x, dim=None, keepdim=False):
     if dim is None:
@@ -58,6 +176,36 @@ def normalize(x, dim=-1, epsilon=1e-6):
     return result
 
 
+def substitute_obs_mask(lbs: torch.Tensor):
+    """
+    Find the observations that are replaced in observation normalization: the sources that observe `O`
+    while at least one other source observes an entity at the same step.
+
+    Parameters
+    ----------
+    lbs: observed label indices (... X n_src)
+
+    Returns
+    -------
+    boolean mask of the same shape
+    """
+    # at least one source observes an entity
+    entity_idx = lbs.sum(dim=-1) > 1E-6
+    # the sources that do not observe any entity
+    no_entity_idx = lbs <= 1E-6
+    return entity_idx.unsqueeze(-1) * no_entity_idx
+
+
+def substitute_obs_prob(d_obs: int, device: Optional[torch.device] = None):
+    """
+    The observation distribution that replaces the masked observations in observation normalization
+    """
+    subsitute_prob = torch.zeros(d_obs, device=device)
+    subsitute_prob[0] = 0.01
+    subsitute_prob[1:] = 0.99 / d_obs
+    return subsitute_prob
+
+
 def entropy(p: torch.Tensor, dim: Optional[int] = -1):
     """
     Calculate entropy